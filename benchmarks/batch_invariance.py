@@ -0,0 +1,65 @@
+"""
+Check that modeling.inference.predict gives every essay the same score at any batch size: each text head is
+scored with --batch_size and with batch_size=1 on the same random essays, and the largest difference is
+reported. BaseModel's head mixes the rows of a batch, so predict always scores it one essay at a time.
+
+    python -m benchmarks.batch_invariance --n_essays 24 --batch_size 8
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from transformers import BatchEncoding
+
+from modeling.model import BaseModel, BaseDevModel, ETSModel, HierarchicalModel, MultitaskModel, PooledModel
+from modeling.inference import predict
+from benchmarks.utils import get_device, print_table
+
+HEADS = {
+    'base': lambda **kw: BaseModel(**kw),
+    'base-dev': lambda **kw: BaseDevModel(**kw),
+    'ets': lambda **kw: ETSModel(**kw),
+    'hierarchical': lambda **kw: HierarchicalModel(**kw),
+    'multitask': lambda **kw: MultitaskModel(**kw),
+    'pooled-mean': lambda **kw: PooledModel(pooling='mean', **kw),
+}
+
+def make_essays(args: argparse.Namespace) -> list:
+    generator = torch.Generator().manual_seed(0)
+    essays = []
+    for _ in range(args.n_essays):
+        length = int(torch.randint(8, args.seq_length + 1, (1,), generator=generator))
+        input_ids = torch.zeros(1, args.seq_length, dtype=torch.long)
+        input_ids[0, :length] = torch.randint(1000, 2000, (length,), generator=generator)
+        attention_mask = (input_ids != 0).long()
+        essays.append((BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask}),
+                       np.random.default_rng(len(essays)).random(args.num_outputs).astype(np.float32)))
+    return essays
+
+def check(name: str, essays: list, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model = HEADS[name](seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name,
+                        load_pretrained=False).to(device)
+    batched = np.array(predict(model, essays, batch_size=args.batch_size, device=device))[:, 0]
+    per_row = np.array(predict(model, essays, batch_size=1, device=device))[:, 0]
+    max_diff = float(np.abs(batched - per_row).max())
+    return {'head': name, 'max_abs_diff': max_diff, 'match': max_diff <= args.atol}
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--heads', type=str, nargs='+', default=list(HEADS))
+    argp.add_argument('--n_essays', type=int, default=24)
+    argp.add_argument('--batch_size', type=int, default=8)
+    argp.add_argument('--seq_length', type=int, default=64)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--atol', type=float, default=1e-4)
+    args = argp.parse_args()
+
+    essays = make_essays(args)
+    rows = [check(name, essays, args) for name in args.heads]
+    print_table(rows, ['head', 'max_abs_diff', 'match'])
+    if not all(row['match'] for row in rows):
+        raise SystemExit("batched scores differ from per-essay scores")
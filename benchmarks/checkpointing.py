@@ -0,0 +1,81 @@
+"""
+How long training stalls per checkpoint: a synchronous save_params against AsyncCheckpointer, whose caller only
+waits for the copy to CPU memory (the write itself overlaps the next epoch). Also checks that a Trainer
+resumed from its saved state continues exactly where an uninterrupted run would be.
+
+    python -m benchmarks.checkpointing --hidden_size 4096 --n_saves 5
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from modeling import trainer
+from modeling.checkpoint import AsyncCheckpointer, save_params
+from benchmarks.train_loop import TinyModel, make_batches
+from benchmarks.utils import get_device, synchronize, count_parameters, print_table
+
+def make_model(args: argparse.Namespace) -> TinyModel:
+    torch.manual_seed(0)
+    return TinyModel(args.vocab_size, args.hidden_size, args.num_outputs).to(get_device())
+
+def stall(mode: str, args: argparse.Namespace, folder: str) -> dict:
+    model = make_model(args)
+    checkpointer = AsyncCheckpointer()
+    path = os.path.join(folder, f"{mode}.pt")
+    stalls = []
+    for _ in range(args.n_saves):
+        synchronize()
+        start = time.perf_counter()
+        if mode == 'sync':
+            save_params(model, path)
+        else:
+            checkpointer.save_params(model, path)
+        stalls.append(time.perf_counter() - start)
+        # stand-in for the next epoch, which the background write overlaps
+        time.sleep(args.epoch_s)
+    start = time.perf_counter()
+    checkpointer.wait()
+    return {'save': mode, 'params_m': count_parameters(model) / 1e6, 'mb_on_disk': os.path.getsize(path) / 2**20,
+            'stall_ms': 1000 * sum(stalls) / len(stalls), 'final_wait_ms': 1000 * (time.perf_counter() - start)}
+
+def run(epochs: range, state_path: str, args: argparse.Namespace, batches: list) -> trainer.Trainer:
+    config = trainer.TrainerConfig(max_epochs=max(epochs.stop, 1), learning_rate=1e-3, lr_decay=True, warmup_tokens=100,
+                                   state_path=state_path)
+    t = trainer.Trainer(model=make_model(args), train_dataloader=batches, config=config)
+    for epoch in range(t.resume() if state_path else epochs.start, epochs.stop):
+        t.losses.append((t.train('train', epoch), None))
+        t.save_checkpoint()
+    t.checkpointer.wait()
+    return t
+
+def check_resume(args: argparse.Namespace, folder: str) -> None:
+    batches = make_batches(args)
+    state_path = os.path.join(folder, "training-state.pt")
+    full = run(range(0, 4), None, args, batches)
+    run(range(0, 2), state_path, args, batches) # "interrupted" after two epochs
+    resumed = run(range(0, 4), state_path, args, batches)
+    same_weights = all(torch.equal(a, b) for a, b in zip(full.model.state_dict().values(), resumed.model.state_dict().values()))
+    print(f"resume: epochs run {len(resumed.losses)}, tokens {resumed.tokens} vs {full.tokens}, "
+          f"losses match {resumed.losses == full.losses}, weights match {same_weights}")
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--n_saves', type=int, default=5)
+    argp.add_argument('--epoch_s', type=float, default=1.0, help='Simulated training time between checkpoints')
+    argp.add_argument('--vocab_size', type=int, default=30522)
+    argp.add_argument('--hidden_size', type=int, default=4096)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--steps', type=int, default=20)
+    argp.add_argument('--batch_size', type=int, default=16)
+    argp.add_argument('--seq_length', type=int, default=64)
+    args = argp.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        rows = [stall(mode, args, folder) for mode in ['sync', 'async']]
+        print_table(rows, ['save', 'params_m', 'mb_on_disk', 'stall_ms', 'final_wait_ms'])
+        args.hidden_size = 32
+        check_resume(args, folder)
@@ -0,0 +1,84 @@
+"""
+Items per second of DefaultDataset: the old per-item pandas .loc lookups, the array-backed __getitem__,
+and the batched __getitems__, on a synthetic essay CSV. Run with a tokenizer, a token cache, or neither
+(inputs returned as-is) to see where the time goes.
+
+    python -m benchmarks.dataset_items --rows 20000 --tokenizer_name distilbert-base-uncased
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_loading.datasets import DefaultDataset, token_cache_item
+from benchmarks.utils import print_table
+
+class LegacyDataset(DefaultDataset):
+    # item access as it was before the columnar arrays
+    def __getitem__(self, index):
+        idx = self.indices[index]
+        if self.token_cache is not None:
+            features = token_cache_item(self.token_cache, index)
+        elif self.tokenizer:
+            features = self.tokenizer(self.inputs.loc[idx].item(), **self.tokenizer_params)
+        else:
+            features = self.inputs.loc[idx].values
+        return features, self.targets.loc[idx].values
+
+def write_csv(path: str, rows: int, num_targets: int) -> list:
+    rng = np.random.default_rng(0)
+    words = np.array("the student argues that school should start later because sleep matters".split())
+    data = {'text_id': np.arange(rows), 'full_text': [" ".join(rng.choice(words, rng.integers(50, 400))) for _ in range(rows)]}
+    target_cols = [f'score_{i}' for i in range(num_targets)]
+    for col in target_cols:
+        data[col] = rng.integers(1, 10, rows).astype(float)
+    pd.DataFrame(data).to_csv(path, index=False)
+    return target_cols
+
+def items_per_second(dataset, n_items: int, batch_size: int = None) -> float:
+    indices = np.random.default_rng(1).integers(0, len(dataset), n_items).tolist()
+    start = time.perf_counter()
+    if batch_size is None:
+        for index in indices:
+            dataset[index]
+    else:
+        for i in range(0, n_items, batch_size):
+            dataset.__getitems__(indices[i:i + batch_size])
+    return n_items / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--rows', type=int, default=20000)
+    argp.add_argument('--num_targets', type=int, default=6)
+    argp.add_argument('--n_items', type=int, default=5000)
+    argp.add_argument('--batch_size', type=int, default=32)
+    argp.add_argument('--tokenizer_name', type=str, default=None, help='Leave unset to time raw (pre-tokenized) inputs')
+    argp.add_argument('--token_cache', action='store_true', help='Serve tokens from the memory-mapped token cache')
+    args = argp.parse_args()
+
+    tokenizer = None
+    if args.tokenizer_name:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'essays.csv')
+        target_cols = write_csv(path, args.rows, args.num_targets)
+        cache_dir = os.path.join(tmp, 'cache') if args.token_cache and tokenizer else None
+        kwargs = dict(file_path=path, input_col='full_text', target_cols=target_cols, index_col='text_id',
+                      tokenizer=tokenizer, cache_dir=cache_dir)
+        legacy, dataset = LegacyDataset(**kwargs), DefaultDataset(**kwargs)
+        rows = [
+            {'access': 'pandas .loc (old)', 'items_per_s': items_per_second(legacy, args.n_items)},
+            {'access': '__getitem__', 'items_per_s': items_per_second(dataset, args.n_items)},
+            {'access': f'__getitems__ (batch {args.batch_size})',
+             'items_per_s': items_per_second(dataset, args.n_items, args.batch_size)},
+        ]
+        del legacy, dataset
+    for row in rows:
+        row['speedup'] = row['items_per_s'] / rows[0]['items_per_s']
+    print_table(rows, ['access', 'items_per_s', 'speedup'])
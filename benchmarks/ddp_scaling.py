@@ -0,0 +1,80 @@
+"""
+DistributedDataParallel scaling on CPU (gloo): one epoch of a fixed global dataset trained by 1..N processes,
+each with its DistributedSampler shard and an equal share of the cores, through Trainer. Reports samples/s
+of the slowest process and the speedup and efficiency over one process.
+
+    python -m benchmarks.ddp_scaling --processes 1 2 4 --n_samples 2048
+"""
+
+import argparse
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from modeling import trainer
+from modeling.distributed import init_distributed, cleanup_distributed
+from data_loading.dataloaders import make_data_loader
+from benchmarks.utils import print_table
+
+class MLPModel(torch.nn.Module):
+    # same call signature as the repo's models: (data, targets, ...) -> (output, loss)
+    def __init__(self, input_size: int, hidden_size: int, num_outputs: int):
+        super(MLPModel, self).__init__()
+        self.l1 = torch.nn.Sequential(torch.nn.Linear(input_size, hidden_size), torch.nn.ReLU(),
+                                      torch.nn.Linear(hidden_size, hidden_size), torch.nn.ReLU())
+        self.l2 = torch.nn.Linear(hidden_size, num_outputs)
+
+    def forward(self, data, targets=None, **kwargs):
+        output = self.l2(self.l1(data))
+        loss = None if targets is None else torch.nn.MSELoss()(output.float(), targets.float())
+        return output, loss
+
+def worker(rank: int, world_size: int, args: argparse.Namespace, results: dict) -> None:
+    os.environ.update({'RANK': str(rank), 'WORLD_SIZE': str(world_size), 'LOCAL_RANK': str(rank),
+                       'LOCAL_WORLD_SIZE': str(world_size), 'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(args.port + world_size)})
+    if world_size > 1:
+        init_distributed('gloo')
+    else:
+        torch.set_num_threads(os.cpu_count() or 1)
+    generator = torch.Generator().manual_seed(0)
+    dataset = torch.utils.data.TensorDataset(torch.randn(args.n_samples, args.input_size, generator=generator),
+                                             torch.rand(args.n_samples, args.num_outputs, generator=generator))
+    loader = make_data_loader(dataset, args.batch_size, shuffle=True, distributed=world_size > 1)
+    torch.manual_seed(0)
+    model = MLPModel(args.input_size, args.hidden_size, args.num_outputs)
+    t = trainer.Trainer(model=model, train_dataloader=loader, config=trainer.TrainerConfig(max_epochs=1, learning_rate=1e-4))
+    t.train('train', 0) # warmup
+    start = time.perf_counter()
+    t.train('train', 1)
+    elapsed = torch.tensor(time.perf_counter() - start)
+    if world_size > 1:
+        torch.distributed.all_reduce(elapsed, op=torch.distributed.ReduceOp.MAX)
+    if rank == 0:
+        results[world_size] = elapsed.item()
+    cleanup_distributed()
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    argp.add_argument('--n_samples', type=int, default=2048)
+    argp.add_argument('--batch_size', type=int, default=32, help='Per-process batch size')
+    argp.add_argument('--input_size', type=int, default=768)
+    argp.add_argument('--hidden_size', type=int, default=2048)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--port', type=int, default=29600)
+    args = argp.parse_args()
+
+    results = mp.Manager().dict()
+    for world_size in args.processes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+    first = args.processes[0]
+    first_rate = args.n_samples / results[first]
+    rows = []
+    for world_size in args.processes:
+        samples_per_s = args.n_samples / results[world_size]
+        rows.append({'processes': world_size, 'epoch_s': results[world_size], 'samples_per_s': samples_per_s,
+                     'speedup': samples_per_s / first_rate,
+                     'efficiency': samples_per_s / first_rate * first / world_size})
+    print_table(rows, ['processes', 'epoch_s', 'samples_per_s', 'speedup', 'efficiency'])
@@ -0,0 +1,58 @@
+"""
+Trainer.fit with and without early stopping on a tiny model that overfits a small random training set, so its
+val loss plateaus early: epochs actually run, wall time, why training stopped, and the cost of keeping the best
+weights (an in-memory snapshot per improvement, written once) against a save_params per improvement as
+run_tuning used to do.
+
+    python -m benchmarks.early_stopping --max_epochs 30 --patience 3
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from modeling import trainer
+from modeling.checkpoint import save_params, to_cpu
+from benchmarks.train_loop import TinyModel, make_batches
+from benchmarks.utils import get_device, synchronize, time_per_call, print_table
+
+def benchmark(patience: int, args: argparse.Namespace) -> dict:
+    torch.manual_seed(0)
+    model = TinyModel(args.vocab_size, args.hidden_size, args.num_outputs).to(get_device())
+    config = trainer.TrainerConfig(max_epochs=args.max_epochs, learning_rate=1e-2, patience=patience)
+    t = trainer.Trainer(model=model, train_dataloader=make_batches(args), val_dataloader=make_batches(args, seed=1), config=config)
+    synchronize()
+    start = time.perf_counter()
+    t.fit()
+    synchronize()
+    return {'patience': patience, 'epochs_run': len(t.losses), 'stop_reason': t.stop_reason, 'best_epoch': t.best_epoch,
+            'best_val_loss': t.best_loss, 'fit_s': time.perf_counter() - start}
+
+def snapshot_cost(args: argparse.Namespace) -> list:
+    torch.manual_seed(0)
+    model = TinyModel(args.vocab_size, args.snapshot_hidden_size, args.num_outputs).to(get_device())
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "best-model.params")
+        return [{'best_weights': 'save_params per improvement', 'ms': 1000 * time_per_call(lambda: save_params(model, path), n_iters=5)},
+                {'best_weights': 'CPU snapshot per improvement', 'ms': 1000 * time_per_call(lambda: to_cpu(model.state_dict()), n_iters=5)}]
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--max_epochs', type=int, default=30)
+    argp.add_argument('--patience', type=int, default=3)
+    argp.add_argument('--steps', type=int, default=8)
+    argp.add_argument('--batch_size', type=int, default=16)
+    argp.add_argument('--seq_length', type=int, default=64)
+    argp.add_argument('--vocab_size', type=int, default=1000)
+    argp.add_argument('--hidden_size', type=int, default=64)
+    argp.add_argument('--snapshot_hidden_size', type=int, default=4096, help='Model size for the snapshot/save comparison')
+    argp.add_argument('--num_outputs', type=int, default=6)
+    args = argp.parse_args()
+
+    rows = [benchmark(patience, args) for patience in [None, args.patience]]
+    print_table(rows, ['patience', 'epochs_run', 'stop_reason', 'best_epoch', 'best_val_loss', 'fit_s'])
+    print()
+    print_table(snapshot_cost(args), ['best_weights', 'ms'])
@@ -0,0 +1,74 @@
+"""
+Gradient accumulation in Trainer: one epoch of a fixed effective batch size split into micro-batches of
+different sizes, reporting peak memory and samples/s, and how far the accumulated gradients of the first
+effective batch are from those of the full batch (dropout off, so they should agree up to float error).
+
+    python -m benchmarks.grad_accumulation --effective_batch_size 32 --micro_batch_sizes 32 16 8 4
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import BatchEncoding
+
+from modeling.model import BaseModel
+from modeling import trainer
+from benchmarks.utils import synchronize, reset_peak_memory, peak_memory_mb, run_isolated, print_table
+
+def make_batches(args: argparse.Namespace, micro_batch_size: int) -> list:
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(1000, 2000, (args.n_samples, 1, args.seq_length), generator=generator)
+    targets = torch.rand(args.n_samples, args.num_outputs, generator=generator)
+    return [(BatchEncoding({'input_ids': input_ids[i:i + micro_batch_size],
+                            'attention_mask': torch.ones_like(input_ids[i:i + micro_batch_size])}),
+             targets[i:i + micro_batch_size]) for i in range(0, args.n_samples, micro_batch_size)]
+
+def first_step_gradients(model: torch.nn.Module, batches: list, steps: int) -> torch.Tensor:
+    # the gradient Trainer would clip and step with for the first effective batch
+    model.eval()
+    model.zero_grad()
+    for x, y in batches[:steps]:
+        (model(x, y)[1] / steps).backward()
+    return torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+
+def benchmark(micro_batch_size: int, args: argparse.Namespace) -> dict:
+    steps = args.effective_batch_size // micro_batch_size
+    torch.manual_seed(0)
+    model = BaseModel(seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name)
+    batches = make_batches(args, micro_batch_size)
+    gradients = first_step_gradients(model, batches, steps)
+
+    config = trainer.TrainerConfig(max_epochs=1, learning_rate=1e-5, grad_accumulation_steps=steps)
+    t = trainer.Trainer(model=model, train_dataloader=batches, config=config)
+    t.tokens = 0
+    reset_peak_memory()
+    synchronize()
+    start = time.perf_counter()
+    t.train('train', 0)
+    synchronize()
+    elapsed = time.perf_counter() - start
+    return {
+        'micro_batch': micro_batch_size,
+        'accumulation_steps': steps,
+        'samples_per_s': args.n_samples / elapsed,
+        'peak_mem_mb': peak_memory_mb(),
+        'gradients': gradients,
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--effective_batch_size', type=int, default=32)
+    argp.add_argument('--micro_batch_sizes', type=int, nargs='+', default=[32, 16, 8, 4])
+    argp.add_argument('--n_samples', type=int, default=128)
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    args = argp.parse_args()
+
+    rows = [run_isolated(benchmark, micro_batch_size, args) for micro_batch_size in args.micro_batch_sizes]
+    reference = rows[0].pop('gradients')
+    rows[0]['max_grad_diff'] = 0.0
+    for row in rows[1:]:
+        row['max_grad_diff'] = (row.pop('gradients') - reference).abs().max().item()
+    print_table(rows, ['micro_batch', 'accumulation_steps', 'samples_per_s', 'peak_mem_mb', 'max_grad_diff'])
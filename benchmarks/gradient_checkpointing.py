@@ -0,0 +1,80 @@
+"""
+Training-step peak memory and samples per second with and without gradient checkpointing on the encoder
+(TrainerConfig.gradient_checkpointing), for PooledModel on DistilBERT at seq_length 512 and SpeechModel on
+100000-sample clips. The batch size doubles until a step's peak memory exceeds --memory_budget_mb, which
+gives the largest batch that fits each way. Each configuration runs in a fresh process, so on CPU the peak
+RSS is comparable between them.
+
+    python -m benchmarks.gradient_checkpointing --memory_budget_mb 16000 --max_batch_size 64
+"""
+
+import argparse
+
+import torch
+
+from modeling.model import PooledModel, SpeechModel, enable_gradient_checkpointing
+from benchmarks.utils import get_device, reset_peak_memory, peak_memory_mb, time_per_call, run_isolated, print_table
+
+def make_model_and_batch(name: str, batch_size: int, args: argparse.Namespace, device) -> tuple:
+    if name == 'speech':
+        model = SpeechModel(num_outputs=4, pretrain_model_name=args.speech_model_name, phoneme_seq_length=30,
+                            word_seq_length=10, word_outputs=3, pooling="mean")
+        data = torch.randn(batch_size, 100000, device=device)
+        return model.to(device), data, [torch.rand(batch_size, 4, device=device)]
+    model = PooledModel(seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name)
+    data = {
+        'input_ids': torch.randint(1000, 2000, (batch_size, 1, args.seq_length), device=device),
+        'attention_mask': torch.ones(batch_size, 1, args.seq_length, dtype=torch.long, device=device),
+    }
+    return model.to(device), data, torch.rand(batch_size, args.num_outputs, device=device)
+
+def benchmark(name: str, checkpointing: bool, batch_size: int, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model, data, targets = make_model_and_batch(name, batch_size, args, device)
+    if checkpointing:
+        enable_gradient_checkpointing(model)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+    def step():
+        model.zero_grad()
+        _, loss = model(data, targets, one_output=True)
+        loss.backward()
+        optimizer.step()
+
+    reset_peak_memory()
+    latency = time_per_call(step, n_iters=args.n_iters, warmup=1)
+    return {'model': name, 'checkpointing': checkpointing, 'batch_size': batch_size,
+            'samples_per_s': batch_size / latency, 'peak_mem_mb': peak_memory_mb()}
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--speech_model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--models', type=str, nargs='+', default=['pooled', 'speech'])
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--memory_budget_mb', type=float, default=16000)
+    argp.add_argument('--max_batch_size', type=int, default=64)
+    argp.add_argument('--n_iters', type=int, default=3)
+    args = argp.parse_args()
+
+    rows, largest = [], []
+    for name in args.models:
+        for checkpointing in [False, True]:
+            fits = None
+            batch_size = 1
+            while batch_size <= args.max_batch_size:
+                row = run_isolated(benchmark, name, checkpointing, batch_size, args)
+                rows.append(row)
+                if row['peak_mem_mb'] > args.memory_budget_mb:
+                    break
+                fits = row
+                batch_size *= 2
+            largest.append({'model': name, 'checkpointing': checkpointing,
+                            'largest_batch_size': fits['batch_size'] if fits else None,
+                            'samples_per_s': fits['samples_per_s'] if fits else None})
+    print_table(rows, ['model', 'checkpointing', 'batch_size', 'samples_per_s', 'peak_mem_mb'])
+    print(f"\nlargest batch within {args.memory_budget_mb:.0f} MB:")
+    print_table(largest, ['model', 'checkpointing', 'largest_batch_size', 'samples_per_s'])
@@ -0,0 +1,69 @@
+"""
+Compare the flattening seq_length*768 regression heads against the pooled heads: parameter count,
+peak memory and per-batch latency of a forward pass (optionally with backward).
+
+    python -m benchmarks.heads --batch_size 16 --seq_length 512
+"""
+
+import argparse
+
+import torch
+
+from modeling.model import BaseModel, BaseDevModel, ETSModel, MultitaskModel, PooledModel
+from benchmarks.utils import (get_device, reset_peak_memory, peak_memory_mb, time_per_call, run_isolated,
+                              count_parameters, print_table)
+
+HEADS = {
+    'base': lambda **kw: BaseModel(**kw),
+    'base-dev': lambda **kw: BaseDevModel(**kw),
+    'ets': lambda **kw: ETSModel(**kw),
+    'multitask': lambda **kw: MultitaskModel(**kw),
+    'pooled-mean': lambda **kw: PooledModel(pooling='mean', **kw),
+    'pooled-cls': lambda **kw: PooledModel(pooling='cls', **kw),
+    'pooled-attention': lambda **kw: PooledModel(pooling='attention', **kw),
+}
+
+def benchmark_head(name: str, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model = HEADS[name](seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name)
+    model = model.to(device)
+    model.train(args.backward)
+    data = {
+        'input_ids': torch.randint(1000, 2000, (args.batch_size, 1, args.seq_length), device=device),
+        'attention_mask': torch.ones(args.batch_size, 1, args.seq_length, dtype=torch.long, device=device),
+    }
+    targets = torch.rand(args.batch_size, args.num_outputs, device=device)
+
+    def step():
+        with torch.set_grad_enabled(args.backward):
+            _, loss = model(data, targets)
+            if args.backward:
+                model.zero_grad()
+                loss.backward()
+
+    reset_peak_memory()
+    latency = time_per_call(step, n_iters=args.n_iters, warmup=args.warmup)
+    total = count_parameters(model)
+    return {
+        'head': name,
+        'params_total': total,
+        'params_head': total - count_parameters(model.l1),
+        'peak_mem_mb': peak_memory_mb(),
+        'latency_ms': latency * 1000,
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--heads', type=str, nargs='+', default=list(HEADS))
+    argp.add_argument('--batch_size', type=int, default=16)
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--n_iters', type=int, default=5)
+    argp.add_argument('--warmup', type=int, default=1)
+    argp.add_argument('--backward', action='store_true', help='Time forward+backward instead of forward only')
+    args = argp.parse_args()
+
+    rows = [run_isolated(benchmark_head, name, args) for name in args.heads]
+    print_table(rows, ['head', 'params_total', 'params_head', 'peak_mem_mb', 'latency_ms'])
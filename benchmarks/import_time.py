@@ -0,0 +1,57 @@
+"""
+Cold-start import latency of the entry points, measured with `python -X importtime <script> --help`.
+Fails if a module that text-only runs should never load (the speech/TTS stack) shows up, or if a
+script takes longer than --max_ms to import.
+
+    python -m benchmarks.import_time --max_ms 8000
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+SCRIPTS = ['run.py', 'run_tuning.py']
+FORBIDDEN = ['espnet2', 'datasets', 'scipy.io.wavfile']
+
+def import_times(script: str) -> List[Tuple[str, int, int]]:
+    # (module, self us, cumulative us) for every import done while loading `script`
+    result = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'],
+                            capture_output=True, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        times.append((module.rstrip(), int(self_us), int(cumulative_us)))
+    return times
+
+def summarize(times: List[Tuple[str, int, int]]) -> Dict:
+    # top-level imports are the unindented ones; their cumulative times add up to the total
+    top_level = [(m.strip(), c) for m, _, c in times if not m.startswith('  ')]
+    loaded = {m.strip() for m, _, _ in times}
+    return {
+        'total_ms': sum(c for _, c in top_level) / 1000,
+        'heaviest': sorted(top_level, key=lambda t: -t[1])[:5],
+        'forbidden': sorted(m for m in loaded if any(m == f or m.startswith(f + '.') for f in FORBIDDEN)),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--scripts', type=str, nargs='+', default=SCRIPTS)
+    argp.add_argument('--max_ms', type=float, default=None, help='Fail if a script takes longer than this to import')
+    args = argp.parse_args()
+
+    failures = []
+    for script in args.scripts:
+        summary = summarize(import_times(script))
+        print(f"{script}: {summary['total_ms']:.0f} ms")
+        for module, cumulative in summary['heaviest']:
+            print(f"    {module:<40} {cumulative / 1000:8.0f} ms")
+        if summary['forbidden']:
+            failures.append(f"{script} imports {', '.join(summary['forbidden'])}")
+        if args.max_ms is not None and summary['total_ms'] > args.max_ms:
+            failures.append(f"{script} takes {summary['total_ms']:.0f} ms to import (limit {args.max_ms:.0f} ms)")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,82 @@
+"""
+Full fine-tuning against LoRA adapters on the encoder (modeling/adapters.py) for PooledModel on DistilBERT or
+SpeechModel on wav2vec2: trainable parameters, AdamW state, checkpoint size on disk, training step time, and
+the time to switch to another tuned model at scoring time (a full checkpoint rebuilt and restored, against
+load_adapters on an already built model).
+
+    python -m benchmarks.lora --models pooled speech --r 8
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from modeling.adapters import apply_lora, load_adapters, trainable_state_dict
+from modeling.checkpoint import load_checkpoint, save_params
+from modeling.model import build_model, restore_params
+from benchmarks.gradient_checkpointing import make_model_and_batch
+from benchmarks.utils import get_device, count_parameters, time_per_call, run_isolated, print_table
+
+def optimizer_state_mb(optimizer: torch.optim.Optimizer) -> float:
+    return sum(v.numel() * v.element_size() for state in optimizer.state.values() for v in state.values()
+               if isinstance(v, torch.Tensor)) / 2**20
+
+def benchmark(name: str, lora: bool, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model, data, targets = make_model_and_batch(name, args.batch_size, args, device)
+    if lora:
+        apply_lora(model, r=args.r, alpha=2 * args.r)
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+
+    def step():
+        model.zero_grad()
+        _, loss = model(data, targets, one_output=True)
+        loss.backward()
+        optimizer.step()
+
+    step_s = time_per_call(step, n_iters=args.n_iters, warmup=1)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "model.params")
+        save_params(model, path)
+        size_mb = os.path.getsize(path) / 2**20
+        state_dict, architecture = load_checkpoint(path)
+
+        def switch_full():
+            restore_params(build_model(architecture, load_pretrained=lora).to(device), state_dict)
+
+        def switch_adapters():
+            load_adapters(model, state_dict)
+
+        switch_s = time_per_call(switch_adapters if lora else switch_full, n_iters=3, warmup=1)
+    return {
+        'model': name,
+        'training': f"LoRA r={args.r}" if lora else 'full',
+        'trainable_m': sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6,
+        'total_m': count_parameters(model) / 1e6,
+        'adam_state_mb': optimizer_state_mb(optimizer),
+        'checkpoint_mb': size_mb,
+        'checkpoint_tensors': len(trainable_state_dict(model)),
+        'step_s': step_s,
+        'switch_model_s': switch_s,
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--speech_model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--models', type=str, nargs='+', default=['pooled', 'speech'])
+    argp.add_argument('--r', type=int, default=8)
+    argp.add_argument('--batch_size', type=int, default=4)
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--n_iters', type=int, default=3)
+    args = argp.parse_args()
+
+    rows = [run_isolated(benchmark, name, lora, args) for name in args.models for lora in [False, True]]
+    print_table(rows, ['model', 'training', 'trainable_m', 'total_m', 'adam_state_mb', 'checkpoint_mb',
+                       'checkpoint_tensors', 'step_s', 'switch_model_s'])
@@ -0,0 +1,64 @@
+"""
+Start-up cost of building a scorer and restoring a full checkpoint into it, with the encoder either
+loaded from its pretrained weights first (the old path) or built from its config alone, and the
+checkpoint either unpickled with torch.load or memory-mapped from .safetensors. Each variant runs in a
+fresh process so the peak RSS is its own.
+
+    python -m benchmarks.model_construction --model_type base
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from modeling.model import BaseModel, PooledModel, restore_params
+from modeling.checkpoint import load_params, save_params
+from benchmarks.utils import run_isolated, peak_memory_mb, print_table
+
+def build(model_type: str, args: argparse.Namespace, load_pretrained: bool) -> torch.nn.Module:
+    if model_type == 'base':
+        return BaseModel(seq_length=args.seq_length, num_outputs=args.num_outputs,
+                         pretrain_model_name=args.model_name, load_pretrained=load_pretrained)
+    return PooledModel(seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name,
+                       pooling=model_type.split('-', 1)[1], load_pretrained=load_pretrained)
+
+def write_checkpoints(paths: list, args: argparse.Namespace) -> dict:
+    model = build(args.model_type, args, load_pretrained=True)
+    for path in paths:
+        save_params(model, path, args.model_name)
+    return {}
+
+def restore(path: str, args: argparse.Namespace, load_pretrained: bool) -> dict:
+    start = time.perf_counter()
+    model = build(args.model_type, args, load_pretrained)
+    built = time.perf_counter()
+    state_dict = load_params(path)
+    loaded = time.perf_counter()
+    restore_params(model, state_dict, load_pretrained=load_pretrained)
+    done = time.perf_counter()
+    return {
+        'format': os.path.splitext(path)[1],
+        'encoder': 'pretrained' if load_pretrained else 'config only',
+        'build_s': built - start,
+        'load_s': loaded - built,
+        'restore_s': done - loaded,
+        'total_s': done - start,
+        'peak_rss_mb': peak_memory_mb(),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--model_type', type=str, default='base', help='base or pooled-mean/pooled-cls/pooled-attention')
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    args = argp.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, 'model.params'), os.path.join(tmp, 'model.safetensors')]
+        run_isolated(write_checkpoints, paths, args)
+        rows = [run_isolated(restore, path, args, load_pretrained) for path in paths for load_pretrained in [True, False]]
+    print_table(rows, ['format', 'encoder', 'build_s', 'load_s', 'restore_s', 'total_s', 'peak_rss_mb'])
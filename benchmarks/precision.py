@@ -0,0 +1,76 @@
+"""
+Samples per second and peak memory of BaseModel, HierarchicalModel and SpeechModel under each autocast
+precision (modeling.precision), for scoring or, with --backward, for a full training step with loss scaling.
+
+    python -m benchmarks.precision --precisions fp32 bf16 --batch_size 8
+"""
+
+import argparse
+
+import torch
+
+from modeling.model import BaseModel, HierarchicalModel, SpeechModel
+from modeling.precision import autocast, check_precision, grad_scaler
+from benchmarks.utils import get_device, reset_peak_memory, peak_memory_mb, time_per_call, run_isolated, print_table
+
+def make_model_and_batch(name: str, args: argparse.Namespace, device) -> tuple:
+    if name == 'speech':
+        model = SpeechModel(num_outputs=4, pretrain_model_name=args.speech_model_name, phoneme_seq_length=30,
+                            word_seq_length=10, word_outputs=3)
+        data = torch.randn(args.batch_size, 100000, device=device)
+        targets = [torch.rand(args.batch_size, 4, device=device), torch.rand(args.batch_size, 3, 10, device=device),
+                   torch.rand(args.batch_size, 1, 30, device=device)]
+        return model.to(device), data, targets
+    model_class = BaseModel if name == 'base' else HierarchicalModel
+    model = model_class(seq_length=args.seq_length, num_outputs=args.num_outputs, pretrain_model_name=args.model_name)
+    data = {
+        'input_ids': torch.randint(1000, 2000, (args.batch_size, 1, args.seq_length), device=device),
+        'attention_mask': torch.ones(args.batch_size, 1, args.seq_length, dtype=torch.long, device=device),
+    }
+    return model.to(device), data, torch.rand(args.batch_size, args.num_outputs, device=device)
+
+def benchmark(name: str, precision: str, args: argparse.Namespace) -> dict:
+    device = get_device()
+    check_precision(precision, device)
+    torch.manual_seed(0)
+    model, data, targets = make_model_and_batch(name, args, device)
+    model.train(args.backward)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    scaler = grad_scaler(precision)
+
+    def step():
+        with torch.set_grad_enabled(args.backward), autocast(precision, device):
+            _, loss = model(data, targets, val=not args.backward)
+        if args.backward:
+            model.zero_grad()
+            scaler.scale(loss.float()).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+    reset_peak_memory()
+    latency = time_per_call(step, n_iters=args.n_iters, warmup=args.warmup)
+    return {
+        'model': name,
+        'precision': precision,
+        'samples_per_s': args.batch_size / latency,
+        'peak_mem_mb': peak_memory_mb(),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="distilbert-base-uncased")
+    argp.add_argument('--speech_model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--models', type=str, nargs='+', default=['base', 'hierarchical', 'speech'])
+    argp.add_argument('--precisions', type=str, nargs='+', default=None, help='Defaults to fp32 bf16 (CPU) or fp32 bf16 fp16 (CUDA)')
+    argp.add_argument('--batch_size', type=int, default=8)
+    argp.add_argument('--seq_length', type=int, default=512)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    argp.add_argument('--n_iters', type=int, default=5)
+    argp.add_argument('--warmup', type=int, default=1)
+    argp.add_argument('--backward', action='store_true', help='Time a training step (forward, scaled backward, optimizer step)')
+    args = argp.parse_args()
+    if args.precisions is None:
+        args.precisions = ['fp32', 'bf16', 'fp16'] if torch.cuda.is_available() else ['fp32', 'bf16']
+
+    rows = [run_isolated(benchmark, name, precision, args) for name in args.models for precision in args.precisions]
+    print_table(rows, ['model', 'precision', 'samples_per_s', 'peak_mem_mb'])
@@ -0,0 +1,47 @@
+"""
+Cost of TrainerConfig.profile (a device sync at every phase boundary) on Trainer.train steps/s, and the phase
+breakdown it reports, with the tiny model from benchmarks.train_loop.
+
+    python -m benchmarks.profiling --steps 500
+"""
+
+import argparse
+import time
+
+import torch
+
+from modeling import trainer
+from modeling.profiling import PHASES
+from benchmarks.train_loop import TinyModel, make_batches
+from benchmarks.utils import get_device, synchronize, print_table
+
+def benchmark(profile: bool, args: argparse.Namespace) -> dict:
+    torch.manual_seed(0)
+    model = TinyModel(args.vocab_size, args.hidden_size, args.num_outputs).to(get_device())
+    config = trainer.TrainerConfig(max_epochs=1, learning_rate=1e-3, profile=profile)
+    t = trainer.Trainer(model=model, train_dataloader=make_batches(args), config=config)
+    t.train('train', 0) # warmup
+    synchronize()
+    start = time.perf_counter()
+    t.train('train', 0)
+    synchronize()
+    row = {'profile': profile, 'steps_per_s': args.steps / (time.perf_counter() - start)}
+    if profile:
+        summary = t.profile_records[-1]
+        row.update({f"{phase}_%": 100 * summary[f"{phase}_s"] / summary['total_s'] for phase in PHASES})
+        row.update({'samples_per_s': summary['samples_per_s'], 'tokens_per_s': summary['tokens_per_s'],
+                    'peak_memory_mb': summary['peak_memory_mb']})
+    return row
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--steps', type=int, default=500)
+    argp.add_argument('--batch_size', type=int, default=16)
+    argp.add_argument('--seq_length', type=int, default=64)
+    argp.add_argument('--vocab_size', type=int, default=1000)
+    argp.add_argument('--hidden_size', type=int, default=32)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    args = argp.parse_args()
+
+    rows = [benchmark(profile, args) for profile in [False, True]]
+    print_table(rows, ['profile', 'steps_per_s', *[f"{phase}_%" for phase in PHASES], 'samples_per_s', 'tokens_per_s', 'peak_memory_mb'])
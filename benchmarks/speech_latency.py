@@ -0,0 +1,72 @@
+"""
+Speech forward latency per second of real audio: the flattened 312-frame SpeechModel head, where every
+clip is padded to 100000 samples, against the mean-pooled head on batches padded only to their longest
+clip (length-bucketed, as BucketBatchSampler does in training).
+
+    python -m benchmarks.speech_latency --n_clips 64 --batch_size 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from modeling.model import SpeechModel
+from data_loading.dataloaders import pad_audio
+from benchmarks.utils import get_device, synchronize, reset_peak_memory, peak_memory_mb, run_isolated, print_table
+
+SAMPLING_RATE = 16000
+MAX_LENGTH = 100000
+
+def make_clips(args: argparse.Namespace) -> list:
+    # SpeechOcean utterances are mostly a few seconds long, well under the 6.25 s the fixed padding assumes
+    rng = np.random.default_rng(0)
+    durations = rng.uniform(args.min_seconds, args.max_seconds, args.n_clips)
+    return [rng.standard_normal(min(int(d * SAMPLING_RATE), MAX_LENGTH)).astype(np.float32) for d in durations]
+
+def make_batches(clips: list, batch_size: int, pooling: str) -> list:
+    if pooling is None:
+        padded = np.stack([np.pad(clip, (0, MAX_LENGTH - len(clip))) for clip in clips])
+        return [torch.from_numpy(padded[i:i + batch_size]) for i in range(0, len(clips), batch_size)]
+    order = np.argsort([len(clip) for clip in clips])
+    return [pad_audio([clips[j] for j in order[i:i + batch_size]]) for i in range(0, len(clips), batch_size)]
+
+def benchmark(pooling: str, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model = SpeechModel(num_outputs=4, pretrain_model_name=args.model_name, phoneme_seq_length=30, word_seq_length=10,
+                        word_outputs=3, pooling=pooling).to(device)
+    model.eval()
+    clips = make_clips(args)
+    batches = [batch.to(device) for batch in make_batches(clips, args.batch_size, pooling)]
+    audio_seconds = sum(len(clip) for clip in clips) / SAMPLING_RATE
+
+    with torch.inference_mode():
+        model(batches[0], one_output=True)
+        reset_peak_memory()
+        synchronize()
+        start = time.perf_counter()
+        for batch in batches:
+            model(batch, one_output=True)
+        synchronize()
+    elapsed = time.perf_counter() - start
+    return {
+        'head': 'flatten (fixed 100000)' if pooling is None else f'{pooling} (dynamic padding)',
+        'audio_s': audio_seconds,
+        'forward_s': elapsed,
+        'ms_per_audio_s': 1000 * elapsed / audio_seconds,
+        'peak_mem_mb': peak_memory_mb(),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--n_clips', type=int, default=64)
+    argp.add_argument('--batch_size', type=int, default=8)
+    argp.add_argument('--min_seconds', type=float, default=1.0)
+    argp.add_argument('--max_seconds', type=float, default=6.0)
+    args = argp.parse_args()
+
+    rows = [run_isolated(benchmark, pooling, args) for pooling in [None, "mean"]]
+    print_table(rows, ['head', 'audio_s', 'forward_s', 'ms_per_audio_s', 'peak_mem_mb'])
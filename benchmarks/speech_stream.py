@@ -0,0 +1,61 @@
+"""
+Streaming speech scoring: wall time and peak memory of stream_score over synthetic recordings of increasing
+length, fed in 10 s chunks. Memory should stay flat as the recording grows, since only one batch of windows
+is encoded at a time.
+
+    python -m benchmarks.speech_stream --minutes 0.5 2 5 --pooling mean
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import AutoFeatureExtractor
+
+from modeling.model import SpeechModel
+from modeling.inference import stream_score
+from benchmarks.utils import get_device, synchronize, reset_peak_memory, peak_memory_mb, run_isolated, print_table
+
+def synthetic_chunks(seconds: float, sampling_rate: int, chunk_s: float = 10.0):
+    rng = np.random.default_rng(0)
+    remaining = int(seconds * sampling_rate)
+    while remaining > 0:
+        n = min(int(chunk_s * sampling_rate), remaining)
+        remaining -= n
+        yield rng.normal(0, 0.1, n).astype(np.float32)
+
+def benchmark(minutes: float, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    feature_extractor = AutoFeatureExtractor.from_pretrained(args.model_name)
+    model = SpeechModel(num_outputs=4, pretrain_model_name=args.model_name, phoneme_seq_length=30, word_seq_length=10,
+                        word_outputs=3, pooling=args.pooling).to(device)
+    reset_peak_memory()
+    synchronize()
+    start = time.perf_counter()
+    scores = stream_score(model, synthetic_chunks(60 * minutes, feature_extractor.sampling_rate), feature_extractor,
+                          window_s=args.window_s, overlap_s=args.overlap_s, batch_size=args.batch_size, device=device)
+    synchronize()
+    elapsed = time.perf_counter() - start
+    return {
+        'audio_min': minutes,
+        'windows': len(scores['windows']),
+        'score_s': elapsed,
+        'ms_per_audio_s': 1000 * elapsed / (60 * minutes),
+        'peak_mem_mb': peak_memory_mb(),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--minutes', type=float, nargs='+', default=[0.5, 2, 5])
+    argp.add_argument('--pooling', type=str, default="mean", help='"mean", or "none" for the flattened head')
+    argp.add_argument('--window_s', type=float, default=6.0)
+    argp.add_argument('--overlap_s', type=float, default=1.0)
+    argp.add_argument('--batch_size', type=int, default=8)
+    args = argp.parse_args()
+    args.pooling = None if args.pooling == "none" else args.pooling
+
+    rows = [run_isolated(benchmark, minutes, args) for minutes in args.minutes]
+    print_table(rows, ['audio_min', 'windows', 'score_s', 'ms_per_audio_s', 'peak_mem_mb'])
@@ -0,0 +1,91 @@
+"""
+Word/phone target construction in SpeechDataset: build time (extraction + normalization) and per-item
+cost of the old nested-list/DataFrame.apply version against the dense padded arrays, on synthetic
+SpeechOcean-shaped annotations (no audio is loaded).
+
+    python -m benchmarks.speech_targets --utterances 5000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.nn.functional import pad
+
+from data_loading.speech_datasets import SpeechDataset
+from benchmarks.utils import print_table
+
+SENTENCE_COLS = ['accuracy', 'fluency', 'prosodic', 'total']
+WORD_COLS = ['accuracy', 'stress', 'total']
+PHONE_COLS = ['phones-accuracy']
+
+class LegacyTargets:
+    # target handling as it was before the dense arrays
+    def __init__(self, data, word_seq_length: int = 10, phoneme_seq_length: int = 30):
+        self.data = data
+        self.word_seq_length = word_seq_length
+        self.phoneme_seq_length = phoneme_seq_length
+        self.targets_sentence = pd.DataFrame([[data[t][i] for t in SENTENCE_COLS] for i in range(len(data['words']))], columns=SENTENCE_COLS)
+        targets_words, targets_phones = [], []
+        for person_words in data['words']:
+            targets_words.append([[word_dict[w] for word_dict in person_words] for w in WORD_COLS])
+            targets_phones.append([[score for word_dict in person_words for score in word_dict[p]] for p in PHONE_COLS])
+        self.targets_words = pd.DataFrame(targets_words, columns=WORD_COLS)
+        self.targets_phones = pd.DataFrame(targets_phones, columns=PHONE_COLS)
+        self.targets_sentence = self.targets_sentence / self.targets_sentence.max(axis=0) * 100
+        for name in ('targets_words', 'targets_phones'):
+            targets = getattr(self, name)
+            for label in range(len(targets.iloc[0])):
+                def normalize_score(row, max_score: float):
+                    row[label] = [score/max_score*100 for score in row[label]]
+                    return row
+                max_score = targets.apply(lambda x: max(x[label]), axis=1).max()
+                targets = targets.apply(normalize_score, max_score=max_score, axis=1)
+            setattr(self, name, targets)
+
+    def get_targets(self, index):
+        words_output = torch.Tensor(np.array(self.targets_words.loc[index].values.tolist()))
+        words_output = pad(words_output, (0, self.word_seq_length-words_output.shape[1], 0, 0), value=-1)
+        phones_output = torch.Tensor(np.array(self.targets_phones.loc[index].values.tolist()))
+        phones_output = pad(phones_output, (0, self.phoneme_seq_length-phones_output.shape[1], 0, 0), value=-1)
+        return self.targets_sentence.loc[index].values, words_output, phones_output
+
+def make_data(n: int) -> dict:
+    rng = np.random.default_rng(0)
+    words = []
+    for _ in range(n):
+        words.append([{'accuracy': int(rng.integers(0, 11)), 'stress': int(rng.integers(5, 11)), 'total': int(rng.integers(0, 11)),
+                       'phones-accuracy': rng.uniform(0, 2, rng.integers(1, 6)).round(1).tolist()}
+                      for _ in range(rng.integers(1, 16))])
+    data = {'words': words}
+    for col in SENTENCE_COLS:
+        data[col] = rng.integers(1, 11, n).tolist()
+    return data
+
+def build_arrays(data: dict) -> SpeechDataset:
+    dataset = SpeechDataset.__new__(SpeechDataset)
+    dataset.data, dataset.word_seq_length, dataset.phoneme_seq_length = data, 10, 30
+    dataset.build_targets(SENTENCE_COLS, WORD_COLS, PHONE_COLS)
+    return dataset
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--utterances', type=int, default=5000)
+    argp.add_argument('--n_items', type=int, default=5000)
+    args = argp.parse_args()
+
+    data = make_data(args.utterances)
+    indices = np.random.default_rng(1).integers(0, args.utterances, args.n_items).tolist()
+    rows = []
+    for name, build in [('nested lists + apply (old)', LegacyTargets), ('dense arrays', build_arrays)]:
+        targets, build_s = timed(build, data)
+        _, items_s = timed(lambda: [targets.get_targets(i) for i in indices])
+        rows.append({'targets': name, 'build_s': build_s, 'us_per_item': 1e6 * items_s / args.n_items})
+    print_table(rows, ['targets', 'build_s', 'us_per_item'])
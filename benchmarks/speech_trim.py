@@ -0,0 +1,78 @@
+"""
+Silence trimming before the speech encoder: cost of the energy VAD per clip, encoder frames per clip, and
+mean-pooled SpeechModel forward time with and without trimming, on synthetic clips of speech-level noise
+surrounded by leading and trailing near-silence (as in SpeechOcean recordings).
+
+    python -m benchmarks.speech_trim --n_clips 64 --batch_size 8
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from modeling.model import SpeechModel
+from data_loading.dataloaders import pad_audio
+from data_loading.speech_datasets import DEFAULT_VAD_PARAMS, silence_bounds
+from benchmarks.utils import get_device, synchronize, run_isolated, print_table
+
+SAMPLING_RATE = 16000
+MAX_LENGTH = 100000
+
+def make_clips(args: argparse.Namespace) -> list:
+    rng = np.random.default_rng(0)
+    clips = []
+    for _ in range(args.n_clips):
+        lead, speech, tail = rng.uniform(0.2, args.max_silence), rng.uniform(1.0, 4.0), rng.uniform(0.2, args.max_silence)
+        parts = [rng.normal(0, 1e-3, int(lead * SAMPLING_RATE)), rng.normal(0, 0.2, int(speech * SAMPLING_RATE)),
+                 rng.normal(0, 1e-3, int(tail * SAMPLING_RATE))]
+        clips.append(np.concatenate(parts)[:MAX_LENGTH].astype(np.float32))
+    return clips
+
+def trim(clips: list, args: argparse.Namespace) -> list:
+    params = {**DEFAULT_VAD_PARAMS, 'threshold_db': args.threshold_db}
+    return [clip[slice(*silence_bounds(clip, SAMPLING_RATE, **params))] for clip in clips]
+
+def benchmark(trimmed: bool, args: argparse.Namespace) -> dict:
+    device = get_device()
+    torch.manual_seed(0)
+    model = SpeechModel(num_outputs=4, pretrain_model_name=args.model_name, phoneme_seq_length=30, word_seq_length=10,
+                        word_outputs=3, pooling="mean").to(device)
+    model.eval()
+    clips = make_clips(args)
+    start = time.perf_counter()
+    if trimmed:
+        clips = trim(clips, args)
+    vad_s = time.perf_counter() - start
+    frames = model.l1._get_feat_extract_output_lengths(torch.tensor([len(clip) for clip in clips]))
+    order = np.argsort([len(clip) for clip in clips])
+    batches = [pad_audio([clips[j] for j in order[i:i + args.batch_size]]).to(device) for i in range(0, len(clips), args.batch_size)]
+
+    with torch.inference_mode():
+        model(batches[0], one_output=True)
+        synchronize()
+        start = time.perf_counter()
+        for batch in batches:
+            model(batch, one_output=True)
+        synchronize()
+    elapsed = time.perf_counter() - start
+    return {
+        'clips': 'trimmed (VAD)' if trimmed else 'as recorded',
+        'vad_ms_per_clip': 1000 * vad_s / len(clips),
+        'frames_per_clip': frames.float().mean().item(),
+        'forward_s': elapsed,
+        'ms_per_clip': 1000 * elapsed / len(clips),
+    }
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model_name', type=str, default="facebook/wav2vec2-base")
+    argp.add_argument('--n_clips', type=int, default=64)
+    argp.add_argument('--batch_size', type=int, default=8)
+    argp.add_argument('--max_silence', type=float, default=1.5, help='Longest leading/trailing silence, in seconds')
+    argp.add_argument('--threshold_db', type=float, default=-40.0)
+    args = argp.parse_args()
+
+    rows = [run_isolated(benchmark, trimmed, args) for trimmed in [False, True]]
+    print_table(rows, ['clips', 'vad_ms_per_clip', 'frames_per_clip', 'forward_s', 'ms_per_clip'])
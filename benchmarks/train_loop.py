@@ -0,0 +1,59 @@
+"""
+Steps per second of Trainer.train with a tiny random-init model, so the loop's own overhead (host syncs for
+logging and the LR schedule) dominates. log_every=1 reads the loss back after every step, as the loop used
+to; larger values only read it every log_every steps.
+
+    python -m benchmarks.train_loop --steps 500 --log_every 1 50
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import BatchEncoding
+
+from modeling import trainer
+from benchmarks.utils import get_device, synchronize, print_table
+
+class TinyModel(torch.nn.Module):
+    # same call signature as the repo's models: (data, targets, ...) -> (output, loss)
+    def __init__(self, vocab_size: int, hidden_size: int, num_outputs: int):
+        super(TinyModel, self).__init__()
+        self.l1 = torch.nn.EmbeddingBag(vocab_size, hidden_size)
+        self.l2 = torch.nn.Linear(hidden_size, num_outputs)
+
+    def forward(self, data, targets=None, **kwargs):
+        output = self.l2(self.l1(data['input_ids'].squeeze(1)))
+        loss = None if targets is None else torch.nn.MSELoss()(output.float(), targets.float())
+        return output, loss
+
+def make_batches(args: argparse.Namespace, seed: int = 0) -> list:
+    generator = torch.Generator().manual_seed(seed)
+    return [(BatchEncoding({'input_ids': torch.randint(0, args.vocab_size, (args.batch_size, 1, args.seq_length), generator=generator)}),
+             torch.rand(args.batch_size, args.num_outputs, generator=generator)) for _ in range(args.steps)]
+
+def benchmark(log_every: int, args: argparse.Namespace) -> dict:
+    torch.manual_seed(0)
+    model = TinyModel(args.vocab_size, args.hidden_size, args.num_outputs).to(get_device())
+    config = trainer.TrainerConfig(max_epochs=1, learning_rate=1e-3, lr_decay=True, warmup_tokens=100, log_every=log_every)
+    t = trainer.Trainer(model=model, train_dataloader=make_batches(args), config=config)
+    t.train('train', 0) # warmup
+    synchronize()
+    start = time.perf_counter()
+    t.train('train', 0)
+    synchronize()
+    return {'log_every': log_every, 'steps_per_s': args.steps / (time.perf_counter() - start)}
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--steps', type=int, default=500)
+    argp.add_argument('--log_every', type=int, nargs='+', default=[1, 50])
+    argp.add_argument('--batch_size', type=int, default=16)
+    argp.add_argument('--seq_length', type=int, default=64)
+    argp.add_argument('--vocab_size', type=int, default=1000)
+    argp.add_argument('--hidden_size', type=int, default=32)
+    argp.add_argument('--num_outputs', type=int, default=6)
+    args = argp.parse_args()
+
+    rows = [benchmark(log_every, args) for log_every in args.log_every]
+    print_table(rows, ['log_every', 'steps_per_s'])
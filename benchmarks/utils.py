@@ -0,0 +1,59 @@
+"""
+Small helpers shared by the benchmark scripts. Run the benchmarks from the repo root as modules,
+e.g. `python -m benchmarks.heads`.
+"""
+
+import time
+import resource
+import multiprocessing
+from typing import Any, Callable, Dict, Sequence
+
+import torch
+
+
+def get_device() -> Any:
+    return torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+
+def synchronize() -> None:
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def reset_peak_memory() -> None:
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_memory_mb() -> float:
+    # peak CUDA allocation when on GPU, otherwise the peak RSS of this process
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def time_per_call(fn: Callable[[], Any], n_iters: int = 10, warmup: int = 2) -> float:
+    # mean wall time in seconds of fn() after `warmup` untimed calls
+    for _ in range(warmup):
+        fn()
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    synchronize()
+    return (time.perf_counter() - start) / n_iters
+
+def run_isolated(fn: Callable[..., Dict], *args: Any) -> Dict:
+    # run fn in a fresh process so peak-RSS numbers are not polluted by earlier configurations
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+def count_parameters(module: torch.nn.Module) -> int:
+    return sum(p.numel() for p in module.parameters())
+
+def print_table(rows: Sequence[Dict], columns: Sequence[str]) -> None:
+    widths = [max(len(c), *(len(format_value(r.get(c))) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(format_value(r.get(c)).ljust(w) for c, w in zip(columns, widths)))
+
+def format_value(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
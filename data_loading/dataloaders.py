@@ -1,12 +1,18 @@
-from typing import Tuple
+from typing import Tuple, Sequence, Any
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn import functional as F
+from transformers import BatchEncoding, BatchFeature
 import math
 from torch import default_generator, randperm
 from torch._utils import _accumulate
 from torch.utils.data.dataset import Subset
 import warnings
 import numpy as np
+from functools import partial
+
+from modeling.distributed import get_rank, get_world_size
 
 def random_split(dataset, lengths,
                  generator=default_generator):
@@ -59,22 +65,222 @@ def random_split(dataset, lengths,
     indices = randperm(sum(lengths), generator=generator).tolist()  # type: ignore[call-overload]
     return [Subset(dataset, indices[offset - length : offset]) for offset, length in zip(_accumulate(lengths), lengths)]
 
+def pad_collate(batch: Sequence[Tuple[Any, Any]], pad_token_id: int = 0):
+    """
+    Collate tokenized items, padding (or trimming) every tensor only up to the longest sequence in the batch
+    rather than the tokenizer's `max_length`. Items are (features, targets) where each feature tensor is shaped
+    (1, seq_len, ...) with right padding, i.e. what the datasets return.
+    """
+    features, targets = zip(*batch)
+    max_length = max(int(f['attention_mask'].sum()) for f in features)
+    padded = {}
+    for name in features[0].keys():
+        value = pad_token_id if name == 'input_ids' else 0
+        tensors = []
+        for f in features:
+            t = f[name][:, :max_length]
+            # F.pad takes (left, right) pairs starting from the last dim; the sequence dim is dim 1
+            tensors.append(F.pad(t, [0, 0] * (t.dim() - 2) + [0, max_length - t.shape[1]], value=value))
+        padded[name] = torch.stack(tensors)
+    return BatchEncoding(padded), default_collate(targets)
+
+def pad_audio(clips: Sequence[Any], padding_value: float = 0.0) -> BatchFeature:
+    # pad raw audio to the longest clip along the last axis and mark the real samples in attention_mask
+    clips = [torch.as_tensor(np.asarray(clip)) for clip in clips]
+    length = max(clip.shape[-1] for clip in clips)
+    attention_mask = torch.zeros(len(clips), length, dtype=torch.long)
+    for i, clip in enumerate(clips):
+        attention_mask[i, :clip.shape[-1]] = 1
+    input_values = torch.stack([F.pad(clip, (0, length - clip.shape[-1]), value=padding_value) for clip in clips])
+    return BatchFeature({'input_values': input_values, 'attention_mask': attention_mask})
+
+def pad_frames(hidden_states: Sequence[Any]) -> BatchFeature:
+    # pad (frames, hidden_size) encoder outputs to the longest one, with a frame-level attention_mask
+    hidden_states = [torch.as_tensor(np.asarray(h)) for h in hidden_states]
+    length = max(h.shape[0] for h in hidden_states)
+    attention_mask = torch.zeros(len(hidden_states), length, dtype=torch.long)
+    for i, h in enumerate(hidden_states):
+        attention_mask[i, :h.shape[0]] = 1
+    padded = torch.stack([F.pad(h, (0, 0, 0, length - h.shape[0])) for h in hidden_states])
+    return BatchFeature({'last_hidden_state': padded, 'attention_mask': attention_mask})
+
+def pad_audio_collate(batch: Sequence[Tuple[Any, Any]], padding_value: float = 0.0):
+    """
+    Collate SpeechDataset items extracted without padding: inputs are padded to the longest clip in the batch
+    instead of a fixed max_length. The last target is the siamese reference speech (a placeholder int otherwise)
+    and is padded the same way when it is audio, or along its frames when it is a cached embedding.
+    """
+    inputs, targets = zip(*batch)
+    columns = list(zip(*targets))
+    collated = [default_collate(list(column)) for column in columns[:-1]]
+    reference = columns[-1]
+    if not isinstance(reference[0], np.ndarray):
+        collated.append(default_collate(list(reference)))
+    elif reference[0].ndim == 2:
+        # cached reference embeddings rather than audio
+        collated.append(pad_frames(reference))
+    else:
+        collated.append(pad_audio(reference, padding_value))
+    return pad_audio(inputs, padding_value), collated
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches indices so that each batch holds items of similar length, which keeps dynamic padding cheap.
+    When shuffling, indices are permuted, cut into pools of `batch_size * bucket_size_multiplier`, sorted by
+    length inside each pool, batched, and the batch order is permuted again. Without shuffling, all items are
+    sorted by length.
+    With num_replicas > 1 (distributed training) every process builds the same batches from `seed` and the
+    epoch set with set_epoch, and takes every num_replicas-th one; the list is first padded with batches from
+    its start so that all processes run the same number of steps.
+    """
+    def __init__(self, lengths: Sequence[int], batch_size: int, shuffle: bool = True,
+                 bucket_size_multiplier: int = 100, drop_last: bool = False, num_replicas: int = 1, rank: int = 0,
+                 seed: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self):
+        # processes have to agree on the permutation, so distributed runs draw it from a shared seed
+        generator = torch.Generator().manual_seed(self.seed + self.epoch) if self.num_replicas > 1 else None
+        if self.shuffle:
+            order = randperm(len(self.lengths), generator=generator).numpy()
+            pool_size = self.pool_size
+        else:
+            order = np.arange(len(self.lengths))
+            pool_size = max(1, len(order))
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1 and len(batches) > 0:
+            total = len(self) * self.num_replicas
+            batches = (batches * math.ceil(total / len(batches)))[:total][self.rank::self.num_replicas]
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            n_batches = len(self.lengths) // self.batch_size
+        else:
+            n_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return math.ceil(n_batches / self.num_replicas)
+
+def fetch_items(dataset: torch.utils.data.Dataset, indices: Sequence[int]) -> list:
+    # resolve Subsets down to the dataset itself so datasets with __getitems__ can fetch the batch in one call
+    if isinstance(dataset, BatchFetchDataset):
+        return fetch_items(dataset.dataset, indices)
+    if isinstance(dataset, Subset):
+        return fetch_items(dataset.dataset, [dataset.indices[i] for i in indices])
+    if hasattr(dataset, '__getitems__'):
+        return dataset.__getitems__(indices)
+    return [dataset[i] for i in indices]
+
+def dataset_lengths(dataset: torch.utils.data.Dataset) -> np.ndarray:
+    if isinstance(dataset, BatchFetchDataset):
+        return dataset_lengths(dataset.dataset)
+    if isinstance(dataset, Subset):
+        return dataset_lengths(dataset.dataset)[np.asarray(dataset.indices)]
+    return dataset.get_lengths()
+
+class BatchFetchDataset(torch.utils.data.Dataset):
+    """
+    Indexing with a list of indices returns the whole batch via fetch_items; integer indices are passed through.
+    torch 1.13 DataLoaders fetch batches item by item and ignore __getitems__, so batched_loader hands this a
+    batch sampler as its `sampler` with batch_size=None, and each fetch is a single batched call.
+    """
+    def __init__(self, dataset: torch.utils.data.Dataset):
+        self.dataset = dataset
+
+    def get_lengths(self) -> np.ndarray:
+        return dataset_lengths(self.dataset)
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return fetch_items(self.dataset, index)
+        return self.dataset[index]
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+def batched_loader(dataset: torch.utils.data.Dataset, batch_sampler: Any, collate_fn: Any = None,
+                   num_workers: int = 0) -> DataLoader:
+    # batch_sampler yields lists of indices; each list is fetched in one call and then collated
+    return DataLoader(BatchFetchDataset(dataset), sampler=batch_sampler, batch_size=None,
+                      collate_fn=collate_fn if collate_fn else default_collate, num_workers=num_workers)
+
+def make_data_loader(dataset: torch.utils.data.Dataset, batch_size: int, shuffle: bool, num_workers: int = 0,
+                     lengths: np.ndarray = None, collate_fn: Any = None, distributed: bool = False) -> DataLoader:
+    """
+    `lengths` switches on length bucketing for shuffled (training) loaders; `collate_fn` on dynamic padding.
+    With `distributed`, each process gets its own shard of the batches (DistributedSampler, or a sharded
+    BucketBatchSampler), padded with repeated items so every process sees the same number of batches;
+    Trainer calls set_epoch on it to reshuffle each epoch.
+    """
+    if lengths is not None and shuffle:
+        batch_sampler = BucketBatchSampler(lengths, batch_size, shuffle=True, num_replicas=get_world_size() if distributed else 1,
+                                           rank=get_rank() if distributed else 0)
+    else:
+        if distributed:
+            sampler = DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle)
+        else:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    return batched_loader(dataset, batch_sampler, collate_fn, num_workers)
+
+def set_epoch(loader: DataLoader, epoch: int) -> None:
+    # distributed samplers reshuffle per epoch; batched_loader passes the batch sampler as the loader's sampler
+    sampler = getattr(loader, 'sampler', None)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
+    elif hasattr(getattr(sampler, 'sampler', None), 'set_epoch'):
+        sampler.sampler.set_epoch(epoch)
+
+def dynamic_padding_args(dataset: torch.utils.data.Dataset, dynamic_padding: bool, collate_fn: Any = None,
+                         pad_token_id: int = 0):
+    if not dynamic_padding:
+        return None, None
+    return dataset.get_lengths(), (collate_fn if collate_fn else partial(pad_collate, pad_token_id=pad_token_id))
+
 def get_data_loaders(dataset: torch.utils.data.Dataset, val_size: float = 0.0, test_size: float=0.0,
-batch_size: int = 32, val_batch_size: int = 16, test_batch_size: int = 16, num_workers: int = 0) -> Tuple[DataLoader, DataLoader, DataLoader]:
+batch_size: int = 32, val_batch_size: int = 16, test_batch_size: int = 16, num_workers: int = 0,
+dynamic_padding: bool = False, pad_token_id: int = 0, collate_fn: Any = None, distributed: bool = False) -> Tuple[DataLoader, DataLoader, DataLoader]:
+    # with dynamic_padding, batches are padded to their longest member and training batches are length-bucketed.
+    # with distributed, the train and val loaders are sharded across processes; test loaders are not
+    lengths, collate_fn = dynamic_padding_args(dataset, dynamic_padding, collate_fn, pad_token_id)
     if val_size==0.0 and test_size==0.0:
-        train_dl = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True,num_workers=num_workers)
+        train_dl = make_data_loader(dataset, batch_size, shuffle=True, num_workers=num_workers, lengths=lengths, collate_fn=collate_fn,
+                                    distributed=distributed)
         return train_dl
     # split the dataset into train, val, and test
     datasets = random_split(dataset, [1-val_size-test_size, val_size, test_size], generator=torch.Generator().manual_seed(1))
     
-    train_dl = DataLoader(datasets[0], batch_size=batch_size, shuffle=True,num_workers=num_workers, )
-    val_dl = DataLoader(datasets[1], batch_size=val_batch_size, shuffle=False,num_workers=num_workers)
-    test_dl = DataLoader(datasets[2], batch_size=test_batch_size, shuffle=False,num_workers=num_workers)
+    train_dl = make_data_loader(datasets[0], batch_size, shuffle=True, num_workers=num_workers,
+                                lengths=None if lengths is None else lengths[datasets[0].indices], collate_fn=collate_fn,
+                                distributed=distributed)
+    val_dl = make_data_loader(datasets[1], val_batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn,
+                              distributed=distributed)
+    test_dl = make_data_loader(datasets[2], test_batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn)
     
     return train_dl, (val_dl if len(val_dl)>0 else None), (test_dl if len(test_dl)>0 else None)
 
 def split_on_indices(dataset: torch.utils.data.Dataset, index_col: str, val_size: float = 0.0, test_size: float=0.0,
-batch_size: int = 32, val_batch_size: int = 16, test_batch_size: int = 16, num_workers: int = 0, seed: int = 0) -> DataLoader:
+batch_size: int = 32, val_batch_size: int = 16, test_batch_size: int = 16, num_workers: int = 0, seed: int = 0,
+dynamic_padding: bool = False, pad_token_id: int = 0, collate_fn: Any = None, distributed: bool = False) -> DataLoader:
+    lengths, collate_fn = dynamic_padding_args(dataset, dynamic_padding, collate_fn, pad_token_id)
     idx = np.array(list(set(dataset.data[index_col])))
     np.random.seed(1+seed)
     np.random.shuffle(idx)
@@ -86,8 +292,11 @@ batch_size: int = 32, val_batch_size: int = 16, test_batch_size: int = 16, num_w
     val_ds = Subset(dataset, np.where(np.isin(dataset.data[index_col], val_idx))[0])
     test_ds = Subset(dataset, np.where(np.isin(dataset.data[index_col], test_idx))[0])
 
-    train_dl = DataLoader(train_ds, batch_size=batch_size, shuffle=True,num_workers=num_workers, )
-    val_dl = DataLoader(val_ds, batch_size=val_batch_size, shuffle=False,num_workers=num_workers)
-    test_dl = DataLoader(test_ds, batch_size=test_batch_size, shuffle=False,num_workers=num_workers)
+    train_dl = make_data_loader(train_ds, batch_size, shuffle=True, num_workers=num_workers,
+                                lengths=None if lengths is None else lengths[train_ds.indices], collate_fn=collate_fn,
+                                distributed=distributed)
+    val_dl = make_data_loader(val_ds, val_batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn,
+                              distributed=distributed)
+    test_dl = make_data_loader(test_ds, test_batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn)
 
     return train_dl, val_dl, test_dl
\ No newline at end of file
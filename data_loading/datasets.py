@@ -1,12 +1,11 @@
+import os
+import hashlib
 import pandas as pd
 import torch
-from typing import Sequence, Any, Dict, Tuple, TypeVar
+from typing import Sequence, Any, Dict, List, Tuple, TypeVar
 import numpy as np
-from datasets import load_dataset, Dataset
+from transformers import BatchEncoding
 import torch.nn.functional as F
-from torch.nn.functional import pad
-from espnet2.bin.tts_inference import Text2Speech
-from scipy.io.wavfile import write
 import json
 
 T_co = TypeVar('T_co', covariant=True)
@@ -16,9 +15,86 @@ def pad_up_to(t, max_in_dims, constant_values):
     paddings = (m-s[i] for (i,m) in enumerate(max_in_dims))
     return F.pad(t, paddings, 'constant', constant_values=constant_values)
 
+def cache_key(*parts: Any) -> str:
+    # stable hash of everything that determines the cached arrays
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def file_id(path: str) -> Tuple[str, float, int]:
+    # path plus modification time and size, so a source file edited in place gets a new cache key
+    return os.path.abspath(path), os.path.getmtime(path), os.path.getsize(path)
+
+def build_token_cache(texts: Sequence[str], tokenizer: Any, tokenizer_params: Dict, cache_dir: str, key: str,
+                      batch_size: int = 1024) -> Dict[str, np.ndarray]:
+    """
+    Tokenize `texts` once into memory-mapped `input_ids`/`attention_mask` arrays of shape (N, max_length)
+    stored under `cache_dir`, and return them opened copy-on-write so items can be sliced without copying.
+    Rows are always padded to `max_length` so the arrays are rectangular.
+    """
+    names = ('input_ids', 'attention_mask')
+    paths = {name: os.path.join(cache_dir, f"{key}.{name}.npy") for name in names}
+    if not all(os.path.exists(path) for path in paths.values()):
+        os.makedirs(cache_dir, exist_ok=True)
+        params = {**tokenizer_params, 'padding': 'max_length', 'return_tensors': 'np'}
+        params.setdefault('max_length', tokenizer.model_max_length)
+        # write to temporary files first so a crashed or concurrent build never leaves a partial cache behind
+        tmp_paths = {name: f"{path}.{os.getpid()}.tmp" for name, path in paths.items()}
+        arrays = {name: np.lib.format.open_memmap(tmp_paths[name], mode='w+', dtype=np.int64,
+                                                  shape=(len(texts), params['max_length'])) for name in names}
+        for start in range(0, len(texts), batch_size):
+            encoded = tokenizer(list(texts[start:start + batch_size]), **params)
+            for name in names:
+                arrays[name][start:start + len(encoded[name])] = encoded[name]
+        for name in names:
+            arrays[name].flush()
+            del arrays[name]
+            os.replace(tmp_paths[name], paths[name])
+    return {name: np.load(path, mmap_mode='c') for name, path in paths.items()}
+
+def token_cache_item(token_cache: Dict[str, np.ndarray], index: int) -> BatchEncoding:
+    # (1, max_length) views, the same shape the tokenizer returns with return_tensors='pt'
+    return BatchEncoding({name: torch.from_numpy(array[index:index + 1]) for name, array in token_cache.items()})
+
+def token_cache_items(token_cache: Dict[str, np.ndarray], indices: Sequence[int]) -> List[BatchEncoding]:
+    # one fancy-indexed read per array for the whole batch
+    return split_batch_encoding(BatchEncoding({name: torch.from_numpy(array[indices]) for name, array in token_cache.items()}))
+
+def split_batch_encoding(encoding: BatchEncoding) -> List[BatchEncoding]:
+    # (B, L) tensors -> B items shaped (1, L), as if each text had been tokenized on its own
+    return [BatchEncoding({name: value[i:i + 1] for name, value in encoding.items()})
+            for i in range(len(encoding['input_ids']))]
+
+def batch_tokenizable(tokenizer_params: Dict) -> bool:
+    # batched tokenization only matches per-item tokenization when every row is padded to the same length
+    return tokenizer_params.get('padding') == 'max_length' and tokenizer_params.get('return_tensors') == 'pt'
+
+def token_lengths(texts: Sequence[str], tokenizer: Any, tokenizer_params: Dict,
+                  token_cache: Dict[str, np.ndarray] = None) -> np.ndarray:
+    # number of non-padding tokens per text (after truncation)
+    if token_cache is not None:
+        return token_cache['attention_mask'].sum(axis=1)
+    params = {**tokenizer_params, 'padding': False, 'return_tensors': None}
+    return np.array([len(ids) for ids in tokenizer(list(texts), **params)['input_ids']])
+
+def get_items(dataset: torch.utils.data.Dataset, indices: Sequence[int]) -> List[T_co]:
+    """
+    Fetch a whole batch of a text dataset at once: one tokenizer call (or one read of the token cache) and one
+    fancy index into the targets. Items are the same as dataset[i] for each index.
+    """
+    indices = list(indices)
+    targets = dataset.target_array[indices]
+    if dataset.token_cache is not None:
+        features = token_cache_items(dataset.token_cache, indices)
+    elif dataset.tokenizer and batch_tokenizable(dataset.tokenizer_params):
+        features = split_batch_encoding(dataset.tokenizer([dataset.texts[i] for i in indices], **dataset.tokenizer_params))
+    elif dataset.tokenizer:
+        features = [dataset.tokenizer(dataset.texts[i], **dataset.tokenizer_params) for i in indices]
+    else:
+        features = dataset.input_array[indices]
+    return list(zip(features, targets))
+
 class DefaultDataset(torch.utils.data.Dataset):
     def __init__(self, file_path, input_col: str, target_cols: Sequence[str], index_col: str = None,
-                 tokenizer: Any = None, tokenizer_params: Dict = None, normalize=True):
+                 tokenizer: Any = None, tokenizer_params: Dict = None, normalize=True, cache_dir: str = None):
         self.data = pd.read_csv(file_path)
         # set index col so we can use it as a key
         if index_col:
@@ -38,21 +114,42 @@ class DefaultDataset(torch.utils.data.Dataset):
          'max_length': 512,
         # 'max_length': max([len(t) for t in self.tokenizer(self.inputs['full_text'].to_list())['input_ids']]),
          'truncation': True, 'return_tensors': 'pt'} 
+        # identifies the tokenized inputs; also used to key caches built on top of them
+        self.cache_key = None if not self.tokenizer else cache_key(
+            file_id(file_path), input_col, self.tokenizer.name_or_path, self.tokenizer_params)
+        # optionally pre-tokenize everything once into a memory-mapped cache shared across epochs and runs
+        self.token_cache = None
+        # plain arrays and lists for item access: a pandas row lookup costs tens of microseconds per call
+        self.input_array = self.inputs.to_numpy()
+        self.texts = self.inputs[input_col].tolist()
+        self.target_array = self.targets.to_numpy()
+        if cache_dir and self.tokenizer:
+            self.token_cache = build_token_cache(self.texts, self.tokenizer, self.tokenizer_params,
+                                                 cache_dir, self.cache_key)
     
     def normalize_targets(self, normalize_score: float = 100.0) -> None:
         self.targets = (self.targets) / self.targets.max(axis=0) * normalize_score
+        self.target_array = self.targets.to_numpy()
 
     def standardize_targets(self) -> None:
         self.targets = (self.targets - self.targets.mean(axis=0)) / self.targets.std(axis=0)
+        self.target_array = self.targets.to_numpy()
+
+    def get_lengths(self) -> np.ndarray:
+        return token_lengths(self.texts, self.tokenizer, self.tokenizer_params, self.token_cache)
 
     def __getitem__(self, index: Any) -> T_co:
-        idx = self.indices[index]
-        if self.tokenizer:
-            features = self.tokenizer(self.inputs.loc[idx].item(), **self.tokenizer_params)
+        if self.token_cache is not None:
+            features = token_cache_item(self.token_cache, index)
+        elif self.tokenizer:
+            features = self.tokenizer(self.texts[index], **self.tokenizer_params)
         else:
             # input is already tokenized
-            features = self.inputs.loc[idx].values
-        return features, self.targets.loc[idx].values
+            features = self.input_array[index]
+        return features, self.target_array[index]
+
+    def __getitems__(self, indices: Sequence[int]) -> List[T_co]:
+        return get_items(self, indices)
 
     def __len__(self) -> int:
         return len(self.data)
@@ -61,7 +158,7 @@ class CombinedDataset(torch.utils.data.Dataset):
     def __init__(self, file_path1: str, file_path2: str,
                  input_col1: str, input_col2: str,
                  target_cols1: Sequence[str], target_cols2: Sequence[str], index_col1: str = None, index_col2: str = None,
-                 tokenizer: Any = None, tokenizer_params: Dict = None):
+                 tokenizer: Any = None, tokenizer_params: Dict = None, cache_dir: str = None):
         self.data1 = pd.read_csv(file_path1)
         self.data2 = pd.read_csv(file_path2)
         # set index col so we can use it as a key
@@ -110,6 +207,16 @@ class CombinedDataset(torch.utils.data.Dataset):
          'max_length': 512,
         # 'max_length': max([len(t) for t in self.tokenizer(self.inputs['full_text'].to_list())['input_ids']]),
          'truncation': True, 'return_tensors': 'pt'} 
+        self.cache_key = None if not self.tokenizer else cache_key(
+            file_id(file_path1), file_id(file_path2), input_col1, input_col2,
+            self.tokenizer.name_or_path, self.tokenizer_params)
+        self.token_cache = None
+        self.input_array = self.inputs.to_numpy()
+        self.texts = self.inputs.iloc[:, 0].tolist()
+        self.target_array = self.targets.to_numpy()
+        if cache_dir and self.tokenizer:
+            self.token_cache = build_token_cache(self.texts, self.tokenizer, self.tokenizer_params,
+                                                 cache_dir, self.cache_key)
     
     def normalize_targets(self, targs, normalize_score: float = 100.0):
         return (targs) / targs.max(axis=0) * normalize_score
@@ -117,123 +224,21 @@ class CombinedDataset(torch.utils.data.Dataset):
     def standardize_targets(self, targs) -> None:
         return (targs - targs.mean(axis=0)) / targs.std(axis=0)
 
+    def get_lengths(self) -> np.ndarray:
+        return token_lengths(self.texts, self.tokenizer, self.tokenizer_params, self.token_cache)
+
     def __getitem__(self, index: Any) -> T_co:
-        if self.tokenizer:
-            features = self.tokenizer(self.inputs.iloc[index].item(), **self.tokenizer_params)
+        if self.token_cache is not None:
+            features = token_cache_item(self.token_cache, index)
+        elif self.tokenizer:
+            features = self.tokenizer(self.texts[index], **self.tokenizer_params)
         else:
             # input is already tokenized
-            features = self.inputs.iloc[index].values
-        return features, self.targets.iloc[index].values
-
-    def __len__(self) -> int:
-        return len(self.data)
-
-class SpeechDataset(torch.utils.data.Dataset):
-    def __init__(self, path_name: str, input_col: str, target_cols_sentence: Sequence[str], 
-    target_cols_words: Sequence[str] = [], target_cols_phones: Sequence[str] = [],
-                 tokenizer: Any = None, tokenizer_params: Dict = None, phoneme_seq_length: int = 30, word_seq_length: int = 10,
-                 siamese: bool = False):
-        self.data = load_dataset(path_name, split='train')
-        self.tokenizer = tokenizer
+            features = self.input_array[index]
+        return features, self.target_array[index]
 
-        tokenizer_params = tokenizer_params if tokenizer_params else {'sampling_rate':tokenizer.sampling_rate, 
-        'padding': 'max_length', 'max_length': 100000, 
-        'truncation': True}
-        self.inputs = tokenizer(
-        [x[input_col]['array'] for x in self.data], ** tokenizer_params)
-        self.inputs = self.inputs['input_features'] if ('input_features' in self.inputs) else self.inputs['input_values']
-
-        # Tokenize correct speech
-        if siamese:
-        # self.correct_speech = [5 for x in self.data]
-            self.correct_speech = load_dataset('siegels/speechocean_correct_data', split='train').to_pandas().to_numpy()
-            self.correct_speech = [np.trim_zeros(self.correct_speech[i], trim='b') for i in range(self.correct_speech.shape[0])]
-            self.correct_speech = tokenizer(self.correct_speech, ** tokenizer_params)
-            self.correct_speech = self.correct_speech['input_features'] if ('input_features' in self.correct_speech) else self.correct_speech['input_values']
-        else:
-            self.correct_speech = [5 for x in self.data]
-
-        self.targets_sentence = pd.DataFrame([[x[t] for t in target_cols_sentence] for x in self.data ], columns=target_cols_sentence)
-        if (len(target_cols_words) > 0) | (len(target_cols_phones) > 0):
-            targets_words, targets_phones = self.compute_subtargets(target_cols_words, target_cols_phones)
-        
-        if len(target_cols_words) > 0:
-            self.targets_words = pd.DataFrame(targets_words, columns=target_cols_words)
-        else:
-            self.targets_words = None
-        if len(target_cols_phones) > 0:
-            self.targets_phones = pd.DataFrame(targets_phones, columns=target_cols_phones)
-        else:
-            self.targets_phones = None
-        
-        # normalize the targets
-        self.phoneme_seq_length = phoneme_seq_length
-        self.word_seq_length = word_seq_length
-        self.normalize_targets()
-    
-    def compute_subtargets(self, target_cols_words: Sequence[str], target_cols_phones: Sequence[str]) -> Tuple[Sequence[str], Sequence[str]]:
-        compute_phone_accuracy = len(target_cols_phones) > 0
-        compute_word_accuracy = len(target_cols_words) > 0
-        targets_words = []
-        targets_phones = []
-        for person_words in self.data['words']:
-            person_word_list = []
-            person_phones_list = []
-            for w in target_cols_words:
-                word_scores = []
-                for word_dict in person_words:
-                    word_scores.append(word_dict[w])
-                person_word_list.append(word_scores)
-            for p in target_cols_phones:
-                word_phone_scores = []
-                for word_dict in person_words:
-                    # word_phone_scores.append(np.array(word_dict[p]))
-                    word_phone_scores.append(word_dict[p])
-                # person_phones_list.append(word_phone_scores)
-                person_phones_list.append([score for sublist in word_phone_scores for score in sublist])
-            if compute_word_accuracy:
-                targets_words.append(person_word_list)
-            if compute_phone_accuracy:
-                targets_phones.append(person_phones_list)
-        return targets_words, targets_phones
+    def __getitems__(self, indices: Sequence[int]) -> List[T_co]:
+        return get_items(self, indices)
 
-    def normalize_targets(self, normalize_score: float = 100.0) -> None:
-        # normalize the sentence targets
-        self.targets_sentence = (self.targets_sentence) / self.targets_sentence.max(axis=0) * normalize_score
-        # normalize the word targets
-        if self.targets_words is not None:
-            for label in range(len(self.targets_words.iloc[0])):
-                # loop through each word target and normalize it
-                def normalize_score(row, max_score: float):
-                    row[label] = [score/max_score*100 for score in row[label]]
-                    return row
-                max_score = self.targets_words.apply(lambda x: max(x[label]), axis=1).max()
-                self.targets_words = self.targets_words.apply(normalize_score, max_score=max_score, axis=1)
-        # normalize the phone targets
-        if self.targets_phones is not None:
-            for label in range(len(self.targets_phones.iloc[0])):
-                # loop through each word target and normalize it
-                def normalize_score(row, max_score: float):
-                    # row[label] = np.array([np.array([score/max_score*100 for score in phone]) for phone in row[label]])
-                    row[label] = [score/max_score*100 for score in row[label]]
-                    return row
-                # max_score = self.targets_phones.apply(lambda x: max(list(map(max, x[label]))), axis=1).max()
-                max_score = self.targets_phones.apply(lambda x: max(x[label]), axis=1).max()
-                self.targets_phones = self.targets_phones.apply(normalize_score, max_score =max_score, axis=1)
-
-    def __getitem__(self, index: Any) -> T_co:
-        words_output = None if self.targets_words is None else np.array(self.targets_words.loc[index].values.tolist())
-        if words_output is not None:
-            words_output = torch.Tensor(words_output)
-            words_output = pad(words_output, (0, self.word_seq_length-words_output.shape[1], 0, 0), value=-1)
-        phones_output = None if self.targets_phones is None else np.array(self.targets_phones.loc[index].values.tolist())
-        if phones_output is not None:
-            phones_output = torch.Tensor(phones_output)
-            phones_output = pad(phones_output, (0, self.phoneme_seq_length-phones_output.shape[1], 0, 0), value=-1)
-        if (phones_output is None) and (words_output is None):
-            return self.inputs[index], [self.targets_sentence.loc[index].values, self.correct_speech[index]]
-        return self.inputs[index], [self.targets_sentence.loc[index].values, words_output, phones_output, self.correct_speech[index]]
-
-            
     def __len__(self) -> int:
-        return len(self.data)
\ No newline at end of file
+        return len(self.data)
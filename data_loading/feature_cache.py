@@ -0,0 +1,164 @@
+import os
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+import torch
+from functools import partial
+from transformers import BatchEncoding
+
+from data_loading.datasets import cache_key, T_co
+from data_loading.dataloaders import batched_loader, pad_audio, pad_collate
+from modeling.model import encode_audio
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """
+    Encoder outputs of a frozen encoder read back from a memory-mapped cache, paired with the targets of the
+    text dataset they were computed from. kind "pooled" holds one (hidden_size,) vector per essay (mean/cls
+    pooling); kind "hidden" holds the unpadded last_hidden_state of each essay (attention pooling, which is
+    trained and so cannot be cached pooled).
+    """
+    def __init__(self, base_dataset: torch.utils.data.Dataset, kind: str, features: np.ndarray,
+                 offsets: np.ndarray = None):
+        self.base_dataset = base_dataset
+        self.targets = base_dataset.targets
+        self.target_array = base_dataset.target_array
+        self.kind = kind
+        self.features = features
+        self.offsets = offsets
+
+    def get_lengths(self) -> np.ndarray:
+        if self.kind == "hidden":
+            return np.diff(self.offsets)
+        return np.ones(len(self), dtype=np.int64)
+
+    def __getitem__(self, index: Any) -> T_co:
+        if self.kind == "hidden":
+            hidden_states = torch.from_numpy(self.features[self.offsets[index]:self.offsets[index + 1]]).float()
+            features = BatchEncoding({'last_hidden_state': hidden_states.unsqueeze(0),
+                                      'attention_mask': torch.ones(1, hidden_states.shape[0], dtype=torch.long)})
+        else:
+            features = BatchEncoding({'pooled': torch.from_numpy(self.features[index:index + 1])})
+        return features, self.target_array[index]
+
+    def __getitems__(self, indices: Sequence[int]) -> List[T_co]:
+        if self.kind == "hidden":
+            return [self[index] for index in indices]
+        pooled = torch.from_numpy(self.features[list(indices)])
+        return [(BatchEncoding({'pooled': pooled[row:row + 1]}), self.target_array[index]) for row, index in enumerate(indices)]
+
+    def __len__(self) -> int:
+        return len(self.base_dataset)
+
+def build_feature_cache(model: torch.nn.Module, dataset: torch.utils.data.Dataset, cache_dir: str,
+                        checkpoint: str = None, batch_size: int = 64, device: Any = 'cpu',
+                        pad_token_id: int = 0) -> FeatureDataset:
+    """
+    Run the (frozen) encoder of a PooledModel over `dataset` once and store its outputs under `cache_dir`,
+    keyed by the tokenized dataset, the encoder and the checkpoint it was restored from. Later calls with the
+    same key, e.g. from other tuning trials, only open the cache.
+    """
+    kind = "hidden" if model.pooling == "attention" else "pooled"
+    checkpoint_id = None if checkpoint is None else (os.path.abspath(checkpoint), os.path.getmtime(checkpoint))
+    key = cache_key(dataset.cache_key, model.l1.config.name_or_path, checkpoint_id, kind, model.pooling)
+    paths = {name: os.path.join(cache_dir, f"{key}.{name}.npy") for name in ('features', 'offsets')}
+    if not os.path.exists(paths['features']):
+        os.makedirs(cache_dir, exist_ok=True)
+        write_feature_cache(model, dataset, kind, paths, batch_size, device, pad_token_id)
+    features = np.load(paths['features'], mmap_mode='c')
+    offsets = np.load(paths['offsets']) if kind == "hidden" else None
+    return FeatureDataset(dataset, kind, features, offsets)
+
+def write_feature_cache(model: torch.nn.Module, dataset: torch.utils.data.Dataset, kind: str, paths: Dict[str, str],
+                        batch_size: int, device: Any, pad_token_id: int) -> None:
+    lengths = dataset.get_lengths()
+    hidden_size = model.l1.config.hidden_size
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    shape = (offsets[-1], hidden_size) if kind == "hidden" else (len(dataset), hidden_size)
+    dtype = np.float16 if kind == "hidden" else np.float32
+    tmp_path = f"{paths['features']}.{os.getpid()}.tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+
+    # longest first, padded per batch, so the encoder never runs over more padding than needed
+    order = np.argsort(-lengths, kind='stable')
+    batches = [order[start:start + batch_size].tolist() for start in range(0, len(order), batch_size)]
+    loader = batched_loader(dataset, batches, collate_fn=partial(pad_collate, pad_token_id=pad_token_id))
+    model = model.to(device)
+    model.eval()
+    position = 0
+    with torch.inference_mode():
+        for x, _ in loader:
+            x = x.to(device)
+            attention_mask = x['attention_mask'].squeeze(1)
+            hidden_states = model.l1(input_ids=x['input_ids'].squeeze(1), attention_mask=attention_mask)['last_hidden_state']
+            indices = order[position:position + len(hidden_states)]
+            position += len(hidden_states)
+            if kind == "pooled":
+                features[indices] = model.pool(hidden_states, attention_mask).float().cpu().numpy()
+                continue
+            hidden_states = hidden_states.to(torch.float16).cpu().numpy()
+            for row, index in enumerate(indices):
+                features[offsets[index]:offsets[index + 1]] = hidden_states[row, :lengths[index]]
+    features.flush()
+    del features
+    if kind == "hidden":
+        with open(f"{paths['offsets']}.{os.getpid()}.tmp", 'wb') as f:
+            np.save(f, offsets)
+        os.replace(f.name, paths['offsets'])
+    # the features file is written last: its presence marks the cache as complete
+    os.replace(tmp_path, paths['features'])
+
+def build_reference_cache(model: torch.nn.Module, dataset: torch.utils.data.Dataset, cache_dir: str,
+                          checkpoint: str = None, text_col: str = 'text', batch_size: int = 8, device: Any = 'cpu') -> None:
+    """
+    Encode the siamese reference speech once per unique prompt text with `model`'s encoder and store each
+    last_hidden_state (frames, hidden_size, fp16) under `cache_dir`, indexed by the hash of the text. `dataset`
+    (a siamese SpeechDataset) is then pointed at the cache, so its items carry the embedding instead of the waveform
+    and the model skips the encoder for them.
+    """
+    # the cached branch only keeps matching the live one while the encoder does not change (this includes LoRA
+    # adapters, which train the encoder's output too)
+    if any(param.requires_grad for param in model.l1.parameters()):
+        raise ValueError("reference embeddings can only be cached for a frozen encoder")
+    # the encoder has to see the waveforms, not a previously attached cache
+    dataset.reference_embeddings = None
+    text_keys = [cache_key(text) for text in dataset.data[text_col]]
+    first_row = {}
+    for row, text_key in enumerate(text_keys):
+        first_row.setdefault(text_key, row)
+    unique_keys = sorted(first_row)
+    checkpoint_id = None if checkpoint is None else (os.path.abspath(checkpoint), os.path.getmtime(checkpoint))
+    key = cache_key('reference-embeddings', dataset.reference_data._fingerprint, dataset.tokenizer.to_dict(),
+                    dataset.tokenizer_params, dataset.vad_params, model.l1.config.name_or_path, checkpoint_id, unique_keys)
+    paths = {name: os.path.join(cache_dir, f"{key}.{name}.npy") for name in ('features', 'offsets')}
+    if not os.path.exists(paths['features']):
+        os.makedirs(cache_dir, exist_ok=True)
+        write_reference_cache(model, dataset, [first_row[k] for k in unique_keys], paths, batch_size, device)
+    row_of_key = {text_key: row for row, text_key in enumerate(unique_keys)}
+    dataset.set_reference_embeddings(np.load(paths['features'], mmap_mode='r'), np.load(paths['offsets']),
+                                     np.array([row_of_key[k] for k in text_keys]))
+
+def write_reference_cache(model: torch.nn.Module, dataset: torch.utils.data.Dataset, rows: Sequence[int],
+                          paths: Dict[str, str], batch_size: int, device: Any) -> None:
+    # each reference is extracted once; the frame counts come first, so the ragged array can be allocated up front
+    clips = [clip for start in range(0, len(rows), batch_size)
+             for clip in dataset.get_correct_speech(rows[start:start + batch_size])]
+    frames = model.l1._get_feat_extract_output_lengths(torch.tensor([clip.shape[-1] for clip in clips])).numpy()
+    offsets = np.concatenate([[0], np.cumsum(frames)])
+    tmp_path = f"{paths['features']}.{os.getpid()}.tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                         shape=(offsets[-1], model.l1.config.hidden_size))
+    model = model.to(device)
+    model.eval()
+    with torch.inference_mode():
+        # encoded one at a time: group-norm encoders (wav2vec2-base) take no attention mask, so in a padded batch
+        # a short reference's embedding would depend on how long the others in its batch are
+        for index, clip in enumerate(clips):
+            hidden_states = encode_audio(model.l1, pad_audio([clip]).to(device))[0]
+            features[offsets[index]:offsets[index + 1]] = hidden_states[0, :frames[index]].to(torch.float16).cpu().numpy()
+    features.flush()
+    del features
+    with open(f"{paths['offsets']}.{os.getpid()}.tmp", 'wb') as f:
+        np.save(f, offsets)
+    os.replace(f.name, paths['offsets'])
+    # the features file is written last: its presence marks the cache as complete
+    os.replace(tmp_path, paths['features'])
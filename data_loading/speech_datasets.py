@@ -0,0 +1,274 @@
+import os
+import pandas as pd
+import torch
+from typing import Sequence, Any, Callable, Dict, List, Tuple
+import numpy as np
+# the HuggingFace datasets library is only needed for speech, so it is imported here and not in datasets.py
+from datasets import load_dataset
+from torch.nn.functional import pad
+
+from data_loading.datasets import T_co, cache_key
+
+# energy-based voice activity detection used to trim leading and trailing silence off clips before extraction:
+# frames more than threshold_db below the loudest frame of the clip count as silence, and margin_ms of audio
+# is kept on either side of the first and last voiced frame
+DEFAULT_VAD_PARAMS = {'threshold_db': -40.0, 'frame_ms': 25.0, 'hop_ms': 10.0, 'margin_ms': 100.0}
+
+def silence_bounds(audio: np.ndarray, sampling_rate: int, threshold_db: float = -40.0, frame_ms: float = 25.0,
+                   hop_ms: float = 10.0, margin_ms: float = 100.0) -> Tuple[int, int]:
+    """
+    Returns (start, end) such that audio[start:end] is the clip without its leading and trailing silence. Clips
+    shorter than one frame, or without any frame above the threshold, are kept whole.
+    """
+    frame = max(int(sampling_rate * frame_ms / 1000), 1)
+    hop = max(int(sampling_rate * hop_ms / 1000), 1)
+    if len(audio) <= frame:
+        return 0, len(audio)
+    # mean energy of every frame from a running sum of squares
+    energy = np.concatenate([[0.0], np.cumsum(np.square(audio, dtype=np.float64))])
+    starts = np.arange(0, len(audio) - frame + 1, hop)
+    frame_db = 10 * np.log10((energy[starts + frame] - energy[starts]) / frame + 1e-12)
+    voiced = np.flatnonzero(frame_db >= frame_db.max() + threshold_db)
+    if len(voiced) == 0 or frame_db.max() <= -120:
+        return 0, len(audio)
+    margin = int(sampling_rate * margin_ms / 1000)
+    return max(starts[voiced[0]] - margin, 0), min(starts[voiced[-1]] + frame + margin, len(audio))
+
+def build_audio_cache(extract: Callable[[List[np.ndarray]], List[np.ndarray]], load_audio: Callable[[int, int], List[np.ndarray]],
+                      n: int, max_length: int, cache_dir: str, key: str, batch_size: int = 64,
+                      trim: Callable[[List[np.ndarray]], Tuple[List[np.ndarray], np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extract features for `n` clips in one streaming pass, `batch_size` clips at a time, into a memory-mapped
+    array under `cache_dir` with one row per clip, zero-padded to `max_length` along the last axis, and return it
+    opened read-only together with each clip's unpadded length. Only one batch of audio is in memory at a time;
+    later runs with the same key just open the files. With `trim`, clips are trimmed before extraction and the
+    (n, 2) sample offsets it returns are cached and returned as well (None otherwise). With n == 0 nothing is
+    written and the arrays are empty.
+    """
+    names = ('audio', 'lengths', 'offsets') if trim is not None else ('audio', 'lengths')
+    if n == 0:
+        # nothing to extract (e.g. an empty split): empty arrays, as the token cache gives for no texts
+        return np.zeros((0, max_length), dtype=np.float32), np.zeros(0, dtype=np.int64), \
+            np.zeros((0, 2), dtype=np.int64) if trim is not None else None
+    paths = {name: os.path.join(cache_dir, f"{key}.{name}.npy") for name in names}
+    if not all(os.path.exists(path) for path in paths.values()):
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under a temporary name so a crashed or concurrent build never leaves a partial cache behind
+        tmp_path = f"{paths['audio']}.{os.getpid()}.tmp"
+        features = None
+        arrays = {'lengths': np.zeros(n, dtype=np.int64), 'offsets': np.zeros((n, 2), dtype=np.int64)}
+        for start in range(0, n, batch_size):
+            clips = load_audio(start, min(start + batch_size, n))
+            if trim is not None:
+                clips, arrays['offsets'][start:start + len(clips)] = trim(clips)
+            for row, item in enumerate(extract(clips)):
+                if features is None:
+                    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=item.dtype,
+                                                         shape=(n, *item.shape[:-1], max_length))
+                features[start + row, ..., :item.shape[-1]] = item
+                arrays['lengths'][start + row] = item.shape[-1]
+        features.flush()
+        del features
+        for name in names[1:]:
+            with open(f"{paths[name]}.{os.getpid()}.tmp", 'wb') as f:
+                np.save(f, arrays[name])
+            os.replace(f.name, paths[name])
+        # the audio file is moved last: its presence marks the cache as complete
+        os.replace(tmp_path, paths['audio'])
+    offsets = np.load(paths['offsets']) if trim is not None else None
+    return np.load(paths['audio'], mmap_mode='r'), np.load(paths['lengths']), offsets
+
+def cached_rows(features: np.ndarray, lengths: np.ndarray, indices: Sequence[int]) -> List[np.ndarray]:
+    return [np.array(features[i, ..., :lengths[i]]) for i in indices]
+
+def pad_ragged(scores: np.ndarray, counts: np.ndarray, width: int, fill: float = -1) -> np.ndarray:
+    """
+    Turn flat (labels, sum(counts)) scores into a dense (len(counts), labels, width) float32 array: row i holds the
+    first min(counts[i], width) scores of item i and `fill` after them.
+    """
+    out = np.full((len(counts), scores.shape[0], width), fill, dtype=np.float32)
+    starts = np.cumsum(counts) - counts
+    rows = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(scores.shape[1]) - np.repeat(starts, counts)
+    keep = positions < width
+    out[rows[keep], :, positions[keep]] = scores[:, keep].T
+    return out
+
+class SpeechDataset(torch.utils.data.Dataset):
+    def __init__(self, path_name: str, input_col: str, target_cols_sentence: Sequence[str], 
+    target_cols_words: Sequence[str] = [], target_cols_phones: Sequence[str] = [],
+                 tokenizer: Any = None, tokenizer_params: Dict = None, phoneme_seq_length: int = 30, word_seq_length: int = 10,
+                 siamese: bool = False, cache_dir: str = None, dynamic_padding: bool = False, vad_params: Dict = None):
+        self.data = load_dataset(path_name, split='train')
+        self.input_col = input_col
+        self.tokenizer = tokenizer
+
+        # with dynamic_padding clips are only truncated here and padded per batch by pad_audio_collate
+        self.tokenizer_params = tokenizer_params if tokenizer_params else {'sampling_rate':tokenizer.sampling_rate, 
+        'padding': False if dynamic_padding else 'max_length', 'max_length': 100000, 
+        'truncation': True}
+        # reference (correct) speech for the siamese model; rows are raw samples padded with trailing zeros
+        self.reference_data = load_dataset('siegels/speechocean_correct_data', split='train') if siamese else None
+        # None keeps clips as they are; otherwise silence is trimmed with silence_bounds(**vad_params) before extraction
+        self.vad_params = vad_params
+
+        # features are extracted lazily per item (or per batch in __getitems__), so the padded feature matrix is
+        # never held in memory. With cache_dir they are extracted once into a memory-mapped file instead.
+        self.inputs, self.input_lengths, self.input_offsets = None, None, None
+        self.correct_speech, self.correct_speech_lengths = None, None
+        # set by data_loading.feature_cache.build_reference_cache
+        self.reference_embeddings = None
+        if cache_dir:
+            max_length = self.tokenizer_params.get('max_length')
+            if max_length is None or not self.tokenizer_params.get('truncation'):
+                raise ValueError("The audio feature cache needs tokenizer_params with truncation to a max_length")
+            extractor = (self.tokenizer.to_dict(), self.tokenizer_params, self.vad_params)
+            trim = self.trim if self.vad_params is not None else None
+            self.inputs, self.input_lengths, self.input_offsets = build_audio_cache(
+                self.extract, self.load_audio, len(self.data), max_length, cache_dir,
+                cache_key(path_name, input_col, self.data._fingerprint, *extractor), trim=trim)
+            if siamese:
+                self.correct_speech, self.correct_speech_lengths, _ = build_audio_cache(
+                    self.extract, self.load_reference_audio, len(self.reference_data), max_length, cache_dir,
+                    cache_key('reference', self.reference_data._fingerprint, *extractor), trim=trim)
+
+        self.phoneme_seq_length = phoneme_seq_length
+        self.word_seq_length = word_seq_length
+        self.build_targets(target_cols_sentence, target_cols_words, target_cols_phones)
+
+    def build_targets(self, target_cols_sentence: Sequence[str], target_cols_words: Sequence[str],
+                      target_cols_phones: Sequence[str]) -> None:
+        """
+        Sentence targets become an (N, sentence_labels) array. Word targets become (N, word_labels, word_seq_length)
+        and phone targets (N, phone_labels, phoneme_seq_length), truncated or padded with -1, the value the
+        speech losses mask out. All of them are normalized once here so items only index into them.
+        """
+        # column access, so the audio column is not decoded just to read the scores
+        self.targets_sentence = pd.DataFrame({t: self.data[t] for t in target_cols_sentence}, columns=target_cols_sentence)
+        self.targets_words, self.targets_phones = None, None
+        if (len(target_cols_words) > 0) | (len(target_cols_phones) > 0):
+            (word_scores, word_counts), (phone_scores, phone_counts) = self.compute_subtargets(target_cols_words, target_cols_phones)
+            if len(target_cols_words) > 0:
+                self.targets_words = word_scores, word_counts
+            if len(target_cols_phones) > 0:
+                self.targets_phones = phone_scores, phone_counts
+        self.normalize_targets()
+        self.sentence_array = self.targets_sentence.to_numpy()
+        if self.targets_words is not None:
+            self.targets_words = pad_ragged(*self.targets_words, self.word_seq_length)
+        if self.targets_phones is not None:
+            self.targets_phones = pad_ragged(*self.targets_phones, self.phoneme_seq_length)
+    
+    def compute_subtargets(self, target_cols_words: Sequence[str], target_cols_phones: Sequence[str]) -> Tuple[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+        # flat (labels, total_words) and (labels, total_phones) score arrays with per-utterance word and phone counts;
+        # the phones of an utterance are those of its words in order
+        utterances = self.data['words']
+        words = [word for person_words in utterances for word in person_words]
+        word_counts = np.array([len(person_words) for person_words in utterances])
+        word_scores = np.array([[word[w] for word in words] for w in target_cols_words], dtype=np.float64).reshape(len(target_cols_words), -1)
+        phone_scores, phone_counts = np.zeros((0, 0)), np.zeros(len(utterances), dtype=np.int64)
+        if len(target_cols_phones) > 0:
+            phone_scores = np.array([[score for word in words for score in word[p]] for p in target_cols_phones], dtype=np.float64)
+            word_phone_counts = np.array([len(word[target_cols_phones[0]]) for word in words])
+            phone_counts = np.bincount(np.repeat(np.arange(len(utterances)), word_counts), weights=word_phone_counts,
+                                       minlength=len(utterances)).astype(np.int64)
+        return (word_scores, word_counts), (phone_scores, phone_counts)
+
+    def normalize_targets(self, normalize_score: float = 100.0) -> None:
+        # normalize the sentence targets
+        self.targets_sentence = (self.targets_sentence) / self.targets_sentence.max(axis=0) * normalize_score
+        # word and phone scores are scaled per label by their maximum over every (untruncated) word or phone
+        for name in ('targets_words', 'targets_phones'):
+            if getattr(self, name) is not None:
+                scores, counts = getattr(self, name)
+                setattr(self, name, (scores / scores.max(axis=1, keepdims=True) * normalize_score, counts))
+
+    def extract(self, audio: List[np.ndarray]) -> List[np.ndarray]:
+        # features for a batch of raw clips, one array per clip
+        features = self.tokenizer(audio, **self.tokenizer_params)
+        features = features['input_features'] if ('input_features' in features) else features['input_values']
+        return [np.asarray(f) for f in features]
+
+    def trim(self, clips: List[np.ndarray]) -> Tuple[List[np.ndarray], np.ndarray]:
+        # trimmed clips and their (start, end) sample offsets in the original clips
+        offsets = np.array([silence_bounds(clip, self.tokenizer.sampling_rate, **self.vad_params) for clip in clips],
+                           dtype=np.int64).reshape(-1, 2)
+        return [clip[start:end] for clip, (start, end) in zip(clips, offsets)], offsets
+
+    def load_clips(self, load: Callable[[int, int], List[np.ndarray]], start: int, end: int) -> List[np.ndarray]:
+        clips = load(start, end)
+        return clips if self.vad_params is None else self.trim(clips)[0]
+
+    def load_audio(self, start: int, end: int) -> List[np.ndarray]:
+        # slicing decodes only these rows
+        return [x['array'] for x in self.data[start:end][self.input_col]]
+
+    def load_reference_audio(self, start: int, end: int) -> List[np.ndarray]:
+        rows = self.reference_data.select(range(start, end)).to_pandas().to_numpy()
+        return [np.trim_zeros(row, trim='b') for row in rows]
+
+    def get_lengths(self) -> np.ndarray:
+        # samples per clip after truncation, used to bucket clips of similar length together
+        if self.input_lengths is not None:
+            return self.input_lengths
+        lengths = []
+        for start in range(0, len(self.data), 64):
+            lengths.extend(len(audio) for audio in self.load_clips(self.load_audio, start, min(start + 64, len(self.data))))
+        lengths = np.array(lengths)
+        max_length = self.tokenizer_params.get('max_length')
+        return lengths if max_length is None else np.minimum(lengths, max_length)
+
+    def get_inputs(self, indices: Sequence[int]) -> List[np.ndarray]:
+        if self.inputs is not None:
+            return cached_rows(self.inputs, self.input_lengths, indices)
+        return self.extract([self.load_clips(self.load_audio, int(i), int(i) + 1)[0] for i in indices])
+
+    def get_trim_offsets(self, indices: Sequence[int]) -> np.ndarray:
+        """
+        (len(indices), 2) start and end, in samples of the original clip, of the audio the model sees for each item.
+        Frame f of the encoder output then starts at sample start + f * (the encoder's total conv stride, 320 for
+        wav2vec2), which maps frame-level (word/phone) outputs back onto the untrimmed recording.
+        """
+        if self.input_offsets is not None:
+            return self.input_offsets[list(indices)]
+        clips = [self.load_audio(int(i), int(i) + 1)[0] for i in indices]
+        if self.vad_params is None:
+            return np.array([[0, len(clip)] for clip in clips], dtype=np.int64).reshape(-1, 2)
+        return self.trim(clips)[1]
+
+    def set_reference_embeddings(self, features: np.ndarray, offsets: np.ndarray, rows: np.ndarray) -> None:
+        # item i gets features[offsets[rows[i]]:offsets[rows[i] + 1]], the encoded reference speech of its prompt
+        self.reference_embeddings = (features, offsets, rows)
+
+    def get_correct_speech(self, indices: Sequence[int]) -> Sequence[Any]:
+        if self.reference_data is None:
+            return [5 for _ in indices]
+        if self.reference_embeddings is not None:
+            features, offsets, rows = self.reference_embeddings
+            return [features[offsets[rows[i]]:offsets[rows[i] + 1]].astype(np.float32) for i in indices]
+        if self.correct_speech is not None:
+            return cached_rows(self.correct_speech, self.correct_speech_lengths, indices)
+        return self.extract([self.load_clips(self.load_reference_audio, int(i), int(i) + 1)[0] for i in indices])
+
+    def get_targets(self, index: Any) -> Tuple[Any, Any, Any]:
+        words_output = None if self.targets_words is None else torch.from_numpy(self.targets_words[index])
+        phones_output = None if self.targets_phones is None else torch.from_numpy(self.targets_phones[index])
+        return self.sentence_array[index], words_output, phones_output
+
+    def make_item(self, index: Any, inputs: np.ndarray, correct_speech: Any) -> T_co:
+        sentence_output, words_output, phones_output = self.get_targets(index)
+        if (phones_output is None) and (words_output is None):
+            return inputs, [sentence_output, correct_speech]
+        return inputs, [sentence_output, words_output, phones_output, correct_speech]
+
+    def __getitem__(self, index: Any) -> T_co:
+        return self.make_item(index, self.get_inputs([index])[0], self.get_correct_speech([index])[0])
+
+    def __getitems__(self, indices: Sequence[int]) -> List[T_co]:
+        # one feature-extractor call for the whole batch
+        indices = list(indices)
+        inputs, correct_speech = self.get_inputs(indices), self.get_correct_speech(indices)
+        return [self.make_item(index, inputs[row], correct_speech[row]) for row, index in enumerate(indices)]
+
+    def __len__(self) -> int:
+        return len(self.data)
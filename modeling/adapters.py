@@ -0,0 +1,99 @@
+"""
+Low-rank adapters (LoRA) for the `l1` encoder. apply_lora freezes the encoder and adds a trainable low-rank
+update to its attention query/value projections, so only the adapters and the model's head are trained (and
+held in the optimizer). Checkpoints of such a model hold only those weights plus the LoRA settings in the
+architecture: build_model puts them back on top of the pretrained encoder, and load_adapters swaps another
+tuned model's adapters and head into an already built one without touching the encoder.
+"""
+
+import math
+from typing import Any, Dict, Sequence
+
+import torch
+
+# DistilBERT/BERT-style (q_lin, v_lin) and wav2vec2/RoBERTa-style (q_proj, v_proj) attention projections
+DEFAULT_TARGETS = ["q_lin", "v_lin", "q_proj", "v_proj"]
+
+class LoRALinear(torch.nn.Linear):
+    """
+    A frozen nn.Linear plus a trainable update scaling * B @ A of rank r. B starts at zero, so the layer starts out
+    computing exactly what the original did. weight and bias keep their names, so the state dict keys of the
+    encoder's own weights do not change.
+    """
+    def __init__(self, linear: torch.nn.Linear, r: int, alpha: float, dropout: float = 0.0):
+        torch.nn.Module.__init__(self)
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        self.weight, self.bias = linear.weight, linear.bias
+        self.weight.requires_grad = False
+        if self.bias is not None:
+            self.bias.requires_grad = False
+        self.r, self.scaling = r, alpha / r
+        self.lora_A = torch.nn.Parameter(torch.empty(r, self.in_features, device=self.weight.device, dtype=self.weight.dtype))
+        self.lora_B = torch.nn.Parameter(torch.zeros(self.out_features, r, device=self.weight.device, dtype=self.weight.dtype))
+        torch.nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = torch.nn.Dropout(dropout)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return super().forward(x) + (self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+def apply_lora(model: torch.nn.Module, r: int = 8, alpha: float = 16, dropout: float = 0.0,
+               targets: Sequence[str] = DEFAULT_TARGETS, base_params: str = None) -> torch.nn.Module:
+    """
+    Freeze model.l1 and wrap its nn.Linear layers named in `targets` in LoRALinear. The settings are added to
+    model.architecture['lora'], so build_model rebuilds the same model from a checkpoint; base_params records a
+    checkpoint the encoder weights came from when they are not the pretrained ones (e.g. after run.py pretrain).
+    Returns the model.
+    """
+    encoder = model.l1
+    for param in encoder.parameters():
+        param.requires_grad = False
+    if hasattr(encoder, 'freeze_feature_encoder'):
+        # wav2vec2-style: otherwise the convolutional feature encoder still runs its backward every step
+        encoder.freeze_feature_encoder()
+    targets = list(targets)
+    replaced = 0
+    for name, module in list(encoder.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if child_name in targets and type(child) == torch.nn.Linear:
+                setattr(module, child_name, LoRALinear(child, r, alpha, dropout))
+                replaced += 1
+    if replaced == 0:
+        raise ValueError(f"No linear layers named {targets} in {type(encoder).__name__}")
+    if hasattr(model, 'architecture'):
+        model.architecture['lora'] = {'r': r, 'alpha': alpha, 'dropout': dropout, 'targets': targets}
+        if base_params is not None:
+            model.architecture['lora']['base_params'] = base_params
+    return model
+
+def has_lora(model: torch.nn.Module) -> bool:
+    model = model.module if hasattr(model, "module") else model
+    return 'lora' in getattr(model, 'architecture', {})
+
+def is_trainable_key(key: str) -> bool:
+    # everything outside the encoder (the head) and the encoder's adapters
+    return not key.startswith('l1.') or 'lora_' in key
+
+def trainable_state_dict(model: torch.nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    What a checkpoint of `model` needs: the adapters and the head for a LoRA model, everything otherwise.
+    """
+    model = model.module if hasattr(model, "module") else model
+    state_dict = model.state_dict()
+    if not has_lora(model):
+        return state_dict
+    return {k: v for k, v in state_dict.items() if is_trainable_key(k)}
+
+def load_adapters(model: torch.nn.Module, state_dict: Dict[str, torch.Tensor]) -> Any:
+    """
+    Load a trainable_state_dict into `model`. For a LoRA model only the adapters and head are replaced and the
+    (shared) encoder weights stay as they are; anything else missing or left over is an error, as with strict
+    loading.
+    """
+    model = model.module if hasattr(model, "module") else model
+    if not has_lora(model):
+        return model.load_state_dict(state_dict)
+    result = model.load_state_dict(state_dict, strict=False)
+    missing = [k for k in result.missing_keys if is_trainable_key(k)]
+    if missing or result.unexpected_keys:
+        raise RuntimeError(f"Adapter checkpoint does not match the model: missing {missing}, unexpected {result.unexpected_keys}")
+    return result
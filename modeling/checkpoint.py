@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from modeling.adapters import trainable_state_dict
+
+SAFETENSORS_SUFFIX = ".safetensors"
+
+# header fields stored as plain strings so they can be read without touching the tensors
+METADATA_FIELDS = ["model_class", "num_outputs", "seq_length", "tokenizer_name"]
+
+def is_safetensors(path: str) -> bool:
+    return str(path).endswith(SAFETENSORS_SUFFIX)
+
+def checkpoint_metadata(architecture: Dict[str, Any], tokenizer_name: str = None) -> Dict[str, str]:
+    metadata = {'architecture': json.dumps(architecture)}
+    fields = {**architecture, 'tokenizer_name': tokenizer_name or architecture.get('pretrain_model_name')}
+    for field in METADATA_FIELDS:
+        if fields.get(field) is not None:
+            metadata[field] = str(fields[field])
+    return metadata
+
+def save_state_dict(state_dict: Dict[str, torch.Tensor], path: str, architecture: Dict[str, Any] = None,
+                    tokenizer_name: str = None) -> None:
+    if not is_safetensors(path):
+        # torch.save checkpoints keep their descriptor next to the weights; plain state dicts are still read
+        torch.save(state_dict if architecture is None else {'architecture': architecture, 'state_dict': state_dict}, path)
+        return
+    metadata = checkpoint_metadata(architecture, tokenizer_name) if architecture is not None else None
+    save_file({k: v.detach().cpu().contiguous() for k, v in state_dict.items()}, path, metadata=metadata)
+
+def save_params(model: torch.nn.Module, path: str, tokenizer_name: str = None) -> None:
+    """
+    Save the weights of `model` to `path` together with its architecture, so the checkpoint can be rebuilt with
+    modeling.model.build_model. A path ending in .safetensors gets the memory-mappable format with the
+    architecture in its header; any other path is written with torch.save. Models with LoRA adapters only save
+    the adapters and the head.
+    """
+    model = model.module if hasattr(model, "module") else model
+    save_state_dict(trainable_state_dict(model), path, getattr(model, 'architecture', None), tokenizer_name)
+
+def load_checkpoint(path: str, device: Any = 'cpu') -> Tuple[Dict[str, torch.Tensor], Optional[Dict[str, Any]]]:
+    """
+    Returns (state_dict, architecture); architecture is None for checkpoints saved without one.
+    """
+    if is_safetensors(path):
+        # mmapped: tensors are backed by the page cache until load_state_dict copies them in
+        metadata = read_metadata(path) or {}
+        architecture = json.loads(metadata['architecture']) if 'architecture' in metadata else None
+        return load_file(path, device=str(device)), architecture
+    checkpoint = torch.load(path, map_location=device)
+    if isinstance(checkpoint, dict) and set(checkpoint.keys()) == {'architecture', 'state_dict'}:
+        return checkpoint['state_dict'], checkpoint['architecture']
+    return checkpoint, None
+
+def load_params(path: str, device: Any = 'cpu') -> Dict[str, torch.Tensor]:
+    return load_checkpoint(path, device)[0]
+
+def read_metadata(path: str) -> Optional[Dict[str, str]]:
+    # only the header is read; torch.save checkpoints have no header
+    if not is_safetensors(path):
+        return None
+    with safe_open(path, framework="pt") as f:
+        return f.metadata()
+
+def convert(src: str, dst: str, architecture: Dict[str, Any] = None, tokenizer_name: str = None) -> None:
+    state_dict, saved_architecture = load_checkpoint(src)
+    architecture = architecture or saved_architecture
+    if architecture is None:
+        raise ValueError(f"{src} does not record its architecture; pass --model_class and --num_outputs")
+    tmp_path = f"{dst}.{os.getpid()}.tmp{SAFETENSORS_SUFFIX}"
+    save_state_dict(state_dict, tmp_path, architecture, tokenizer_name)
+    os.replace(tmp_path, dst)
+
+def to_cpu(obj: Any) -> Any:
+    # copy of every tensor in a (nested) state dict, on the CPU, so training can keep updating the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def replace_atomically(write: Callable[[str], None], path: str) -> None:
+    # write to a temporary file next to `path` (same suffix, so the format is picked the same way), then rename
+    root, suffix = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints from a background thread so training does not wait for the disk. save_* copies the
+    state to CPU memory on the calling thread (the only part training waits for) and hands the write to a
+    thread that renames the finished file into place, so a crash never leaves a partial checkpoint. At most one
+    write is in flight: a new save first waits for the previous one, which bounds the extra memory to one
+    snapshot. Errors from the writer are raised by the next save or wait.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def submit(self, job: Callable[[], None]) -> None:
+        self.wait()
+        def run():
+            try:
+                job()
+            except BaseException as e:
+                self.error = e
+        self.thread = threading.Thread(target=run, name="checkpoint-writer")
+        self.thread.start()
+
+    def wait(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save_params(self, model: torch.nn.Module, path: str, tokenizer_name: str = None) -> None:
+        # asynchronous save_params
+        model = model.module if hasattr(model, "module") else model
+        self.save_state_dict(trainable_state_dict(model), path, getattr(model, 'architecture', None), tokenizer_name)
+
+    def save_state_dict(self, state_dict: Dict[str, torch.Tensor], path: str, architecture: Dict[str, Any] = None,
+                        tokenizer_name: str = None) -> None:
+        # asynchronous save_state_dict
+        state_dict = to_cpu(state_dict)
+        self.submit(lambda: replace_atomically(lambda tmp: save_state_dict(state_dict, tmp, architecture, tokenizer_name), path))
+
+    def save(self, state: Dict[str, Any], path: str, params_path: str = None, tokenizer_name: str = None,
+             architecture: Dict[str, Any] = None) -> None:
+        """
+        torch.save `state` (snapshotted to CPU) to `path`; with `params_path`, state['model'] is also written there
+        as a plain parameter checkpoint, from the same snapshot.
+        """
+        state = to_cpu(state)
+        def job():
+            if params_path is not None:
+                replace_atomically(lambda tmp: save_state_dict(state['model'], tmp, architecture, tokenizer_name), params_path)
+            replace_atomically(lambda tmp: torch.save(state, tmp), path)
+        self.submit(job)
+
+if __name__ == '__main__':
+    # e.g. python -m modeling.checkpoint expt/params.pt expt/params.safetensors --model_class BaseModel --num_outputs 6
+    argp = argparse.ArgumentParser(description="Convert a torch.save checkpoint (.params/.pt) to .safetensors")
+    argp.add_argument('src')
+    argp.add_argument('dst')
+    argp.add_argument('--model_class', default=None, help="Needed for checkpoints that do not record their architecture")
+    argp.add_argument('--num_outputs', type=int, default=None)
+    argp.add_argument('--seq_length', type=int, default=None)
+    argp.add_argument('--pretrain_model_name', default="distilbert-base-uncased")
+    argp.add_argument('--tokenizer_name', default=None)
+    argp.add_argument('--extra', default="{}", help="JSON of any other constructor arguments, e.g. '{\"pooling\": \"cls\"}'")
+    args = argp.parse_args()
+    if not is_safetensors(args.dst):
+        argp.error(f"dst must end in {SAFETENSORS_SUFFIX}")
+
+    architecture = None
+    if args.model_class is not None:
+        if args.num_outputs is None:
+            argp.error("--model_class needs --num_outputs")
+        architecture = {'model_class': args.model_class, 'num_outputs': args.num_outputs,
+                        'pretrain_model_name': args.pretrain_model_name}
+        if args.seq_length is not None:
+            architecture['seq_length'] = args.seq_length
+        architecture.update(json.loads(args.extra))
+    convert(args.src, args.dst, architecture, args.tokenizer_name)
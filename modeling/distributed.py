@@ -0,0 +1,61 @@
+"""
+Multi-process (DistributedDataParallel) training helpers. Scripts are launched with torchrun, e.g.
+
+    torchrun --nproc_per_node 4 run.py finetune --model_type pooled-mean ...
+
+which sets RANK/WORLD_SIZE/LOCAL_RANK for every process. Without those variables everything here reports a
+single process, so the same scripts keep running unchanged.
+"""
+
+import os
+from typing import Any
+
+import torch
+import torch.distributed as dist
+
+def init_distributed(backend: str = None) -> bool:
+    # gloo runs on CPU-only machines; nccl is the default when every process has its own GPU
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        backend = backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+        dist.init_process_group(backend=backend)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank())
+    else:
+        # otherwise every process starts one intra-op thread per core and they all fight over the same cores
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', get_world_size()))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return True
+
+def cleanup_distributed() -> None:
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+def distributed_device() -> Any:
+    return local_rank() if torch.cuda.is_available() else 'cpu'
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    # in place on every process; a no-op for single-process runs
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
@@ -0,0 +1,152 @@
+"""
+Batched scoring for the text models: one forward pass per large batch instead of one per essay,
+with outputs kept on the device until the end and returned in the dataset's original row order.
+Streaming scoring for SpeechModel: long recordings are read in chunks and scored as overlapping windows.
+"""
+
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+import torch
+
+from data_loading.dataloaders import batched_loader, dataset_lengths, pad_audio, pad_collate
+from modeling.precision import autocast, check_precision
+
+# samples the flattened (pooling=None) speech head was built for; SpeechDataset pads and truncates clips to this
+FIXED_SPEECH_LENGTH = 100000
+
+def predict(model: torch.nn.Module, dataset: torch.utils.data.Dataset, batch_size: int = 64, device: Any = 'cpu',
+            dynamic_padding: bool = False, pad_token_id: int = 0, num_workers: int = 0,
+            precision: str = "fp32") -> List[Tuple[float, float]]:
+    """
+    Score every row of `dataset` and return (mean prediction, mean target) per row, the same pairs the
+    old batch_size=1 loops produced, in the dataset's order. With `dynamic_padding` (pooled models only)
+    rows are scored longest-first in length-sorted batches padded to their longest member. Models whose head
+    mixes the rows of a batch (mixes_rows, e.g. BaseModel) are always scored with batch_size=1. `precision` is
+    one of modeling.precision.PRECISIONS.
+    """
+    check_precision(precision, device)
+    if getattr(model.module if hasattr(model, "module") else model, 'mixes_rows', False):
+        batch_size = 1
+    if dynamic_padding:
+        order = np.argsort(-dataset_lengths(dataset), kind='stable')
+        collate_fn = partial(pad_collate, pad_token_id=pad_token_id)
+    else:
+        order = np.arange(len(dataset))
+        collate_fn = None
+    batches = [order[start:start + batch_size].tolist() for start in range(0, len(order), batch_size)]
+    loader = batched_loader(dataset, batches, collate_fn=collate_fn, num_workers=num_workers)
+
+    model.eval()
+    outputs, targets = [], []
+    with torch.inference_mode(), autocast(precision, device):
+        for x, y in loader:
+            x = x.to(device)
+            output = model(x, eval_output=True)[0]
+            # stays on the device; a single transfer happens after the loop
+            outputs.append(output.float().reshape(output.shape[0], -1).mean(dim=1))
+            targets.append(y.float().reshape(y.shape[0], -1).mean(dim=1))
+    scores = np.empty(len(order))
+    actual = np.empty(len(order))
+    if len(order) > 0:
+        scores[order] = torch.cat(outputs).cpu().numpy()
+        actual[order] = torch.cat(targets).numpy()
+    return list(zip(scores.tolist(), actual.tolist()))
+
+def read_chunks(path: str, sampling_rate: int, chunk_s: float = 10.0) -> Iterator[np.ndarray]:
+    # mono float32 blocks of an audio file, read lazily; soundfile is only needed for streaming, so it is imported here
+    import soundfile
+    if soundfile.info(path).samplerate != sampling_rate:
+        raise ValueError(f"{path} is not sampled at {sampling_rate} Hz; resample it first")
+    for block in soundfile.blocks(path, blocksize=int(chunk_s * sampling_rate), dtype='float32', always_2d=True):
+        yield block.mean(axis=1)
+
+def audio_windows(chunks: Iterable[np.ndarray], window: int, hop: int) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    (start sample, samples) of windows `window` samples long every `hop` samples over a stream of audio chunks. At
+    most one window plus one chunk is held in memory. The last window ends with the stream, so no audio is dropped;
+    a stream shorter than `window` is a single, shorter window.
+    """
+    buffer, buffer_start, next_start, covered = np.zeros(0, dtype=np.float32), 0, 0, 0
+    for chunk in chunks:
+        buffer = np.concatenate([buffer, np.asarray(chunk, dtype=np.float32)])
+        while buffer_start + len(buffer) >= next_start + window:
+            yield next_start, buffer[next_start - buffer_start:next_start - buffer_start + window]
+            covered = next_start + window
+            next_start += hop
+        # keep what the next window, or an end-aligned last window, may still need
+        keep_from = min(next_start, max(buffer_start + len(buffer) - window, 0))
+        buffer, buffer_start = buffer[keep_from - buffer_start:], keep_from
+    end = buffer_start + len(buffer)
+    if end > covered:
+        start = max(end - window, 0)
+        yield start, buffer[start - buffer_start:]
+
+def score_windows(model: torch.nn.Module, windows: List[np.ndarray], feature_extractor: Any, device: Any,
+                  one_output: bool) -> Tuple[torch.Tensor, Any, Any]:
+    sampling_rate = feature_extractor.sampling_rate
+    if model.pooling is None:
+        # the flattened head only takes clips padded to the length it was trained on
+        x = feature_extractor(windows, sampling_rate=sampling_rate, padding='max_length', max_length=FIXED_SPEECH_LENGTH,
+                              truncation=True, return_tensors='pt')['input_values']
+    else:
+        x = pad_audio(feature_extractor(windows, sampling_rate=sampling_rate)['input_values'])
+    return model(x.to(device), one_output=one_output)[0]
+
+def stream_score(model: torch.nn.Module, chunks: Iterable[np.ndarray], feature_extractor: Any, window_s: float = 6.0,
+                 overlap_s: float = 1.0, batch_size: int = 8, device: Any = 'cpu', one_output: bool = False,
+                 precision: str = "fp32") -> Dict[str, Any]:
+    """
+    Score a recording of any length with a SpeechModel by encoding overlapping `window_s` windows, `batch_size` at a
+    time, so memory does not grow with the length of the recording. Returns
+    - 'sentence': (num_outputs,) window scores averaged with each window weighted by its length in samples,
+    - 'window_sentence': (n_windows, num_outputs) scores of each window,
+    - 'windows': (n_windows, 2) start and end sample of each window,
+    - 'words' / 'phones': (word_outputs, n_windows * word_seq_length) and (n_windows * phoneme_seq_length,), the
+      per-window outputs stitched in window order (None with `one_output`). The heads predict word and phone slots
+      by position within their window, not by time, so slot j of window k belongs to windows[k].
+    """
+    model = model.module if hasattr(model, "module") else model
+    sampling_rate = feature_extractor.sampling_rate
+    window = int(window_s * sampling_rate)
+    hop = window - int(overlap_s * sampling_rate)
+    if hop <= 0:
+        raise ValueError("overlap_s must be shorter than window_s")
+    if model.pooling is None and window > FIXED_SPEECH_LENGTH:
+        raise ValueError(f"the flattened speech head scores windows of at most {FIXED_SPEECH_LENGTH} samples; "
+                         f"use a shorter window_s or a pooled model")
+
+    check_precision(precision, device)
+    model.eval()
+    bounds, sentence, words, phones = [], [], [], []
+    def flush(batch: List[np.ndarray]) -> None:
+        output, word_output, phoneme_output = score_windows(model, batch, feature_extractor, device, one_output)
+        sentence.append(output.float().cpu())
+        if not one_output:
+            words.append(word_output.float().reshape(len(batch), model.word_outputs, model.word_seq_length).cpu())
+            phones.append(phoneme_output.float().reshape(len(batch), model.phoneme_seq_length).cpu())
+
+    batch = []
+    with torch.inference_mode(), autocast(precision, device):
+        for start, samples in audio_windows(chunks, window, hop):
+            bounds.append((start, start + len(samples)))
+            batch.append(samples)
+            if len(batch) == batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    if not bounds:
+        raise ValueError("no audio to score")
+
+    bounds = np.array(bounds)
+    window_sentence = torch.cat(sentence).numpy()
+    weights = (bounds[:, 1] - bounds[:, 0]).astype(np.float64)
+    return {
+        'sentence': (window_sentence * weights[:, None]).sum(axis=0) / weights.sum(),
+        'window_sentence': window_sentence,
+        'windows': bounds,
+        'words': None if one_output else torch.cat(words).permute(1, 0, 2).reshape(model.word_outputs, -1).numpy(),
+        'phones': None if one_output else torch.cat(phones).reshape(-1).numpy(),
+    }
@@ -1,14 +1,83 @@
 import torch
 import torch.nn as nn
-from transformers import AutoModel
+from transformers import AutoModel, AutoConfig
+from transformers.modeling_utils import no_init_weights
 from torch.nn import functional as F
-from typing import Any
+from typing import Any, Dict, Optional, Tuple
+
+from modeling.adapters import apply_lora, has_lora, load_adapters
+from modeling.checkpoint import load_params
+
+def load_encoder(pretrain_model_name: str, load_pretrained: bool = True) -> torch.nn.Module:
+    # with load_pretrained=False only the config is read: use it when a full checkpoint is restored right after
+    if load_pretrained:
+        return AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+    config = AutoConfig.from_pretrained(pretrain_model_name, trust_remote_code=True)
+    with no_init_weights():
+        return AutoModel.from_config(config, trust_remote_code=True)
+
+def has_encoder_weights(state_dict: Dict[str, torch.Tensor]) -> bool:
+    # a checkpoint that holds the encoder makes reading the pretrained weights first redundant; LoRA adapters
+    # (modeling/adapters.py) are not the encoder and still need it underneath
+    return any(k.startswith('l1.') and 'lora_' not in k for k in state_dict)
+
+def restore_params(model: torch.nn.Module, state_dict: Dict[str, torch.Tensor], strict: bool = True,
+                   load_pretrained: bool = True) -> Any:
+    if strict and has_lora(model):
+        # LoRA checkpoints hold only the adapters and head; the encoder weights underneath stay as built
+        return load_adapters(model, state_dict)
+    result = model.load_state_dict(state_dict, strict=strict)
+    missing = [k for k in result.missing_keys if k.startswith('l1.')]
+    if missing and not load_pretrained:
+        raise ValueError(f"Checkpoint is missing encoder weights ({missing[0]}, ...) but the encoder was built without pretrained weights")
+    return result
+
+def enable_gradient_checkpointing(model: torch.nn.Module) -> bool:
+    """
+    Recompute the activations of the model's `l1` encoder layer by layer during backward instead of keeping them
+    from the forward pass: much less activation memory (so larger batches fit) for roughly one more forward pass
+    of compute. Only applies in train mode. Returns False when there is nothing to checkpoint: no encoder, one
+    without checkpointing support, or a completely frozen one.
+    """
+    encoder = getattr(model, 'l1', None)
+    if encoder is None or not getattr(encoder, 'supports_gradient_checkpointing', False):
+        return False
+    if not any(p.requires_grad for p in encoder.parameters()):
+        return False
+    encoder.gradient_checkpointing_enable()
+    # the checkpointed layers only get gradients when their input requires grad, which it no longer does once the
+    # embeddings are frozen (e.g. run_tuning's freezing); wav2vec2-style encoders have no input embeddings to hook
+    embeddings = None
+    try:
+        embeddings = encoder.get_input_embeddings()
+    except NotImplementedError:
+        pass
+    # the hook handles are kept on the modules, so calling this again does not stack another hook
+    if embeddings is not None and not any(p.requires_grad for p in embeddings.parameters()):
+        if not hasattr(encoder, '_require_grads_hook'):
+            encoder.enable_input_require_grads()
+    elif embeddings is None and hasattr(encoder, 'feature_projection') and not any(p.requires_grad for p in encoder.feature_projection.parameters()):
+        # wav2vec2-style with a frozen front end (e.g. under LoRA): the same for the transformer layers' input
+        if not hasattr(encoder.encoder, '_require_grads_hook'):
+            encoder.encoder._require_grads_hook = encoder.encoder.register_forward_pre_hook(
+                lambda module, args: (args[0].requires_grad_(True), *args[1:]))
+    return True
+
+def architecture(model: torch.nn.Module, **kwargs: Any) -> Dict[str, Any]:
+    # constructor arguments, saved alongside the weights so a checkpoint can describe the model it belongs to
+    return {'model_class': type(model).__name__, **kwargs}
 
 class BaseModel(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    # the conv runs over the (seq_length, batch) transpose, i.e. along the batch axis, so an essay's output depends
+    # on the essays next to it in the batch; modeling.inference.predict scores such models one essay at a time
+    mixes_rows = True
+
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(BaseModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, self.seq_length)
         self.conv = torch.nn.Conv1d(in_channels=self.seq_length, out_channels=self.seq_length, kernel_size=3, padding="same")
@@ -31,10 +100,12 @@ class BaseModel(torch.nn.Module):
         return output, loss
 
 class BaseDevModel(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(BaseDevModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, self.seq_length)
         self.l4 = torch.nn.ReLU()
@@ -53,10 +124,12 @@ class BaseDevModel(torch.nn.Module):
         return output, loss
 
 class BaseModelOG(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(BaseModelOG, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, num_outputs)
     
@@ -72,10 +145,12 @@ class BaseModelOG(torch.nn.Module):
         return output, loss
 
 class ETSModel(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(ETSModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, self.seq_length)
         self.relu_layer = torch.nn.ReLU()
@@ -98,10 +173,12 @@ class ETSModel(torch.nn.Module):
 
 
 class HierarchicalModel(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(HierarchicalModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, num_outputs - 1)
         self.l4 = torch.nn.Linear(num_outputs - 1, 1)
@@ -122,10 +199,12 @@ class HierarchicalModel(torch.nn.Module):
         return output, loss
     
 class MultitaskModel(torch.nn.Module):
-    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str):
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, load_pretrained: bool = True):
         super(MultitaskModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name)
         self.seq_length = seq_length
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
         self.l2 = torch.nn.Dropout(0.3)
         self.l3 = torch.nn.Linear(self.seq_length*768, self.seq_length)
         self.l4 = torch.nn.Dropout(0.3)
@@ -136,9 +215,8 @@ class MultitaskModel(torch.nn.Module):
         x2 = self.l2(x1['last_hidden_state'].reshape(-1, self.seq_length*768))
         x3 = self.l3(x2)
         x4 = self.l4(x3)
+        # eval_output keeps one row of outputs per essay (output[-1] only picked that row for a batch of one)
         output = self.l5(x4)
-        if eval_output:
-            output = output[-1]
         loss = None
         if targets is not None:
             loss = nn.MSELoss()(
@@ -147,16 +225,120 @@ class MultitaskModel(torch.nn.Module):
         return output, loss
 
 
+POOLING_TYPES = ["mean", "cls", "attention"]
+
+def masked_mean(hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    # average over the non-padding positions only, so the result does not depend on how far a batch was padded
+    mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+    return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+class PooledModel(torch.nn.Module):
+    """
+    Regression head on a pooled `last_hidden_state` instead of the flattened seq_length*768 one,
+    so it accepts batches padded to any length (e.g. dynamically padded batches) and the head stays small.
+    pooling is one of "mean" (masked average), "cls" (first token) or "attention" (learned token weights).
+    """
+    def __init__(self, seq_length: int, num_outputs: int, pretrain_model_name: str, pooling: str = "mean",
+                 load_pretrained: bool = True):
+        super(PooledModel, self).__init__()
+        self.architecture = architecture(self, seq_length=seq_length, num_outputs=num_outputs,
+                                         pretrain_model_name=pretrain_model_name, pooling=pooling)
+        if pooling not in POOLING_TYPES:
+            raise ValueError(f"Invalid pooling: {pooling}")
+        self.seq_length = seq_length
+        self.pooling = pooling
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
+        hidden_size = self.l1.config.hidden_size
+        self.l2 = torch.nn.Dropout(0.3)
+        self.l3 = torch.nn.Linear(hidden_size, hidden_size)
+        self.l4 = torch.nn.ReLU()
+        self.l5 = torch.nn.Dropout(0.3)
+        self.l6 = torch.nn.Linear(hidden_size, num_outputs)
+        if pooling == "attention":
+            self.attention = torch.nn.Linear(hidden_size, 1)
+
+    def pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        if self.pooling == "cls":
+            return hidden_states[:, 0]
+        if self.pooling == "attention":
+            scores = self.attention(hidden_states).squeeze(-1)
+            scores = scores.masked_fill(attention_mask == 0, torch.finfo(scores.dtype).min)
+            weights = torch.softmax(scores, dim=1).unsqueeze(-1)
+            return (weights * hidden_states).sum(dim=1)
+        return masked_mean(hidden_states, attention_mask)
+
+    def forward(self, data: Any, targets: Any = None, eval_output: bool = False, **kwargs):
+        # data may also hold cached encoder outputs (see data_loading/feature_cache.py), which skip self.l1
+        if 'pooled' in data:
+            pooled = data['pooled'].squeeze(1)
+        else:
+            attention_mask = data['attention_mask'].squeeze(1)
+            if 'last_hidden_state' in data:
+                hidden_states = data['last_hidden_state'].squeeze(1)
+            else:
+                hidden_states = self.l1(input_ids=data['input_ids'].squeeze(1), attention_mask=attention_mask)['last_hidden_state']
+            pooled = self.pool(hidden_states, attention_mask)
+        output_2 = self.l2(pooled)
+        output_3 = self.l4(self.l3(output_2))
+        output = self.l6(self.l5(output_3))
+        # if we are given some desired targets also calculate the loss
+        loss = None
+        if targets is not None:
+            loss = nn.MSELoss()(output.float(), targets.float())
+        return output, loss
+
+
+SPEECH_POOLING_TYPES = [None, "mean"]
+
+def encode_audio(encoder: torch.nn.Module, data: Any) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Run a wav2vec2-style encoder over a batch of audio: either a (B, T) tensor padded to a fixed length, or a
+    BatchFeature with `input_values` and `attention_mask` padded to the longest clip (pad_audio_collate).
+    Precomputed hidden states, a (B, frames, hidden_size) tensor or a BatchFeature with `last_hidden_state`,
+    are passed through without running the encoder.
+    Returns last_hidden_state and a (B, frames) mask of the frames that come from real audio (None if unpadded).
+    """
+    if isinstance(data, torch.Tensor):
+        if data.dim() == 3:
+            # already encoded: (B, frames, hidden_size), e.g. cached reference embeddings
+            return data, None
+        return encoder(data)['last_hidden_state'], None
+    if 'last_hidden_state' in data:
+        return data['last_hidden_state'], data.get('attention_mask')
+    attention_mask = data.get('attention_mask')
+    # encoders with a group-norm feature extractor (e.g. wav2vec2-base) were trained on zero padding without a
+    # mask and should not be given one; the mask is still used for pooling
+    pass_mask = attention_mask is not None and getattr(encoder.config, 'feat_extract_norm', 'layer') == 'layer'
+    hidden_states = encoder(data['input_values'], attention_mask=attention_mask if pass_mask else None)['last_hidden_state']
+    if attention_mask is None:
+        return hidden_states, None
+    return hidden_states, encoder._get_feature_vector_attention_mask(hidden_states.shape[1], attention_mask)
+
+def temporal_mean(hidden_states: torch.Tensor, frame_mask: Optional[torch.Tensor]) -> torch.Tensor:
+    if frame_mask is None:
+        return hidden_states.mean(dim=1)
+    return masked_mean(hidden_states, frame_mask)
 
 class SpeechModel(torch.nn.Module):
+    """
+    pooling=None flattens the 312 frames of a clip padded to 100000 samples (the original head); pooling="mean"
+    averages the real (unpadded) frames, so clips can be padded only to the longest one in their batch.
+    """
     def __init__(self, num_outputs: int, pretrain_model_name: str, phoneme_seq_length: int, word_seq_length: int, word_outputs: int,
-                 alpha: float = 1):
+                 alpha: float = 1, pooling: str = None, load_pretrained: bool = True):
         super(SpeechModel, self).__init__()
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        if pooling not in SPEECH_POOLING_TYPES:
+            raise ValueError(f"Invalid pooling: {pooling}")
+        self.architecture = architecture(self, num_outputs=num_outputs, pretrain_model_name=pretrain_model_name,
+                                         phoneme_seq_length=phoneme_seq_length, word_seq_length=word_seq_length,
+                                         word_outputs=word_outputs, alpha=alpha, pooling=pooling)
+        self.pooling = pooling
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
+        feature_size = 312*768 if pooling is None else self.l1.config.hidden_size
         self.l2 = torch.nn.Dropout(0.3)
-        self.l3 = torch.nn.Linear(312*768, num_outputs)
-        self.l4 = torch.nn.Linear(312*768, word_outputs*word_seq_length)
-        self.l5 = torch.nn.Linear(312*768, phoneme_seq_length)
+        self.l3 = torch.nn.Linear(feature_size, num_outputs)
+        self.l4 = torch.nn.Linear(feature_size, word_outputs*word_seq_length)
+        self.l5 = torch.nn.Linear(feature_size, phoneme_seq_length)
         self.phoneme_lstm = torch.nn.LSTM(768, phoneme_seq_length, bidirectional=True, batch_first=True)
         self.l6 = torch.nn.Dropout(0.3)
         # mult by 2 bc bidir
@@ -172,17 +354,21 @@ class SpeechModel(torch.nn.Module):
         self.word_seq_length = word_seq_length
         self.phoneme_seq_length = phoneme_seq_length
         self.alpha = alpha
+
+    def summarize(self, data: Any) -> torch.Tensor:
+        hidden_states, frame_mask = encode_audio(self.l1, data)
+        if self.pooling is None:
+            return hidden_states.reshape(-1, 312*768)
+        return temporal_mean(hidden_states, frame_mask)
     
     def forward(self, data: Any, targets: Any = None, one_output: bool = False, val: bool = False):
         # if (one_output) | ((targets is not None) & (len(targets)<3)):
         if (one_output):
-            output_1= self.l1(data)
-            output_2 = output_1['last_hidden_state'].reshape(-1, 312*768)
+            output_2 = self.summarize(data)
             output = self.l3(output_2)
             word_output, phoneme_output = (0,0)
         else:
-            output_1= self.l1(data)
-            output_2 = self.l2(output_1['last_hidden_state'].reshape(-1, 312*768))
+            output_2 = self.l2(self.summarize(data))
 
             # lstm_output, (hn, cn) = self.phoneme_lstm(output_1['last_hidden_state'])
             # lstm_output = self.l6(lstm_output.reshape(-1, self.phoneme_seq_length*2*312))
@@ -223,26 +409,35 @@ class SpeechModel(torch.nn.Module):
 
 class SiameseSpeechModel(torch.nn.Module):
     def __init__(self, num_outputs: int, pretrain_model_name: str, phoneme_seq_length: int, word_seq_length: int, word_outputs: int,
-                 alpha: float = 1):
+                 alpha: float = 1, pooling: str = None, load_pretrained: bool = True):
         super(SiameseSpeechModel, self).__init__()
-        self.l1 = AutoModel.from_pretrained(pretrain_model_name, trust_remote_code=True)
+        if pooling not in SPEECH_POOLING_TYPES:
+            raise ValueError(f"Invalid pooling: {pooling}")
+        self.architecture = architecture(self, num_outputs=num_outputs, pretrain_model_name=pretrain_model_name,
+                                         phoneme_seq_length=phoneme_seq_length, word_seq_length=word_seq_length,
+                                         word_outputs=word_outputs, alpha=alpha, pooling=pooling)
+        self.pooling = pooling
+        self.l1 = load_encoder(pretrain_model_name, load_pretrained)
+        # flattened 312 frames, or one frame-averaged vector with pooling
+        feature_size = 312*768 if pooling is None else self.l1.config.hidden_size
+        lstm_size = phoneme_seq_length*2*312 if pooling is None else phoneme_seq_length*2
         self.l2 = torch.nn.Dropout(0.3)
-        self.siamese_linear_basic = torch.nn.Linear(312*768*1, num_outputs)
-        self.l3 = torch.nn.Linear(312*768, num_outputs)
+        self.siamese_linear_basic = torch.nn.Linear(feature_size*1, num_outputs)
+        self.l3 = torch.nn.Linear(feature_size, num_outputs)
         # self.l4 = torch.nn.Linear(312*768, word_outputs*word_seq_length)
         # self.l5 = torch.nn.Linear(312*768, phoneme_seq_length)
-        self.l6 = torch.nn.Linear(312*768, num_outputs)
+        self.l6 = torch.nn.Linear(feature_size, num_outputs)
         self.phoneme_lstm = torch.nn.LSTM(768, phoneme_seq_length, bidirectional=True, batch_first=True)
         # siamese linear layer to combine the two outputs into one
         self.siamese_relu = torch.nn.ReLU()
-        self.siamese_linear_phoneme =  torch.nn.Linear(phoneme_seq_length*2*312*1, phoneme_seq_length)
-        self.siamese_linear_word = torch.nn.Linear(phoneme_seq_length*2*312*1, word_seq_length*word_outputs)
-        self.siamese_linear_output = torch.nn.Linear(phoneme_seq_length*2*312*1, num_outputs)
+        self.siamese_linear_phoneme =  torch.nn.Linear(lstm_size*1, phoneme_seq_length)
+        self.siamese_linear_word = torch.nn.Linear(lstm_size*1, word_seq_length*word_outputs)
+        self.siamese_linear_output = torch.nn.Linear(lstm_size*1, num_outputs)
 
         # mult by 2 bc bidir
-        self.phoneme_fc = torch.nn.Linear(phoneme_seq_length*2*312, phoneme_seq_length)
-        self.word_fc = torch.nn.Linear(phoneme_seq_length*2*312, word_seq_length*word_outputs)
-        self.output_fc = torch.nn.Linear(phoneme_seq_length*2*312, num_outputs)
+        self.phoneme_fc = torch.nn.Linear(lstm_size, phoneme_seq_length)
+        self.word_fc = torch.nn.Linear(lstm_size, word_seq_length*word_outputs)
+        self.output_fc = torch.nn.Linear(lstm_size, num_outputs)
         self.word_outputs = word_outputs
         self.word_seq_length = word_seq_length
         self.phoneme_seq_length = phoneme_seq_length
@@ -251,17 +446,19 @@ class SiameseSpeechModel(torch.nn.Module):
     
     def forward(self, data: Any, targets: Any = None, one_output: bool = False, val: bool = False):
         def forward_pass(data, targets, one_output):
+            hidden_states, frame_mask = encode_audio(self.l1, data)
             if (one_output):
-                output_1= self.l1(data)
-                output_2 = output_1['last_hidden_state'].reshape(-1, 312*768)
+                if self.pooling is not None:
+                    return temporal_mean(hidden_states, frame_mask)
+                output_2 = hidden_states.reshape(-1, 312*768)
                 # output = self.l3(output_2)
                 # word_output, phoneme_output = (0,0)
                 return output_2
             else:
-                output_1= self.l1(data)
-                output_2 = self.l2(output_1['last_hidden_state'].reshape(-1, 312*768))
-
-                lstm_output, (hn, cn) = self.phoneme_lstm(output_1['last_hidden_state'])
+                lstm_output, (hn, cn) = self.phoneme_lstm(hidden_states)
+                if self.pooling is not None:
+                    # the pooled LSTM summary feeds the siamese_linear_* and *_fc heads directly
+                    return temporal_mean(lstm_output, frame_mask)
                 # phoneme_fc = self.phoneme_fc(phoneme_output)
 
         
@@ -328,4 +525,29 @@ class SiameseSpeechModel(torch.nn.Module):
                     print(f'phoneme loss: {phoneme_loss*1}')
                     print(f'overall loss: {loss}')
             
-        return (output, word_output, phoneme_output), loss
\ No newline at end of file
+        return (output, word_output, phoneme_output), loss
+
+
+MODEL_REGISTRY = {model.__name__: model for model in [
+    BaseModel, BaseDevModel, BaseModelOG, ETSModel, HierarchicalModel, MultitaskModel, PooledModel,
+    SpeechModel, SiameseSpeechModel,
+]}
+
+def build_model(architecture: Dict[str, Any], load_pretrained: bool = True) -> torch.nn.Module:
+    """
+    Construct the model described by `architecture` (a model's .architecture, as saved in its checkpoint).
+    """
+    kwargs = dict(architecture)
+    model_class = kwargs.pop('model_class')
+    lora = kwargs.pop('lora', None)
+    if model_class not in MODEL_REGISTRY:
+        raise ValueError(f"Unknown model class: {model_class}")
+    model = MODEL_REGISTRY[model_class](**kwargs, load_pretrained=load_pretrained)
+    if lora is not None:
+        # a LoRA checkpoint holds only adapters and head: the encoder underneath is the pretrained one, or the
+        # one from the checkpoint the adapters were trained on top of
+        if lora.get('base_params') is not None:
+            base_state = load_params(lora['base_params'])
+            model.load_state_dict({k: v for k, v in base_state.items() if k.startswith('l1.')}, strict=False)
+        apply_lora(model, **lora)
+    return model
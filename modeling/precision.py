@@ -0,0 +1,36 @@
+"""
+Autocast settings shared by the Trainer and the scoring loops. "fp32" runs as before; "bf16" autocasts on CPU
+or on GPUs that support it; "fp16" autocasts on CUDA only and needs a GradScaler when training.
+"""
+
+import contextlib
+from typing import Any, ContextManager
+
+import torch
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+def device_type(device: Any) -> str:
+    # Trainer and the run scripts keep the device as 'cpu' or a CUDA index
+    return torch.device(device).type
+
+def check_precision(precision: str, device: Any) -> str:
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision: {precision}, choose from {PRECISIONS}")
+    if precision == "fp16" and device_type(device) != 'cuda':
+        raise ValueError("fp16 autocast needs a CUDA device; use bf16 on CPU")
+    if precision == "bf16" and device_type(device) == 'cuda' and not torch.cuda.is_bf16_supported():
+        raise ValueError("this GPU does not support bf16; use fp16")
+    return precision
+
+def autocast(precision: str, device: Any) -> ContextManager:
+    # forward passes only; the models already compute their losses on .float() outputs
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type(device), dtype=AUTOCAST_DTYPES[precision])
+
+def grad_scaler(precision: str) -> torch.cuda.amp.GradScaler:
+    # fp16 gradients underflow without loss scaling; bf16 has fp32's range and does not need it. A disabled
+    # scaler passes scale/unscale_/step straight through, so the training step is the same for every precision.
+    return torch.cuda.amp.GradScaler(enabled=(precision == "fp16"))
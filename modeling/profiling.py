@@ -0,0 +1,120 @@
+"""
+Opt-in instrumentation for Trainer.train (TrainerConfig.profile): wall time per phase of each step, throughput
+and peak memory, plus an optional torch.profiler trace of a window of optimizer steps (TrainerConfig.trace_dir).
+
+The phases are
+    data       waiting on the DataLoader, i.e. reading, tokenizing/extracting features and collating the batch
+    transfer   copying the batch to the device
+    forward    forward pass and loss
+    backward   backward pass
+    optimizer  unscale, clip, optimizer step and learning rate update
+Each boundary synchronizes the device so GPU work lands in the phase that queued it; that costs some
+throughput, which is why this is off by default.
+"""
+
+import os
+import json
+import time
+import resource
+from collections import defaultdict
+from typing import Any, Dict, List
+
+import torch
+
+PHASES = ["data", "transfer", "forward", "backward", "optimizer"]
+
+def synchronize(device: Any) -> None:
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def reset_peak_memory(device: Any) -> None:
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device: Any) -> float:
+    # peak CUDA allocation since the last reset on GPU; on CPU the peak RSS of the process, which never resets
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def count_inputs(x: Any) -> int:
+    # non-padding tokens for tokenized text, audio samples for speech
+    if hasattr(x, 'keys') and 'attention_mask' in x.keys():
+        return int(x['attention_mask'].sum())
+    if hasattr(x, 'keys'):
+        return x['input_ids'].numel()
+    return x.numel()
+
+class PhaseTimer:
+    """
+    Splits wall time into phases: mark(phase) charges the time since the previous mark to `phase`. Keeps totals
+    for the epoch and for the window since the last window() call. A disabled timer does nothing.
+    """
+    def __init__(self, device: Any, enabled: bool = True):
+        self.device, self.enabled = device, enabled
+        self.totals, self.window_totals = defaultdict(float), defaultdict(float)
+        self.samples, self.inputs, self.steps = 0, 0, 0
+        self.window_steps = 0
+        if enabled:
+            reset_peak_memory(device)
+            synchronize(device)
+        self.begin = self.last = time.perf_counter()
+
+    def mark(self, phase: str) -> None:
+        if not self.enabled:
+            return
+        synchronize(self.device)
+        now = time.perf_counter()
+        self.totals[phase] += now - self.last
+        self.window_totals[phase] += now - self.last
+        self.last = now
+
+    def count(self, x: Any, y: Any) -> None:
+        if self.enabled:
+            self.samples += len(y[0] if type(y) == list else y)
+            self.inputs += count_inputs(x)
+
+    def step(self) -> None:
+        self.steps += 1
+        self.window_steps += 1
+
+    def window(self) -> Dict[str, float]:
+        # ms per step of each phase since the last call
+        per_step = {f"{phase}_ms": 1000 * self.window_totals[phase] / max(1, self.window_steps) for phase in PHASES
+                    if phase in self.window_totals}
+        self.window_totals, self.window_steps = defaultdict(float), 0
+        return per_step
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = time.perf_counter() - self.begin
+        summary = {f"{phase}_s": self.totals[phase] for phase in PHASES if phase in self.totals}
+        summary.update({'total_s': elapsed, 'steps': self.steps, 'samples': self.samples,
+                        'samples_per_s': self.samples / elapsed, 'tokens_per_s': self.inputs / elapsed,
+                        'peak_memory_mb': peak_memory_mb(self.device)})
+        return summary
+
+def trace_profiler(trace_dir: str, start: int, steps: int) -> torch.profiler.profile:
+    """
+    torch.profiler over optimizer steps [start, start + steps) of an epoch, written to trace_dir for TensorBoard's
+    profiler plugin. The caller enters it and calls .step() after every optimizer step.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    # the step before the window is a warmup step, whose events are discarded
+    warmup = 1 if start > 0 else 0
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=start - warmup, warmup=warmup, active=steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True,
+    )
+
+def write_summary(records: List[Dict[str, Any]], path: str) -> None:
+    # whole file rewritten every epoch, renamed into place so a reader never sees half of it
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(records, f, indent=2)
+    os.replace(tmp_path, path)
@@ -3,8 +3,11 @@ Simple training loop; Boilerplate that could apply to any arbitrary neural netwo
 so nothing in this file really has anything to do with GPT specifically.
 """
 
+import os
 import math
+import random
 import logging
+import contextlib
 
 from tqdm import tqdm
 from functools import partialmethod
@@ -16,6 +19,15 @@ import torch
 import torch.optim as optim
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data.dataloader import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+
+from modeling.checkpoint import AsyncCheckpointer, load_params, to_cpu
+from modeling.model import enable_gradient_checkpointing
+from modeling.adapters import trainable_state_dict, load_adapters
+from modeling.precision import autocast, check_precision, grad_scaler
+from modeling.profiling import PhaseTimer, trace_profiler, write_summary
+from modeling.distributed import is_distributed, is_main_process, distributed_device, all_reduce_sum, get_world_size
+from data_loading.dataloaders import set_epoch
 
 logger = logging.getLogger(__name__)
 
@@ -26,16 +38,43 @@ class TrainerConfig:
     learning_rate = 3e-4
     betas = (0.9, 0.95)
     grad_norm_clip = 1.0
+    # micro-batches per optimizer step: the loader yields micro-batches and the effective batch is this many of them
+    grad_accumulation_steps = 1
     weight_decay = 0.1 # only applied on matmul weights
     # learning rate decay params: linear warmup followed by cosine decay to 10% of original
     lr_decay = False
     warmup_tokens = 1e6 # these two numbers come from the GPT-3 paper, but may not be good defaults elsewhere
     final_tokens = 260e9 # (at what point we reach 10% of original LR)
     # checkpoint settings
-    # checkpoint settings
     ckpt_path = None
+    # full training state (weights, optimizer, loss scaler, LR token counter, epoch, losses, RNG) for Trainer.resume
+    state_path = None
+    # early stopping: stop after `patience` epochs whose val loss is not at least min_delta below the best so far
+    # (None trains every epoch). Trainer.fit keeps the best weights in memory either way and, with best_path,
+    # also writes them there each time they improve (which is also where resume() finds them again)
+    patience = None
+    min_delta = 0.0
+    best_path = None
+    tokenizer_name = None # recorded in the best_path checkpoint
     num_workers = 0 # for DataLoader
     writer = None
+    log_every = 50 # optimizer steps between reads of the running train loss (each read waits for the device)
+    # autocast for forward passes: "fp32" (off), "bf16" (CPU or supporting GPUs) or "fp16" (CUDA, with loss scaling)
+    precision = "fp32"
+    # DistributedDataParallel (when launched with torchrun): some heads leave layers unused (e.g. SpeechModel's
+    # LSTM, or the word/phone layers with one_output), which DDP only tolerates when told to look for them
+    find_unused_parameters = True
+    # recompute the encoder's (self.l1) activations in backward instead of storing them: larger batches fit in
+    # memory, at the cost of about one extra encoder forward per step
+    gradient_checkpointing = False
+    # opt-in instrumentation (modeling/profiling.py): time per phase, samples/s, tokens/s and peak memory, written to
+    # the writer every log_every steps and per epoch to the JSON list at profile_path. Syncs the device per phase
+    profile = False
+    profile_path = None
+    # torch.profiler trace of optimizer steps [trace_start, trace_start + trace_steps) of the first training epoch
+    trace_dir = None
+    trace_start = 5
+    trace_steps = 5
     
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -50,29 +89,173 @@ class Trainer:
         self.config = config
         self.val_dataloader = val_dataloader
         self.losses = []
+        self.tokens = 0 # counter used for learning rate decay
+        self.epoch = 0 # training epochs finished, i.e. the one to resume from
+        self.global_step = 0 # optimizer steps so far; the x axis of everything sent to the writer
+        self.profile_records = [] # per-epoch summaries when profiling
+        self.traced = False
+        # best validation loss so far, the epoch it came from and a CPU copy of its weights
+        self.best_loss, self.best_epoch, self.best_state = float('inf'), None, None
+        self.bad_epochs = 0 # epochs since the val loss last improved
+        self.stop_reason = None # why fit() stopped: "max_epochs", "early_stopping" or "non_finite_loss"
         self.optimizer = self.create_optimizer()
         # flag for speech
         self.one_output = one_output
+        if config.gradient_checkpointing and not enable_gradient_checkpointing(self.model):
+            logger.warning("gradient_checkpointing: the model has no trainable encoder that supports it, ignored")
 
-        # take over whatever gpus are on the system
+        # take over whatever gpus are on the system: one process per GPU (or per share of the CPU cores) under
+        # torchrun, otherwise DataParallel over every GPU in this process
         self.device = 'cpu'
-        if torch.cuda.is_available():
+        if is_distributed():
+            self.device = distributed_device()
+            self.model = DistributedDataParallel(self.model.to(self.device),
+                                                 device_ids=[self.device] if torch.cuda.is_available() else None,
+                                                 find_unused_parameters=config.find_unused_parameters,
+                                                 # recomputing in backward would otherwise mark parameters ready twice
+                                                 static_graph=config.gradient_checkpointing)
+        elif torch.cuda.is_available():
             self.device = torch.cuda.current_device()
             self.model = torch.nn.DataParallel(self.model).to(self.device)
+        self.precision = check_precision(config.precision, self.device)
+        self.scaler = grad_scaler(self.precision)
+        self.checkpointer = AsyncCheckpointer()
 
     def save_checkpoint(self):
-        if self.config.ckpt_path is not None:
-            ckpt_model = self.model.module if hasattr(self.model, "module") else self.model
+        # every process holds the same weights; only the first one writes them, from a background thread
+        if not is_main_process():
+            return
+        model = self.model.module if hasattr(self.model, "module") else self.model
+        if self.config.state_path is not None:
+            logger.info("saving %s", self.config.state_path)
+            self.checkpointer.save(self.training_state(), self.config.state_path, params_path=self.config.ckpt_path,
+                                   architecture=getattr(model, 'architecture', None))
+        elif self.config.ckpt_path is not None:
             logger.info("saving %s", self.config.ckpt_path)
-            torch.save(ckpt_model.state_dict(), self.config.ckpt_path)
+            self.checkpointer.save_params(model, self.config.ckpt_path)
+
+    def training_state(self):
+        model = self.model.module if hasattr(self.model, "module") else self.model
+        rng = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng['cuda'] = torch.cuda.get_rng_state_all()
+        return {'model': trainable_state_dict(model), 'optimizer': self.optimizer.state_dict(), 'scaler': self.scaler.state_dict(),
+                'tokens': self.tokens, 'epoch': self.epoch, 'global_step': self.global_step, 'losses': list(self.losses), 'rng': rng,
+                # only the metric: the best weights themselves are written once per improvement, to best_path
+                'best': {'loss': self.best_loss, 'epoch': self.best_epoch, 'bad_epochs': self.bad_epochs}}
+
+    def resume(self, path=None):
+        """
+        Restore the state save_checkpoint wrote to `path` (default TrainerConfig.state_path) and return the epoch
+        to continue from, so a loop over range(trainer.resume(), max_epochs) skips the finished epochs. Returns 0
+        when there is no state to resume.
+        """
+        path = path or self.config.state_path
+        if path is None or not os.path.exists(path):
+            return 0
+        logger.info("resuming from %s", path)
+        state = torch.load(path, map_location='cpu')
+        load_adapters(self.model, state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.tokens, self.epoch, self.losses = state['tokens'], state['epoch'], list(state['losses'])
+        self.global_step = state.get('global_step', 0)
+        best = state.get('best', {'loss': float('inf'), 'epoch': None, 'bad_epochs': 0})
+        self.best_loss, self.best_epoch, self.bad_epochs = best['loss'], best['epoch'], best['bad_epochs']
+        if self.best_epoch is not None and self.config.best_path is not None and os.path.exists(self.config.best_path):
+            self.best_state = load_params(self.config.best_path)
+        random.setstate(state['rng']['python'])
+        np.random.set_state(state['rng']['numpy'])
+        torch.set_rng_state(state['rng']['torch'])
+        if 'cuda' in state['rng'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        return self.epoch
+
+    def fit(self, max_epochs=None, on_epoch_end=None):
+        """
+        Train and validate for up to max_epochs (default TrainerConfig.max_epochs), resuming from
+        TrainerConfig.state_path when it holds a saved state. After each epoch the best weights are snapshotted in
+        memory (and written to TrainerConfig.best_path when they improve), the training state is checkpointed and
+        on_epoch_end(epoch, train_loss, val_loss) is called (e.g. to report to ray tune). Stops early after TrainerConfig.patience epochs without improvement, or when the train
+        loss stops being finite; the reason is left in self.stop_reason. Returns self.losses.
+        """
+        max_epochs = self.config.max_epochs if max_epochs is None else max_epochs
+        for epoch in range(self.resume(), max_epochs):
+            # checked before each epoch too, so a run resumed after it had already stopped does not carry on
+            self.stop_reason = self.early_stop_reason()
+            if self.stop_reason is not None:
+                break
+            train_loss = self.train('train', epoch)
+            val_loss = self.train('val', epoch) if self.val_dataloader else None
+            self.losses.append((train_loss, val_loss))
+            self.track_best(val_loss, epoch)
+            self.save_checkpoint()
+            if on_epoch_end is not None:
+                on_epoch_end(epoch, train_loss, val_loss)
+        else:
+            self.stop_reason = self.early_stop_reason() or "max_epochs"
+        logger.info("stopped after epoch %d: %s (best val loss %s at epoch %s)", self.epoch, self.stop_reason, self.best_loss, self.best_epoch)
+        return self.losses
+
+    def early_stop_reason(self):
+        if self.losses and not math.isfinite(self.losses[-1][0]):
+            return "non_finite_loss"
+        if self.config.patience is not None and self.bad_epochs >= self.config.patience:
+            return "early_stopping"
+        return None
+
+    def track_best(self, val_loss, epoch):
+        # a copy on the CPU, written to best_path (when set) only when it changes
+        if val_loss is None:
+            return False
+        if val_loss < self.best_loss - self.config.min_delta:
+            model = self.model.module if hasattr(self.model, "module") else self.model
+            self.best_loss, self.best_epoch, self.best_state = val_loss, epoch, to_cpu(trainable_state_dict(model))
+            self.bad_epochs = 0
+            if self.config.best_path is not None:
+                self.save_best()
+            return True
+        self.bad_epochs += 1
+        return False
+
+    def save_best(self, path=None, tokenizer_name=None):
+        # the best weights fit() saw, or the current ones when there was no validation set; to best_path by default
+        path = path or self.config.best_path
+        tokenizer_name = tokenizer_name or self.config.tokenizer_name
+        if not is_main_process():
+            return
+        model = self.model.module if hasattr(self.model, "module") else self.model
+        state_dict = self.best_state if self.best_state is not None else trainable_state_dict(model)
+        self.checkpointer.save_state_dict(state_dict, path, getattr(model, 'architecture', None), tokenizer_name)
+
+    def restore_best(self):
+        # load the best weights back into the model, e.g. before scoring the test set
+        if self.best_state is not None:
+            load_adapters(self.model, self.best_state)
+
+    def record_profile(self, split, step, timer):
+        # this process's numbers; under torchrun the first process reports its own share of the data
+        summary = {'split': split, 'epoch': step, 'global_step': self.global_step, **timer.summary()}
+        logger.info("%s epoch %d: %s", split, step + 1, summary)
+        if not is_main_process():
+            return
+        self.profile_records.append(summary)
+        if self.config.writer is not None:
+            for name, value in summary.items():
+                if name not in ('split', 'epoch', 'global_step'):
+                    self.config.writer.add_scalar(f'perf/{split}/epoch_{name}', value, self.global_step)
+        if self.config.profile_path is not None:
+            write_summary(self.profile_records, self.config.profile_path)
 
     def create_optimizer(self):
         model, config = self.model, self.config
 
-        # create the optimizer
+        # create the optimizer over the trainable parameters only (frozen encoders, LoRA), which keeps AdamW's two
+        # moments per parameter off the frozen ones
         no_decay = ["bias", "LayerNorm.weight"]
-        params_decay = [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)]
-        params_nodecay = [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)]
+        named_parameters = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+        params_decay = [p for n, p in named_parameters if not any(nd in n for nd in no_decay)]
+        params_nodecay = [p for n, p in named_parameters if any(nd in n for nd in no_decay)]
         optim_groups = [
             {"params": params_decay, "weight_decay": config.weight_decay},
             {"params": params_nodecay, "weight_decay": 0.0},
@@ -87,38 +270,79 @@ class Trainer:
         loader = self.train_dataloader if is_train else self.val_dataloader
 
         pbar = tqdm(enumerate(loader), total=len(loader)) if is_train else enumerate(loader)
-        losses = []
+        timer = PhaseTimer(self.device, enabled=config.profile)
+        profiler = None
+        if is_train and config.trace_dir is not None and not self.traced and is_main_process():
+            profiler = trace_profiler(config.trace_dir, config.trace_start, config.trace_steps)
+            profiler.start()
+            self.traced = True
+        if is_train:
+            # distributed samplers reshuffle per epoch
+            set_epoch(loader, step)
+        accumulation_steps = max(1, config.grad_accumulation_steps)
+        ddp = isinstance(model, DistributedDataParallel)
+        # losses are summed on the device and only read back every log_every steps and at the end of the epoch
+        epoch_loss, n_losses = torch.zeros((), device=self.device), 0
+        window_loss, window_size = torch.zeros((), device=self.device), 0
         for it, (x, y) in pbar:
+            timer.mark('data')
+            timer.count(x, y)
+            # labels that count towards the LR schedule (masked ones are negative, e.g. -1000 in CombinedDataset),
+            # counted on the loader's CPU tensors so no device sync is needed
+            n_labels = int(((y[0] if type(y) == list else y) >= 0).sum()) if is_train else 0
             # place data on the correct device
             x = x.to(self.device)
             if type(y) == list:
                 y = [yy.to(self.device) for yy in y]
             else:
                 y = y.to(torch.float32).to(self.device)
+            timer.mark('transfer')
+
+            # micro-batches are grouped into effective batches of accumulation_steps; the last group of the
+            # epoch may be shorter, and each loss is divided by its own group's size so every step averages
+            group_start = it - it % accumulation_steps
+            group_size = min(accumulation_steps, len(loader) - group_start)
+            last_in_group = it == group_start + group_size - 1
+            # DDP all-reduces gradients in backward; within a group that is only needed for the last micro-batch
+            sync = model.no_sync() if ddp and is_train and not last_in_group else contextlib.nullcontext()
 
             # forward the model
             if is_train:
                 model.train()
             else:
                 model.eval()
-            with torch.set_grad_enabled(is_train):
-                logits, loss = model(x, y, val=(not is_train), one_output=self.one_output)
-                loss = loss.mean() # collapse all losses if they are scattered on multiple gpus
-                losses.append(loss.item())
-            if is_train:
-                # backprop and update the parameters
-                model.zero_grad()
-                loss.backward()
+            with sync:
+                with torch.set_grad_enabled(is_train), autocast(self.precision, self.device):
+                    logits, loss = model(x, y, val=(not is_train), one_output=self.one_output)
+                    loss = loss.float().mean() # collapse all losses if they are scattered on multiple gpus
+                timer.mark('forward')
+                epoch_loss += loss.detach()
+                n_losses += 1
+                if is_train:
+                    window_loss += loss.detach()
+                    window_size += 1
+                    if it == group_start:
+                        model.zero_grad()
+                    self.scaler.scale(loss / group_size).backward()
+                    timer.mark('backward')
+            if not is_train:
+                timer.step()
+            else:
+                # tokens still count every micro-batch, so the decay schedule is the same as without accumulation;
+                # each process sees 1/world_size of the data, so the schedule follows all of them
+                self.tokens += n_labels * get_world_size()
+                if not last_in_group:
+                    continue
+
+                # backprop and update the parameters once per effective batch; gradients are unscaled before clipping
+                self.scaler.unscale_(self.optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
-                self.optimizer.step()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
                 lr = config.learning_rate
                 # decay the learning rate based on our progress
                 if config.lr_decay:
-                    if type(y) == list:
-                        self.tokens += (y[0] >= 0).sum()
-                    else:
-                        self.tokens += (y >= 0).sum() # number of tokens processed this step (i.e. label is not -100)
                     if self.tokens < config.warmup_tokens:
                         # linear warmup
                         lr_mult = float(self.tokens) / float(max(1, config.warmup_tokens))
@@ -131,11 +355,31 @@ class Trainer:
                         param_group['lr'] = lr
                 else:
                     lr = config.learning_rate
-                # report progress
-                pbar.set_description(f"epoch {step+1} iter {it}: train loss {loss.item():.5f}. lr {lr:e}")
-                
-                if config.writer is not None:
-                    config.writer.add_scalar('train/loss',  loss.item(), step)
-                    config.writer.add_scalar('train/lr', lr, step)
-                    
-        return np.mean(losses)
+                timer.mark('optimizer')
+                timer.step()
+                self.global_step += 1
+                if profiler is not None:
+                    profiler.step()
+
+                # report progress every log_every steps, with the loss averaged over the steps since the last report
+                if (it // accumulation_steps + 1) % config.log_every == 0 or it == len(loader) - 1:
+                    mean_loss = (window_loss / window_size).item()
+                    window_loss, window_size = torch.zeros((), device=self.device), 0
+                    pbar.set_description(f"epoch {step+1} iter {it}: train loss {mean_loss:.5f}. lr {lr:e}")
+
+                    if config.writer is not None and is_main_process():
+                        config.writer.add_scalar('train/loss',  mean_loss, self.global_step)
+                        config.writer.add_scalar('train/lr', lr, self.global_step)
+                        # ms per step of each phase over the same window (nothing unless profiling)
+                        for name, value in timer.window().items():
+                            config.writer.add_scalar(f'perf/train/{name}', value, self.global_step)
+
+        if profiler is not None:
+            profiler.stop()
+        if config.profile:
+            self.record_profile(split, step, timer)
+        if is_train:
+            self.epoch = step + 1
+        # mean over every process's batches (for validation, each process scored its own shard)
+        loss_sum, count = all_reduce_sum(torch.stack([epoch_loss, torch.tensor(float(n_losses), device=self.device)])).tolist()
+        return loss_sum / count if count else float('nan')
@@ -1,14 +1,18 @@
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
 from tqdm import tqdm
 from torch.nn import functional as F
-from modeling.model import BaseModel, ETSModel, HierarchicalModel, BaseDevModel, BaseModelOG, MultitaskModel
-from torch.utils.tensorboard import SummaryWriter
+from modeling.model import BaseModel, ETSModel, HierarchicalModel, BaseDevModel, BaseModelOG, MultitaskModel, PooledModel, build_model, has_encoder_weights, restore_params
 from transformers import AutoTokenizer
 import random
 
 from modeling import trainer
+from modeling.inference import predict
+from modeling.checkpoint import load_checkpoint, load_params, save_params
+from modeling.adapters import apply_lora
+from modeling.distributed import init_distributed, cleanup_distributed, distributed_device, is_main_process
 from data_loading.dataloaders import get_data_loaders
 from data_loading.datasets import DefaultDataset
 import run_utils as utils
@@ -17,142 +21,148 @@ from settings import *
 torch.manual_seed(0)
 args = utils.get_argparser().parse_args()
 
-# Save the device
-device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+# Save the device; under torchrun (pretrain/finetune) each process trains on its own device and shard of the data
+distributed = init_distributed() if args.function in ('pretrain', 'finetune') else False
+device = distributed_device() if distributed else (torch.cuda.current_device() if torch.cuda.is_available() else 'cpu')
 args.lr_decay = args.lr_decay == "True"
+if args.dynamic_padding and not args.model_type.startswith("pooled"):
+    raise ValueError("--dynamic_padding needs a length-independent head; use a pooled model_type")
 
 # Instantiate the tokenizer and dataset
 tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, trust_remote_code=True)
 dataset = utils.get_dataset(args, tokenizer)
 
+# when the checkpoint to restore already holds the encoder, build it from its config instead of reading the
+# pretrained weights only to overwrite them
+restore_state, restore_architecture = load_checkpoint(args.reading_params_path) if args.reading_params_path is not None else (None, None)
+load_pretrained = restore_state is None or not has_encoder_weights(restore_state)
 
 if args.function == 'pretrain':
+    from torch.utils.tensorboard import SummaryWriter # only needed for training; keeps evaluate start-up light
     writer = SummaryWriter(log_dir='expt/')
     train_dl, val_dl, test_dl = get_data_loaders(
-        dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1, test_batch_size=1, num_workers=0
-    )
+        dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1, test_batch_size=1, num_workers=0, distributed=distributed)
 
     train_config = trainer.TrainerConfig(max_epochs=args.max_epochs, 
             learning_rate=args.learning_rate, lr_decay=args.lr_decay,
-            num_workers=4, writer=writer, ckpt_path='expt/params.pt')
+            num_workers=4, writer=writer, ckpt_path='expt/params.pt', state_path=args.state_path, precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            profile=args.profile, profile_path='expt/profile.json', trace_dir=args.trace_dir,
+            gradient_checkpointing=args.gradient_checkpointing)
 
     if args.model_type == "base-og":
-        model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+        model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
 
         if args.reading_params_path is not None:
-            model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
 
         trainer = trainer.Trainer(model=model, train_dataloader=train_dl, test_dataloader=test_dl, config=train_config, val_dataloader=None)
     elif args.model_type == "ets":
-        model = ETSModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+        model = ETSModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
 
         if args.reading_params_path is not None:
-            model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
         
     trainer = trainer.Trainer(model=model, train_dataloader=train_dl, test_dataloader=test_dl, config=train_config, val_dataloader=None)
 
-    trainer.tokens = 0 # counter used for learning rate decay
-    for epoch in range(args.max_epochs):
-        train_loss = trainer.train('train', epoch)
-        if trainer.val_dataloader:
-            val_loss = trainer.train('val', epoch)
-        else:
-            val_loss = None
-        trainer.losses.append((train_loss, val_loss))
-        trainer.save_checkpoint()
+    # with --state_path, an interrupted run picks up after its last finished epoch
+    trainer.fit(args.max_epochs)
     
-    torch.save(model.state_dict(), args.writing_params_path)
+    trainer.checkpointer.wait()
+    if is_main_process():
+        save_params(model, args.writing_params_path, args.tokenizer_name)
+    cleanup_distributed()
 
 
 elif args.function == 'finetune':
     # TensorBoard training log
+    from torch.utils.tensorboard import SummaryWriter
     writer = SummaryWriter(log_dir='expt/')
 
     train_config = trainer.TrainerConfig(max_epochs=args.max_epochs, 
             learning_rate=args.learning_rate, lr_decay=args.lr_decay,
-            num_workers=4, writer=writer, ckpt_path='expt/params.pt')
+            num_workers=4, writer=writer, ckpt_path='expt/params.pt', state_path=args.state_path, precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            profile=args.profile, profile_path='expt/profile.json', trace_dir=args.trace_dir,
+            gradient_checkpointing=args.gradient_checkpointing)
     # get the dataloaders. can make test and val sizes 0 if you don't want them
     if args.model_type == "base-og":
         train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
-        test_batch_size=1, num_workers=0)
+        test_batch_size=1, num_workers=0, distributed=distributed)
     
-        model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+        model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
         if args.reading_params_path is not None:
-            model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
     elif args.model_type == "base-dev":
         train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
-        test_batch_size=1, num_workers=0)
+        test_batch_size=1, num_workers=0, distributed=distributed)
     
-        model = BaseDevModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+        model = BaseDevModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
         if args.reading_params_path is not None:
-            model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
     elif args.model_type == "base":
         train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
-        test_batch_size=1, num_workers=0)
+        test_batch_size=1, num_workers=0, distributed=distributed)
     
-        model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+        model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
+        if args.reading_params_path is not None:
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
+    elif args.model_type.startswith("pooled-"):
+        train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
+        test_batch_size=1, num_workers=0, dynamic_padding=args.dynamic_padding, pad_token_id=tokenizer.pad_token_id, distributed=distributed)
+
+        model = PooledModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, pooling=args.model_type.split("-", 1)[1], load_pretrained=load_pretrained)
         if args.reading_params_path is not None:
-            model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+            restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
     elif args.model_type == "hierarchical":
         if args.dataset == "ELL-ICNALE":
             train_dl, val_dl, test_dl = get_data_loaders(
-                dataset, val_size=0.2, test_size=0.1, batch_size=32, val_batch_size=1, test_batch_size=1, num_workers=0
-            )
+                dataset, val_size=0.2, test_size=0.1, batch_size=32, val_batch_size=1, test_batch_size=1, num_workers=0, distributed=distributed)
 
             model = HierarchicalModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns) - 1, pretrain_model_name=args.tokenizer_name)
             
         elif args.dataset == "ICNALE-EDITED":
             train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
-            test_batch_size=1, num_workers=0)
+            test_batch_size=1, num_workers=0, distributed=distributed)
         
-            model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=6, pretrain_model_name=args.tokenizer_name)
+            model = BaseModelOG(seq_length=dataset.tokenizer.model_max_length, num_outputs=6, pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
             if args.reading_params_path is not None:
-                model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+                restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
 
+    if args.lora_r is not None:
+        # an encoder restored from --reading_params_path is the base the adapters need at scoring time
+        apply_lora(model, r=args.lora_r, alpha=args.lora_alpha, base_params=None if load_pretrained else args.reading_params_path)
     trainer = trainer.Trainer(model=model, train_dataloader=train_dl, test_dataloader=test_dl, config=train_config, val_dataloader=val_dl)
 
-    trainer.tokens = 0 # counter used for learning rate decay
-
-    for epoch in range(args.max_epochs):
-        train_loss = trainer.train('train', epoch)
-        if trainer.val_dataloader:
-            val_loss = trainer.train('val', epoch)
-        else:
-            val_loss = None
-        trainer.losses.append((train_loss, val_loss))
-        trainer.save_checkpoint()
+    # with --state_path, an interrupted run picks up after its last finished epoch
+    trainer.fit(args.max_epochs)
     
-    torch.save(model.state_dict(), args.writing_params_path)
+    if not is_main_process():
+        # the other processes only share the training; saving and scoring happen once
+        cleanup_distributed()
+        sys.exit(0)
+    trainer.checkpointer.wait()
+    save_params(model, args.writing_params_path, args.tokenizer_name)
     utils.write_predictions(args.val_losses_path, trainer.losses)
 
     model = model.to(device)
-    model.eval()
-    predictions = []
-    pbar = tqdm(enumerate(test_dl), total=len(test_dl)) 
-    for it, (x, y) in pbar:
-        # place data on the correct device
-        x = x.to(device)
-        predictions.append((model(x, eval_output=True)[0].mean().item(), y[0].mean().item()))
-        torch.cuda.empty_cache()
+    predictions = predict(model, test_dl.dataset, batch_size=args.eval_batch_size, device=device,
+                          dynamic_padding=args.dynamic_padding, pad_token_id=tokenizer.pad_token_id,
+                          precision=args.precision)
     
     utils.write_predictions(args.in_distribution_outputs_path, predictions)
 
     # Evaluate in finetune
     dataset = DefaultDataset(
-        file_path=FCE_DATA_DIR, input_col='essay', target_cols=['overall_score'], tokenizer=tokenizer
+        file_path=FCE_DATA_DIR, input_col='essay', target_cols=['overall_score'], tokenizer=tokenizer,
+        cache_dir=args.token_cache_dir
     )
-    test_dl = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False,num_workers=0)
-    model.load_state_dict(torch.load(args.writing_params_path))
+    # LoRA checkpoints hold only the adapters and head; restore_params loads those on top of the encoder
+    restore_params(model, load_params(args.writing_params_path))
     model = model.to(device)
-    model.eval()
-    predictions = []
-
-    pbar = tqdm(enumerate(test_dl), total=len(test_dl)) 
-    for it, (x, y) in pbar:
-        # place data on the correct device
-        x = x.to(device)
-        predictions.append((model(x, eval_output=True)[0].mean().item(), y[0].mean().item()))
-        torch.cuda.empty_cache()
+    predictions = predict(model, dataset, batch_size=args.eval_batch_size, device=device,
+                          dynamic_padding=args.dynamic_padding, pad_token_id=tokenizer.pad_token_id,
+                          precision=args.precision)
 
     utils.write_predictions(args.outputs_path, predictions)
     
@@ -163,28 +173,13 @@ elif args.function == 'evaluate':
     else:
         train_dl, val_dl, test_dl = get_data_loaders(dataset, val_size=0.2, test_size=0.1, batch_size=16, val_batch_size=1,
             test_batch_size=1, num_workers=0)
-    model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
-    if args.dataset == "FCE" and "ell" in args.reading_params_path:
-        model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=6, pretrain_model_name=args.tokenizer_name)
-    if args.dataset == "FCE" and "ets2" in args.reading_params_path:
-        model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=6, pretrain_model_name=args.tokenizer_name)
-    if args.dataset == "FCE" and "icnale-baseline-categories" in args.reading_params_path:
-        model = BaseModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=5, pretrain_model_name=args.tokenizer_name)
-    if args.dataset == "FCE" and args.model_type == "hierarchical":
-        model = HierarchicalModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=7, pretrain_model_name=args.tokenizer_name)
-    if args.model_type == "multitask":
-        model = MultitaskModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=7, pretrain_model_name=args.tokenizer_name)
-    model.load_state_dict(torch.load(args.reading_params_path))
+    # the checkpoint describes its own model; older checkpoints fall back to guessing from the flags and path
+    model = build_model(restore_architecture or utils.legacy_architecture(args, dataset), load_pretrained=load_pretrained)
+    restore_params(model, restore_state, load_pretrained=load_pretrained)
     model = model.to(device)
-    model.eval()
-    predictions = []
-
-    pbar = tqdm(enumerate(test_dl), total=len(test_dl)) 
-    for it, (x, y) in pbar:
-        # place data on the correct device
-        x = x.to(device)
-        predictions.append((model(x, eval_output=True)[0].mean().item(), y[0].mean().item()))
-        torch.cuda.empty_cache()
+    predictions = predict(model, test_dl.dataset, batch_size=args.eval_batch_size, device=device,
+                          dynamic_padding=args.dynamic_padding, pad_token_id=tokenizer.pad_token_id,
+                          precision=args.precision)
     
     utils.write_predictions(args.outputs_path, predictions)
     
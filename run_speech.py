@@ -4,22 +4,26 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 from torch.nn import functional as F
-from modeling.model import SpeechModel, SiameseSpeechModel
-from modeling.model import SpeechModel, SiameseSpeechModel
+from modeling.model import SpeechModel, SiameseSpeechModel, build_model, has_encoder_weights, restore_params
 from torch.utils.tensorboard import SummaryWriter
 from transformers import AutoFeatureExtractor
 import random
 import argparse
 
 from modeling import trainer
-from data_loading.datasets import SpeechDataset
-from data_loading.dataloaders import split_on_indices
+from modeling.checkpoint import load_checkpoint, save_params
+from modeling.adapters import apply_lora
+from modeling.inference import read_chunks, stream_score
+from modeling.precision import autocast, check_precision
+from modeling.distributed import init_distributed, cleanup_distributed, distributed_device, is_main_process
+from data_loading.speech_datasets import SpeechDataset, DEFAULT_VAD_PARAMS
+from data_loading.dataloaders import split_on_indices, pad_audio_collate
 from settings import SPEECHOCEAN_DATA_DIR
 
 
 torch.manual_seed(0)
 argp = argparse.ArgumentParser()
-argp.add_argument('function', help="Choose pretrain, finetune, or evaluate") #TODO: add behavior for pretrain and eval
+argp.add_argument('function', help="Choose pretrain, finetune, evaluate, or stream") #TODO: add behavior for pretrain and eval
 argp.add_argument('--writing_params_path', type=str, help='Path to the writing params file', required=False)
 argp.add_argument('--reading_params_path', type=str, help='Path to the reading params file', required=False)
 argp.add_argument('--outputs_path', type=str, help='Path to the output predictions', default="predictions.txt", required=False)
@@ -29,18 +33,43 @@ argp.add_argument('--dataset', type=str, help='Name of the dataset to use', defa
 argp.add_argument('--max_epochs', type=int, help='Number of epochs to train for', default=25, required=False)
 argp.add_argument('--learning_rate', type=float, help='Learning rate', default=2e-5, required=False)
 argp.add_argument('--seed', type=int, help='Number of epochs to train for', default=0, required=False)
+argp.add_argument('--pooling', type=str, help='Speech head: unset for the flattened 312-frame head, "mean" for masked temporal mean pooling', default=None, required=False)
+argp.add_argument('--dynamic_padding', action='store_true', help='Pad audio only to the longest clip in each batch (needs --pooling)')
+argp.add_argument('--audio_cache_dir', type=str, help='Extract audio features once into a memory-mapped cache here', default=None, required=False)
+argp.add_argument('--trim_silence', action='store_true', help='Trim leading/trailing silence (energy VAD) before feature extraction')
+argp.add_argument('--vad_threshold_db', type=float, help='Frames this many dB below the loudest frame count as silence', default=-40.0, required=False)
+argp.add_argument('--vad_margin_ms', type=float, help='Audio kept around the first and last voiced frame', default=100.0, required=False)
+argp.add_argument('--profile', action='store_true', help='Time each training phase and record throughput and peak memory (to TensorBoard and expt/profile.json)')
+argp.add_argument('--trace_dir', type=str, help='Write a torch.profiler trace of a few steps of the first epoch here', default=None, required=False)
+argp.add_argument('--gradient_checkpointing', action='store_true', help='Recompute encoder activations in backward to fit larger batches')
+argp.add_argument('--lora_r', type=int, help='Train rank-r LoRA adapters on the encoder (and the head) instead of the whole model', default=None, required=False)
+argp.add_argument('--lora_alpha', type=float, help='LoRA scaling numerator (the update is scaled by alpha / r)', default=16, required=False)
+argp.add_argument('--grad_accumulation_steps', type=int, help='Micro-batches accumulated per optimizer step', default=1, required=False)
+argp.add_argument('--precision', type=str, help='Autocast precision for training and scoring: fp32, bf16 or fp16 (CUDA)', default="fp32", required=False)
+argp.add_argument('--audio_path', type=str, help='Recording to score with stream (any length, read in chunks)', default=None, required=False)
+argp.add_argument('--window_s', type=float, help='Window length for stream, in seconds', default=6.0, required=False)
+argp.add_argument('--overlap_s', type=float, help='Overlap between consecutive stream windows, in seconds', default=1.0, required=False)
 args = argp.parse_args()
+if args.dynamic_padding and args.pooling is None:
+    raise ValueError("--dynamic_padding needs a length-independent head; pass --pooling mean")
 
-# Save the device
-device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+# Save the device; finetune under torchrun trains one process per device (or share of the CPU cores)
+distributed = init_distributed() if args.function == 'finetune' else False
+device = distributed_device() if distributed else (torch.cuda.current_device() if torch.cuda.is_available() else 'cpu')
 
 
+vad_params = {**DEFAULT_VAD_PARAMS, 'threshold_db': args.vad_threshold_db, 'margin_ms': args.vad_margin_ms} if args.trim_silence else None
+
 # instantiate the tokenizers
 tokenizer = AutoFeatureExtractor.from_pretrained(args.tokenizer_name)
 # instantiate the dataset
-if args.dataset == "SPEECHOCEAN":
+if args.function == 'stream':
+    # scores a single recording; no dataset needed
+    pass
+elif args.dataset == "SPEECHOCEAN":
     dataset = SpeechDataset(path_name=SPEECHOCEAN_DATA_DIR, input_col = 'audio', target_cols_sentence=['accuracy', 'fluency', 'prosodic', 'total'],
-    target_cols_words = ["accuracy", "stress", "total"], target_cols_phones = ["phones-accuracy"], tokenizer=tokenizer, siamese=False)
+    target_cols_words = ["accuracy", "stress", "total"], target_cols_phones = ["phones-accuracy"], tokenizer=tokenizer, siamese=False,
+    cache_dir=args.audio_cache_dir, dynamic_padding=args.dynamic_padding, vad_params=vad_params)
 else:
     raise ValueError("Invalid dataset name")
                              
@@ -59,23 +88,34 @@ elif args.function == 'finetune':
         val_batch_size=16,
         test_batch_size=16,
         num_workers=0,
-        seed=args.seed
+        seed=args.seed,
+        dynamic_padding=args.dynamic_padding,
+        collate_fn=pad_audio_collate,
+        distributed=distributed
     )
     # TensorBoard training log
     writer = SummaryWriter(log_dir='expt/')
 
     train_config = trainer.TrainerConfig(max_epochs=args.max_epochs, 
             learning_rate=args.learning_rate, 
-            num_workers=4, writer=writer, ckpt_path='expt/params.pt')
+            num_workers=4, writer=writer, ckpt_path='expt/params.pt', precision=args.precision,
+            grad_accumulation_steps=args.grad_accumulation_steps,
+            profile=args.profile, profile_path='expt/profile.json', trace_dir=args.trace_dir,
+            gradient_checkpointing=args.gradient_checkpointing)
 
     model = SpeechModel(num_outputs=(0 if dataset.targets_sentence is None else len(dataset.targets_sentence.columns)), pretrain_model_name=args.tokenizer_name,
-    phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length, word_outputs = 0 if dataset.targets_words is None else len(dataset.targets_words.columns))
+    phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length, word_outputs = 0 if dataset.targets_words is None else dataset.targets_words.shape[1],
+    pooling=args.pooling)
+    if args.lora_r is not None:
+        apply_lora(model, r=args.lora_r, alpha=args.lora_alpha)
     trainer = trainer.Trainer(model=model,  train_dataloader=train_dl, test_dataloader=test_dl, config=train_config, val_dataloader=val_dl)
     trainer.train(split='train', step=0)
-    torch.save(model.state_dict(), args.writing_params_path)
-    with open(args.loss_path, 'w') as f:
-        for loss in trainer.losses:
-            f.write(f"{loss[0]},{loss[1]}\n")
+    if is_main_process():
+        save_params(model, args.writing_params_path, args.tokenizer_name)
+        with open(args.loss_path, 'w') as f:
+            for loss in trainer.losses:
+                f.write(f"{loss[0]},{loss[1]}\n")
+    cleanup_distributed()
 
 elif args.function == 'evaluate':
     train_dl, val_dl, test_dl = split_on_indices(
@@ -87,13 +127,22 @@ elif args.function == 'evaluate':
         val_batch_size=16,
         test_batch_size=1,
         num_workers=0,
-        seed=args.seed
+        seed=args.seed,
+        dynamic_padding=args.dynamic_padding,
+        collate_fn=pad_audio_collate
     )
-    model = SpeechModel(num_outputs=0 if dataset.targets_sentence is None else len(dataset.targets_sentence.columns), pretrain_model_name=args.tokenizer_name,
-    phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length, word_outputs = 0 if dataset.targets_words is None else len(dataset.targets_words.columns))
+    restore_state, architecture = load_checkpoint(args.reading_params_path, device='cpu')
+    load_pretrained = not has_encoder_weights(restore_state)
+    if architecture is None:
+        # checkpoint saved without its architecture: assume a SpeechModel shaped by this dataset
+        architecture = dict(model_class="SpeechModel", num_outputs=0 if dataset.targets_sentence is None else len(dataset.targets_sentence.columns),
+            pretrain_model_name=args.tokenizer_name, phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length,
+            word_outputs=0 if dataset.targets_words is None else dataset.targets_words.shape[1], pooling=args.pooling)
+    model = build_model(architecture, load_pretrained=load_pretrained)
 
-    model.load_state_dict(torch.load(args.reading_params_path, map_location=torch.device('cpu')))
+    restore_params(model, restore_state, load_pretrained=load_pretrained)
     model = model.to(device)
+    check_precision(args.precision, device)
     model.eval()
     torch.set_grad_enabled(False)
     predictions = []
@@ -104,13 +153,36 @@ elif args.function == 'evaluate':
     actual_cols = [f'actual_{c}' for c in dataset.targets_sentence.columns]
     for it, (x, y) in pbar:
         # place data on the correct device
-        with torch.no_grad():
+        with torch.no_grad(), autocast(args.precision, device):
             x = x.to(device)
             one_output = (len(y)<3)
             predictions.append(({**dict(zip(pred_cols, model(x, one_output=one_output)[0][0][0].tolist())), **dict(zip(actual_cols, y[0][0].tolist()))}))
 
     pd.DataFrame(predictions).to_csv(args.outputs_path, index=False)
-    
+
+elif args.function == 'stream':
+    restore_state, architecture = load_checkpoint(args.reading_params_path, device='cpu')
+    if architecture is None:
+        raise ValueError("stream needs a checkpoint that records its architecture; re-save it with "
+                         "python -m modeling.checkpoint --model_class SpeechModel ...")
+    if architecture['model_class'] != "SpeechModel":
+        raise ValueError(f"stream scores SpeechModel checkpoints, not {architecture['model_class']}")
+    load_pretrained = not has_encoder_weights(restore_state)
+    model = build_model(architecture, load_pretrained=load_pretrained)
+    restore_params(model, restore_state, load_pretrained=load_pretrained)
+    model = model.to(device)
+    one_output = model.word_outputs == 0
+
+    scores = stream_score(model, read_chunks(args.audio_path, tokenizer.sampling_rate), tokenizer, window_s=args.window_s,
+                          overlap_s=args.overlap_s, batch_size=8, device=device, one_output=one_output,
+                          precision=args.precision)
+    pred_cols = [f'pred_{c}' for c in ['accuracy', 'fluency', 'prosodic', 'total']]
+    # one row per window, then the length-weighted score of the whole recording
+    rows = [{'start_s': start / tokenizer.sampling_rate, 'end_s': end / tokenizer.sampling_rate, **dict(zip(pred_cols, window))}
+            for (start, end), window in zip(scores['windows'], scores['window_sentence'].tolist())]
+    rows.append({'start_s': 0.0, 'end_s': scores['windows'][-1][1] / tokenizer.sampling_rate, **dict(zip(pred_cols, scores['sentence'].tolist()))})
+    pd.DataFrame(rows).to_csv(args.outputs_path, index=False)
+    print(dict(zip(pred_cols, scores['sentence'].tolist())))
 
 else:
-    print("Invalid function name. Choose pretrain, finetune, or evaluate")     
\ No newline at end of file
+    print("Invalid function name. Choose pretrain, finetune, evaluate, or stream")     
\ No newline at end of file
@@ -5,15 +5,17 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 from torch.nn import functional as F
-from modeling.model import BaseModel, BaseDevModel, ETSModel, HierarchicalModel, SpeechModel, SiameseSpeechModel, MultitaskModel
-from torch.utils.tensorboard import SummaryWriter
+from modeling.model import BaseModel, BaseDevModel, ETSModel, HierarchicalModel, SpeechModel, SiameseSpeechModel, MultitaskModel, PooledModel, has_encoder_weights, restore_params
 from transformers import AutoTokenizer, AutoFeatureExtractor
 import random
 import argparse
 
 from modeling import trainer
-from data_loading.datasets import DefaultDataset, SpeechDataset
-from data_loading.dataloaders import get_data_loaders, split_on_indices
+from modeling.checkpoint import load_params
+from modeling.adapters import apply_lora
+from data_loading.datasets import DefaultDataset
+from data_loading.dataloaders import get_data_loaders, split_on_indices, pad_audio_collate
+from data_loading.feature_cache import build_feature_cache, build_reference_cache
 from settings import *
 import run_utils as utils
 from functools import partial
@@ -32,6 +34,15 @@ def load_data(tokenizer):
     dataset = utils.get_dataset(global_args, tokenizer)
     return dataset
 
+def micro_batching(batch_size):
+    # (loader batch size, micro-batches per optimizer step) for a sampled effective batch size
+    micro_batch_size = global_args.micro_batch_size
+    if micro_batch_size is None or micro_batch_size >= batch_size:
+        return batch_size, 1
+    if batch_size % micro_batch_size != 0:
+        raise ValueError(f"batch_size {batch_size} is not a multiple of --micro_batch_size {micro_batch_size}")
+    return micro_batch_size, batch_size // micro_batch_size
+
 def train_written(tune_config, filename, model_name, out_path):
     from modeling import trainer
     args = global_args  
@@ -41,41 +52,69 @@ def train_written(tune_config, filename, model_name, out_path):
     )
 
     dataset = load_data(tokenizer)
+    # restoring a checkpoint that holds the encoder: build it from its config rather than loading it twice
+    restore_state = load_params(args.reading_params_path) if args.reading_params_path is not None else None
+    load_pretrained = restore_state is None or not has_encoder_weights(restore_state)
+    loader_batch_size, grad_accumulation_steps = micro_batching(tune_config["batch_size"])
     train_config = trainer.TrainerConfig(
         max_epochs=tune_config["max_epochs"],
         learning_rate=tune_config["lr"],
         lr_decay=tune_config["lr_decay"],
         num_workers=4,
-    )
-    train_dl, val_dl, _ = get_data_loaders(
-        dataset,
-        val_size=0.2,
-        test_size=0,
-        batch_size=tune_config["batch_size"],
-        val_batch_size=16,
-        test_batch_size=1,
-        num_workers=0,
+        precision=args.precision,
+        grad_accumulation_steps=grad_accumulation_steps,
+        gradient_checkpointing=args.gradient_checkpointing,
     )
     if model_name == 'baseline':
         model = BaseModel(
             seq_length=dataset.tokenizer.model_max_length,
             num_outputs=len(dataset.targets.columns),
             pretrain_model_name=args.tokenizer_name,
+            load_pretrained=load_pretrained,
         )
     elif model_name == 'ets':
-          model = ETSModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+          model = ETSModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
     elif model_name == 'hierarchical':
-         model = HierarchicalModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+         model = HierarchicalModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
     elif model_name == 'multitask':
-         model = MultitaskModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name)
+         model = MultitaskModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, load_pretrained=load_pretrained)
+    elif model_name.startswith('pooled-'):
+         model = PooledModel(seq_length=dataset.tokenizer.model_max_length, num_outputs=len(dataset.targets.columns), pretrain_model_name=args.tokenizer_name, pooling=model_name.split('-', 1)[1], load_pretrained=load_pretrained)
     
     if(tune_config['freezing']):
         for name, param in model.named_parameters():
             if 'transformer' in name:
                 param.requires_grad = False
 
-    if args.reading_params_path is not None:
-        model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+    if restore_state is not None:
+        restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
+    if args.lora_r is not None:
+        # only the adapters and the head are trained, and each trial's checkpoints hold only those
+        apply_lora(model, r=args.lora_r, alpha=args.lora_alpha, base_params=None if load_pretrained else args.reading_params_path)
+
+    dynamic_padding = args.dynamic_padding
+    if args.feature_cache_dir is not None:
+        # run the frozen encoder once (shared by all trials through the on-disk cache) and only train the head
+        for param in model.l1.parameters():
+            param.requires_grad = False
+        device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+        dataset = build_feature_cache(model, dataset, args.feature_cache_dir, checkpoint=args.reading_params_path,
+                                      device=device, pad_token_id=tokenizer.pad_token_id)
+        # cached hidden states are ragged and padded per batch; pooled vectors have a fixed width and no attention
+        # mask, so pad_collate must not see them
+        dynamic_padding = dataset.kind == "hidden"
+
+    train_dl, val_dl, _ = get_data_loaders(
+        dataset,
+        val_size=0.2,
+        test_size=0,
+        batch_size=loader_batch_size,
+        val_batch_size=16,
+        test_batch_size=1,
+        num_workers=0,
+        dynamic_padding=dynamic_padding,
+        pad_token_id=tokenizer.pad_token_id,
+    )
 
     trainer = trainer.Trainer(
         model=model,
@@ -86,33 +125,31 @@ def train_written(tune_config, filename, model_name, out_path):
 
     output_folder = "/home/ubuntu/nlp-toefl-autograder/tuning/{}/trial_{}/".format(out_path, tune.get_trial_id().split('_')[1])
     os.makedirs(os.path.dirname(output_folder), exist_ok=True)
-    trainer.tokens = 0 # counter used for learning rate decay
-    model_min_loss=float('inf')
-    for epoch in range(tune_config["max_epochs"]):
-        train_loss = trainer.train('train', epoch)
-        if trainer.val_dataloader:
-            val_loss = trainer.train('val', epoch)
-        else:
-            val_loss = None
-
-        if (val_loss < model_min_loss):
-
-            model_min_loss = val_loss
-            tune_config['stopping_epoch'] = epoch
-            tune_config['loss'] = val_loss
-
-            torch.save(model.state_dict(), output_folder+"best-model.params")
-            with open(output_folder+"best-model.txt", 'w') as convert_file:
-                convert_file.write(json.dumps(tune_config))
-
-        trainer.losses.append((train_loss, val_loss))
+    if args.resume_trials:
+        # each trial keeps its full training state and, when restarted, continues after its last finished epoch
+        trainer.config.state_path = output_folder + "training-state.pt"
+    trainer.config.patience, trainer.config.min_delta = args.patience, args.min_delta
+    # written each time the val loss improves, and read back by resume()
+    trainer.config.best_path, trainer.config.tokenizer_name = output_folder+"best-model"+args.params_suffix, args.tokenizer_name
+
+    def report(epoch, train_loss, val_loss):
         with open(output_folder+"all-losses.txt", 'w') as convert_file:
-                convert_file.write(json.dumps(trainer.losses))
+            convert_file.write(json.dumps(trainer.losses))
         tune.report(loss=(val_loss))
-    torch.save(model.state_dict(), output_folder+"final-model.params")
+
+    # the best weights are kept in memory and written to best_path only when they improve
+    trainer.fit(tune_config["max_epochs"], on_epoch_end=report)
+    tune_config['stopping_epoch'] = trainer.best_epoch
+    tune_config['loss'] = trainer.best_loss
+    tune_config['stop_reason'] = trainer.stop_reason
+    with open(output_folder+"best-model.txt", 'w') as convert_file:
+        convert_file.write(json.dumps(tune_config))
+    trainer.checkpointer.save_params(model, output_folder+"final-model"+args.params_suffix, args.tokenizer_name)
+    trainer.checkpointer.wait()
     print("Finished Training")
 
 def train_speech(tune_config, model_name, filename='best-params'):
+    from data_loading.speech_datasets import SpeechDataset, DEFAULT_VAD_PARAMS
     args = global_args  
 
     tokenizer = AutoFeatureExtractor.from_pretrained(args.tokenizer_name)
@@ -125,34 +162,53 @@ def train_speech(tune_config, model_name, filename='best-params'):
          
     dataset = SpeechDataset(path_name=SPEECHOCEAN_DATA_DIR, input_col = 'audio', target_cols_sentence=['accuracy', 'fluency', 'prosodic', 'total'],
     target_cols_words = target_cols_words, target_cols_phones = target_cols_phones, tokenizer=tokenizer,
-    siamese=(model_name == "siamese-speech"))
+    siamese=(model_name == "siamese-speech"), cache_dir=args.audio_cache_dir, dynamic_padding=args.dynamic_padding,
+    vad_params={**DEFAULT_VAD_PARAMS, 'threshold_db': args.vad_threshold_db} if args.trim_silence else None)
 
     from modeling import trainer
 
+    loader_batch_size, grad_accumulation_steps = micro_batching(tune_config["batch_size"])
     train_config = trainer.TrainerConfig(
         max_epochs=tune_config["max_epochs"],
         learning_rate=tune_config["lr"],
         lr_decay=tune_config["lr_decay"],
         num_workers=4,
+        precision=args.precision,
+        grad_accumulation_steps=grad_accumulation_steps,
+        gradient_checkpointing=args.gradient_checkpointing,
     )
     train_dl, val_dl, _ = split_on_indices(
         dataset,
         index_col="speaker_id",
         val_size=0.1,
         test_size=0.1,
-        batch_size=tune_config["batch_size"],
+        batch_size=loader_batch_size,
         val_batch_size=1,
         test_batch_size=1,
         num_workers=0,
-        seed=args.seed
+        seed=args.seed,
+        dynamic_padding=args.dynamic_padding,
+        collate_fn=pad_audio_collate
     )
+    restore_state = load_params(args.reading_params_path) if args.reading_params_path is not None else None
+    load_pretrained = restore_state is None or not has_encoder_weights(restore_state)
     use_mod = SpeechModel if model_name == "speech" else SiameseSpeechModel
     model = use_mod(num_outputs=len(dataset.targets_sentence.columns), pretrain_model_name=args.tokenizer_name,
-    phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length, word_outputs = 0 if dataset.targets_words is None else len(dataset.targets_words.columns),
-    alpha=args.alpha)
-
-    if args.reading_params_path is not None:
-        model.load_state_dict(torch.load(args.reading_params_path), strict=False)
+    phoneme_seq_length=dataset.phoneme_seq_length, word_seq_length=dataset.word_seq_length, word_outputs = 0 if dataset.targets_words is None else dataset.targets_words.shape[1],
+    alpha=args.alpha, pooling=args.pooling, load_pretrained=load_pretrained)
+
+    if restore_state is not None:
+        restore_params(model, restore_state, strict=False, load_pretrained=load_pretrained)
+    if args.lora_r is not None:
+        # only the adapters and the head are trained, and each trial's checkpoints hold only those
+        apply_lora(model, r=args.lora_r, alpha=args.lora_alpha, base_params=None if load_pretrained else args.reading_params_path)
+    if model_name == "siamese-speech" and args.reference_cache_dir:
+        # encode each prompt's reference speech once; training then reads the embedding instead of the waveform.
+        # The encoder is frozen so the live (input) branch keeps matching the cached reference branch
+        for param in model.l1.parameters():
+            param.requires_grad = False
+        device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+        build_reference_cache(model, dataset, args.reference_cache_dir, checkpoint=args.reading_params_path, device=device)
 
     trainer = trainer.Trainer(
         model=model,
@@ -164,30 +220,27 @@ def train_speech(tune_config, model_name, filename='best-params'):
 
     output_folder = "/home/ubuntu/nlp-toefl-autograder/tuning/{}/{}/seed_{}/trial_{}/".format(model_name, args.version, args.seed, tune.get_trial_id().split('_')[1])
     os.makedirs(os.path.dirname(output_folder), exist_ok=True)
-    trainer.tokens = 0 # counter used for learning rate decay
-    model_min_loss=float('inf')
-    for epoch in range(tune_config["max_epochs"]):
-        train_loss = trainer.train('train', epoch)
-        if trainer.val_dataloader:
-            val_loss = trainer.train('val', epoch)
-        else:
-            val_loss = None
-
-        if (val_loss < model_min_loss):
-
-            model_min_loss = val_loss
-            tune_config['stopping_epoch'] = epoch
-            tune_config['loss'] = val_loss
-
-            torch.save(model.state_dict(), output_folder+"best-model.params")
-            with open(output_folder+"best-model.txt", 'w') as convert_file:
-                convert_file.write(json.dumps(tune_config))
-
-        trainer.losses.append((train_loss, val_loss))
+    if args.resume_trials:
+        # each trial keeps its full training state and, when restarted, continues after its last finished epoch
+        trainer.config.state_path = output_folder + "training-state.pt"
+    trainer.config.patience, trainer.config.min_delta = args.patience, args.min_delta
+    # written each time the val loss improves, and read back by resume()
+    trainer.config.best_path, trainer.config.tokenizer_name = output_folder+"best-model"+args.params_suffix, args.tokenizer_name
+
+    def report(epoch, train_loss, val_loss):
         with open(output_folder+"all-losses.txt", 'w') as convert_file:
-                convert_file.write(json.dumps(trainer.losses))
+            convert_file.write(json.dumps(trainer.losses))
         tune.report(loss=(val_loss))
-    torch.save(model.state_dict(), output_folder+"final-model.params")
+
+    # the best weights are kept in memory and written to best_path only when they improve
+    trainer.fit(tune_config["max_epochs"], on_epoch_end=report)
+    tune_config['stopping_epoch'] = trainer.best_epoch
+    tune_config['loss'] = trainer.best_loss
+    tune_config['stop_reason'] = trainer.stop_reason
+    with open(output_folder+"best-model.txt", 'w') as convert_file:
+        convert_file.write(json.dumps(tune_config))
+    trainer.checkpointer.save_params(model, output_folder+"final-model"+args.params_suffix, args.tokenizer_name)
+    trainer.checkpointer.wait()
     print("Finished Training")
 
 def main(model_name, outpath, num_samples=15, max_num_epochs=20, gpus_per_trial=1, filename=None, version=''):
@@ -257,11 +310,28 @@ def main(model_name, outpath, num_samples=15, max_num_epochs=20, gpus_per_trial=
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser()
-    argp.add_argument('--model', type=str, help='Choose speech/ets/hierarchical/baseline', required=True)
+    argp.add_argument('--model', type=str, help='Choose speech/ets/hierarchical/baseline/pooled-mean/pooled-cls/pooled-attention', required=True)
     argp.add_argument('--version', type=str, help='Choose version name for speech', required=False, default="baseline")
     argp.add_argument('--seed', type=int, help='Choose speech/ets/hierarchical/baseline', required=False, default=0)
     argp.add_argument('--alpha', type=float, help='Alpha value to use for speech', required=False, default=1)
     argp.add_argument('--one_output', action='store_true')
+    argp.add_argument('--dynamic_padding', action='store_true', help='Pad batches to their longest essay/clip and bucket by length (pooled models only)')
+    argp.add_argument('--speech_pooling', type=str, help='Speech head: unset for the flattened 312-frame head, "mean" for masked temporal mean pooling', required=False, default=None)
+    argp.add_argument('--feature_cache_dir', type=str, help='Cache frozen-encoder outputs here and train only the head (pooled models only)', required=False, default=None)
+    argp.add_argument('--token_cache_dir', type=str, help='Directory for the memory-mapped pre-tokenization cache', required=False, default=None)
+    argp.add_argument('--audio_cache_dir', type=str, help='Extract speech features once into a memory-mapped cache here (speech models)', required=False, default=None)
+    argp.add_argument('--trim_silence', action='store_true', help='Trim leading/trailing silence (energy VAD) off clips before feature extraction (speech models)')
+    argp.add_argument('--vad_threshold_db', type=float, help='Frames this many dB below the loudest frame count as silence', required=False, default=-40.0)
+    argp.add_argument('--reference_cache_dir', type=str, help='Encode the siamese reference speech once per prompt and cache it here', required=False, default=None)
+    argp.add_argument('--resume_trials', action='store_true', help='Keep each trial\'s training state and resume it from its last finished epoch')
+    argp.add_argument('--patience', type=int, help='Stop a trial after this many epochs without a val loss improvement', required=False, default=None)
+    argp.add_argument('--min_delta', type=float, help='Smallest val loss decrease that counts as an improvement', required=False, default=0.0)
+    argp.add_argument('--gradient_checkpointing', action='store_true', help='Recompute encoder activations in backward to fit larger batches')
+    argp.add_argument('--lora_r', type=int, help='Train rank-r LoRA adapters on the encoder (and the head) instead of the whole model', default=None, required=False)
+    argp.add_argument('--lora_alpha', type=float, help='LoRA scaling numerator (the update is scaled by alpha / r)', default=16, required=False)
+    argp.add_argument('--micro_batch_size', type=int, help='Split each sampled batch_size into micro-batches of this size and accumulate gradients', required=False, default=None)
+    argp.add_argument('--precision', type=str, help='Autocast precision for training: fp32, bf16 or fp16 (CUDA)', required=False, default="fp32")
+    argp.add_argument('--safetensors', action='store_true', help='Write best/final-model checkpoints as memory-mappable .safetensors')
     clargs = argp.parse_args()
 
     import sys
@@ -354,6 +424,10 @@ if __name__ == "__main__":
          global_args = baseline_args
          params_output_name = "baseline-best-model.params"
          trials, epochs_per_trial  = 2, 20
+    elif clargs.model in ['pooled-mean', 'pooled-cls', 'pooled-attention']:
+        global_args = baseline_args
+        params_output_name = "{}-best-model.params".format(clargs.model)
+        trials, epochs_per_trial  = 2, 20
     elif clargs.model == "ell-baseline":
         global_args = baseline_args
         params_output_name = "baseline-best-model.params"
@@ -364,6 +438,41 @@ if __name__ == "__main__":
          print("choose a valid model")
          sys.exit(0)
     
+    global_args.token_cache_dir = clargs.token_cache_dir
+    global_args.dynamic_padding = clargs.dynamic_padding
+    global_args.feature_cache_dir = clargs.feature_cache_dir
+    global_args.audio_cache_dir = clargs.audio_cache_dir
+    global_args.pooling = clargs.speech_pooling
+    global_args.trim_silence = clargs.trim_silence
+    global_args.vad_threshold_db = clargs.vad_threshold_db
+    global_args.reference_cache_dir = clargs.reference_cache_dir
+    global_args.precision = clargs.precision
+    global_args.micro_batch_size = clargs.micro_batch_size
+    global_args.resume_trials = clargs.resume_trials
+    global_args.patience = clargs.patience
+    global_args.gradient_checkpointing = clargs.gradient_checkpointing
+    global_args.lora_r = clargs.lora_r
+    global_args.lora_alpha = clargs.lora_alpha
+    global_args.min_delta = clargs.min_delta
+    global_args.params_suffix = ".safetensors" if clargs.safetensors else ".params"
+    is_speech = clargs.model in ["speech", "siamese-speech"]
+    if clargs.feature_cache_dir and not clargs.model.startswith('pooled-'):
+        print("--feature_cache_dir needs a pooled model")
+        sys.exit(0)
+    if clargs.feature_cache_dir and clargs.lora_r is not None:
+        print("--lora_r trains the encoder's adapters, which --feature_cache_dir skips")
+        sys.exit(0)
+    if clargs.dynamic_padding and not (clargs.model.startswith('pooled-') or (is_speech and clargs.speech_pooling)):
+        print("--dynamic_padding needs a pooled model (or --speech_pooling for speech models)")
+        sys.exit(0)
+    if clargs.reference_cache_dir and not (clargs.model == "siamese-speech" and clargs.speech_pooling and clargs.dynamic_padding):
+        # cached references are unpadded (frames, hidden_size) arrays: only pad_audio_collate and a pooled head take them
+        print("--reference_cache_dir needs --model siamese-speech with --speech_pooling and --dynamic_padding")
+        sys.exit(0)
+    if clargs.reference_cache_dir and clargs.lora_r is not None:
+        print("--reference_cache_dir freezes the encoder, which --lora_r would train")
+        sys.exit(0)
+
     model_name = clargs.model
     if clargs.model == "ets2" or clargs.model == "ell-baseline":
         model_name = "baseline"
@@ -5,10 +5,10 @@ import argparse
 def get_argparser():
     argp = argparse.ArgumentParser()
     argp.add_argument('function', help="Choose pretrain, finetune, or evaluate") #TODO: add behavior for pretrain and eval
-    argp.add_argument("--model_type", type=str, default="base", required=False)
+    argp.add_argument("--model_type", type=str, help="base/base-og/base-dev/ets/hierarchical/multitask/pooled-mean/pooled-cls/pooled-attention", default="base", required=False)
     argp.add_argument("--val_losses_path", type=str, required=False)
-    argp.add_argument('--writing_params_path', type=str, help='Path to the writing params file', required=False)
-    argp.add_argument('--reading_params_path', type=str, help='Path to the reading params file', required=False)
+    argp.add_argument('--writing_params_path', type=str, help='Path to the writing params file (a .safetensors path writes the memory-mappable format)', required=False)
+    argp.add_argument('--reading_params_path', type=str, help='Path to the reading params file (.params/.pt or .safetensors)', required=False)
     argp.add_argument('--loss_path', type=str, help='Path to the output losses', default="losses.txt", required=False)
     argp.add_argument('--outputs_path', type=str, help='Path to the output predictions', default="predictions.txt", required=False)
     argp.add_argument('--in_distribution_outputs_path', type=str, help='Path to the in-distribution output predictions', default="predictions.txt", required=False)
@@ -18,30 +18,42 @@ def get_argparser():
     argp.add_argument('--max_epochs', type=int, help='Number of epochs to train for', default=20, required=False)
     argp.add_argument('--learning_rate', type=float, help='Learning rate', default=2e-5, required=False)
     argp.add_argument('--lr_decay', type=str, help='Decay Learning Rate', default="False", required=False)
+    argp.add_argument('--dynamic_padding', action='store_true', help='Pad batches to their longest essay and bucket by length (pooled models only)')
+    argp.add_argument('--eval_batch_size', type=int, help='Batch size used when scoring', default=64, required=False)
+    argp.add_argument('--state_path', type=str, help='Save the full training state here every epoch and resume from it if it exists', default=None, required=False)
+    argp.add_argument('--profile', action='store_true', help='Time each training phase and record throughput and peak memory (to TensorBoard and expt/profile.json)')
+    argp.add_argument('--trace_dir', type=str, help='Write a torch.profiler trace of a few steps of the first epoch here', default=None, required=False)
+    argp.add_argument('--gradient_checkpointing', action='store_true', help='Recompute encoder activations in backward to fit larger batches')
+    argp.add_argument('--lora_r', type=int, help='Train rank-r LoRA adapters on the encoder (and the head) instead of the whole model', default=None, required=False)
+    argp.add_argument('--lora_alpha', type=float, help='LoRA scaling numerator (the update is scaled by alpha / r)', default=16, required=False)
+    argp.add_argument('--grad_accumulation_steps', type=int, help='Micro-batches accumulated per optimizer step', default=1, required=False)
+    argp.add_argument('--precision', type=str, help='Autocast precision for training and scoring: fp32, bf16 or fp16 (CUDA)', default="fp32", required=False)
+    argp.add_argument('--token_cache_dir', type=str, help='Directory for the memory-mapped pre-tokenization cache', default=None, required=False)
     return argp
 
 def get_dataset(args, tokenizer):
+    cache_dir = getattr(args, 'token_cache_dir', None)
     if args.model_type != "hierarchical":
         if args.dataset == "ELL":
             return DefaultDataset(file_path=ELL_DATA_DIR, input_col='full_text', target_cols=['cohesion', 'syntax',  'vocabulary',  'phraseology',  'grammar',  'conventions'], index_col='text_id', 
-                                    tokenizer=tokenizer)
+                                    tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "ICNALE-EDITED":
             if args.ICNALE_output == "overall":
                 return DefaultDataset(file_path=ICNALE_EDITED_DATA_DIR, input_col='essay', target_cols=['Total 1 (%)'], index_col=None, 
-                                        tokenizer=tokenizer)
+                                        tokenizer=tokenizer, cache_dir=cache_dir)
             else:
                 return DefaultDataset(file_path=ICNALE_EDITED_DATA_DIR, input_col='essay', target_cols=['Content (/12)', 'Organization (/12)',
             'Vocabulary (/12)', 'Language Use (/12)', 'Mechanics (/12)'], index_col=None, 
-                                        tokenizer=tokenizer)
+                                        tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "ICNALE-WRITTEN": #TODO: lots of missing fields in this dataset, what imputations should we use?
             return DefaultDataset(file_path=ICNALE_WRITTEN_DATA_DIR, input_col='essay', target_cols=['Score'], index_col="sortkey", 
-                                    tokenizer=tokenizer)
+                                    tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "FCE":
             return DefaultDataset(file_path=FCE_DATA_DIR, input_col='essay', target_cols=['overall_score'], 
-                                    tokenizer=tokenizer)
+                                    tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "ETS":
             return DefaultDataset(file_path=ETS_DATA_DIR, input_col='response', target_cols=['low', 'medium', 'high'], 
-                                    tokenizer=tokenizer, normalize=False)
+                                    tokenizer=tokenizer, normalize=False, cache_dir=cache_dir)
         else:
             raise ValueError("Invalid dataset name")
     elif args.model_type == "hierarchical":
@@ -49,24 +61,42 @@ def get_dataset(args, tokenizer):
             return CombinedDataset(
                 file_path1=ELL_DATA_DIR, file_path2=ICNALE_EDITED_DATA_DIR, input_col1="full_text", input_col2="essay",
                 target_cols1=['cohesion', 'syntax',  'vocabulary',  'phraseology',  'grammar',  'conventions'],
-                target_cols2=['Total 1 (%)'], tokenizer=tokenizer)
+                target_cols2=['Total 1 (%)'], tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "FCE":
             return DefaultDataset(file_path=FCE_DATA_DIR, input_col='essay', target_cols=['overall_score'], 
-                                    tokenizer=tokenizer)
+                                    tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "ICNALE-EDITED":
             if args.ICNALE_output == "overall":
                 return DefaultDataset(file_path=ICNALE_EDITED_DATA_DIR, input_col='essay', target_cols=['Total 1 (%)'], index_col=None, 
-                                        tokenizer=tokenizer)
+                                        tokenizer=tokenizer, cache_dir=cache_dir)
             else:
                 return DefaultDataset(file_path=ICNALE_EDITED_DATA_DIR, input_col='essay', target_cols=['Content (/12)', 'Organization (/12)',
             'Vocabulary (/12)', 'Language Use (/12)', 'Mechanics (/12)'], index_col=None, 
-                                        tokenizer=tokenizer)
+                                        tokenizer=tokenizer, cache_dir=cache_dir)
         elif args.dataset == "ETS":
             return DefaultDataset(file_path=ETS_DATA_DIR, input_col='response', target_cols=['score'], 
-                                    tokenizer=tokenizer, normalize=False)
+                                    tokenizer=tokenizer, normalize=False, cache_dir=cache_dir)
         else:
             raise ValueError("Invalid dataset name")
 
+def legacy_architecture(args, dataset):
+    # checkpoints saved before they recorded their architecture: infer it from the flags and the checkpoint
+    # path the way evaluate always has, but settle on it before anything is constructed
+    model_class, num_outputs, extra = "BaseModel", len(dataset.targets.columns), {}
+    if args.dataset == "FCE" and ("ell" in args.reading_params_path or "ets2" in args.reading_params_path):
+        num_outputs = 6
+    if args.dataset == "FCE" and "icnale-baseline-categories" in args.reading_params_path:
+        num_outputs = 5
+    if args.dataset == "FCE" and args.model_type == "hierarchical":
+        model_class, num_outputs = "HierarchicalModel", 7
+    if args.model_type == "multitask":
+        model_class, num_outputs = "MultitaskModel", 7
+    if args.model_type.startswith("pooled-"):
+        model_class, num_outputs = "PooledModel", len(dataset.targets.columns)
+        extra = {'pooling': args.model_type.split("-", 1)[1]}
+    return {'model_class': model_class, 'seq_length': dataset.tokenizer.model_max_length, 'num_outputs': num_outputs,
+            'pretrain_model_name': args.tokenizer_name, **extra}
+
 def write_predictions(path, predictions):
     with open(path, 'w') as f:
         for pred in predictions: